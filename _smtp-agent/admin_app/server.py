@@ -1,11 +1,19 @@
+import html
+import json
+import logging
 import os
+import re
 import threading
+import time
 from functools import wraps
 
-from flask import Flask, jsonify, request, render_template, redirect, url_for
+from flask import Flask, Response, jsonify, request, render_template, redirect, url_for, stream_with_context
 from flask_httpauth import HTTPBasicAuth
 
 import config
+import metrics
+from config_provider import get_config_provider
+from utils import tail_lines, follow_file
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 
@@ -16,11 +24,36 @@ except Exception:
     firebase_admin = None
     firestore = None
 
+try:
+    from delivery_stats import read_stats
+except Exception:
+    read_stats = None
+
 _auth = HTTPBasicAuth()
 
 ADMIN_USER = config.ADMIN_USER or os.environ.get("ADMIN_USER", "")
 ADMIN_PASS = config.ADMIN_PASS or os.environ.get("ADMIN_PASS", "")
 
+# Field projections: list and stats queries never need the HTML body
+LIST_FIELDS = [
+    "to",
+    "subject",
+    "message.subject",
+    "createdAt",
+    "smtpAgent.state",
+    "smtpAgent.lastUpdatedAt",
+    "smtpAgent.lastAttempt.errorMessage",
+]
+STATS_FIELDS = ["smtpAgent.state", "smtpAgent.lastUpdatedAt"]
+NEIGHBOR_FIELDS = ["smtpAgent.lastUpdatedAt"]
+
+# Ids of the last /emails page per state filter, reused for prev/next links
+LISTING_CACHE_TTL = 60  # seconds
+_listing_cache = {}  # state -> (monotonic time, [doc ids, newest first])
+
+# Last Firestore reachability check for /health: (monotonic time, ok, error)
+_health_cache = {"at": None, "ok": False, "error": None}
+
 
 def _check_creds(username, password):
     return username == ADMIN_USER and password == ADMIN_PASS and bool(username)
@@ -33,6 +66,79 @@ def verify_password(username, password):
     return None
 
 
+# Level as written by the '%(name)s - %(levelname)s - %(message)s' log format
+_LOG_LEVEL_RE = re.compile(r' - (DEBUG|INFO|WARNING|ERROR|CRITICAL) - ')
+
+
+def _log_filter_args():
+    """(minimum level number or None, substring or None) from ?level= and ?q=."""
+    level = (request.args.get("level") or "").upper()
+    min_level = logging.getLevelName(level) if level else None
+    if not isinstance(min_level, int):
+        min_level = None
+    return min_level, request.args.get("q") or None
+
+
+def _log_line_matches(line, min_level, needle):
+    if needle and needle not in line:
+        return False
+    if min_level is not None:
+        m = _LOG_LEVEL_RE.search(line)
+        if m is None or logging.getLevelName(m.group(1)) < min_level:
+            return False
+    return True
+
+
+def _encode_cursor(updated_at, doc_id):
+    """Keyset cursor for /emails: lastUpdatedAt plus document id as tie-breaker."""
+    return f"{updated_at.isoformat()}|{doc_id}"
+
+
+def _decode_cursor(cursor):
+    ts, _, doc_id = (cursor or "").partition("|")
+    if not doc_id:
+        return None
+    try:
+        return datetime.fromisoformat(ts), doc_id
+    except ValueError:
+        return None
+
+
+def _ordered_query(col, state, direction):
+    """Mail ordered by smtpAgent.lastUpdatedAt, then document id, optionally filtered by state."""
+    q = col
+    if state in ("SENT", "ERROR"):
+        q = q.where("smtpAgent.state", "==", state)
+    return (
+        q.order_by("smtpAgent.lastUpdatedAt", direction=direction)
+        .order_by(firestore.FieldPath.document_id(), direction=direction)
+    )
+
+
+def _neighbor(col, state, doc_id, updated_at, direction):
+    """Id of the document right after (doc_id, updated_at) in the given order, or None."""
+    q = _ordered_query(col, state, direction)
+    q = q.start_after({"smtpAgent.lastUpdatedAt": updated_at, "__name__": doc_id})
+    q = q.limit(1).select(NEIGHBOR_FIELDS)
+    for snap in q.stream():
+        return snap.id
+    return None
+
+
+def _cached_neighbors(state, doc_id):
+    """(newer, older) ids from the cached listing; either may be None if unknown."""
+    entry = _listing_cache.get(state)
+    if not entry or time.monotonic() - entry[0] > LISTING_CACHE_TTL:
+        return None, None
+    ids = entry[1]
+    if doc_id not in ids:
+        return None, None
+    idx = ids.index(doc_id)
+    newer = ids[idx - 1] if idx > 0 else None
+    older = ids[idx + 1] if idx < len(ids) - 1 else None
+    return newer, older
+
+
 def create_app():
     app = Flask(__name__)
 
@@ -98,23 +204,26 @@ def create_app():
             "logLevel": effective["logLevel"],
         }
         # Firestore check
-        fs_ok = False
-        fs_error = None
-        try:
-            if firebase_admin is not None:
-                try:
-                    firebase_admin.get_app()
-                except ValueError:
-                    # Not initialized yet; listener will do it. Attempt lightweight client anyway.
-                    pass
-                if firestore is not None:
-                    db = firestore.client()
-                    # read a lightweight doc; existence not important
-                    db.collection("_smtpAgentTests").document("_health").get()
-                    fs_ok = True
-        except Exception as e:
-            fs_error = str(e)
-        status["firestore"] = {"ok": fs_ok, "error": fs_error}
+        checked_at = _health_cache["at"]
+        if checked_at is None or time.monotonic() - checked_at >= config.HEALTH_CACHE_TTL:
+            fs_ok = False
+            fs_error = None
+            try:
+                if firebase_admin is not None:
+                    try:
+                        firebase_admin.get_app()
+                    except ValueError:
+                        # Not initialized yet; listener will do it. Attempt lightweight client anyway.
+                        pass
+                    if firestore is not None:
+                        db = firestore.client()
+                        # read a lightweight doc; existence not important
+                        db.collection("_smtpAgentTests").document("_health").get()
+                        fs_ok = True
+            except Exception as e:
+                fs_error = str(e)
+            _health_cache.update(at=time.monotonic(), ok=fs_ok, error=fs_error)
+        status["firestore"] = {"ok": _health_cache["ok"], "error": _health_cache["error"]}
         return jsonify(status)
 
     def _read_status_reset(db):
@@ -129,50 +238,36 @@ def create_app():
 
     def _collect_stats():
         stats = {
-            "h1": {"sent": 0, "error": 0},
-            "h24": {"sent": 0, "error": 0},
+            "h1": {"sent": 0, "error": 0, "retry": 0},
+            "h24": {"sent": 0, "error": 0, "retry": 0},
             "lastProcessedAt": None,
             "status": {"indicator": "green", "since": None, "errorsSinceReset": 0},
             "serverTime": None,
+            "pollInterval": None,
         }
         now = datetime.now(timezone.utc)
         stats["serverTime"] = now.isoformat()
+        # Effective (adaptive) interval of the agent running in this process
+        gauge = metrics.REGISTRY.get("smtp_agent_poll_interval_seconds")
+        stats["pollInterval"] = gauge.get() if gauge is not None else None
         if firestore is None:
             return stats
         try:
             db = firestore.client()
             reset_at = _read_status_reset(db)
-            t1 = now - timedelta(hours=1)
             t24 = now - timedelta(hours=24)
-            # Query last 24h processed docs
-            q24 = (
-                db.collection(config.MAIL_COLLECTION)
-                .where("smtpAgent.lastUpdatedAt", ">=", t24)
-            )
-            docs = q24.stream()
-            last_ts = None
-            errors_since_reset = 0
-            for d in docs:
-                data = d.to_dict() or {}
-                sa = data.get("smtpAgent", {}) or {}
-                st = (sa.get("state") or "").upper()
-                ts = sa.get("lastUpdatedAt")
-                if ts and (last_ts is None or ts > last_ts):
-                    last_ts = ts
-                if st == "SENT":
-                    stats["h24"]["sent"] += 1
-                elif st == "ERROR":
-                    stats["h24"]["error"] += 1
-                # track 1h inside same loop
-                if ts and ts >= t1:
-                    if st == "SENT":
-                        stats["h1"]["sent"] += 1
-                    elif st == "ERROR":
-                        stats["h1"]["error"] += 1
-                # errors since reset
-                if reset_at and ts and ts >= reset_at and st == "ERROR":
-                    errors_since_reset += 1
-            stats["lastProcessedAt"] = last_ts
+            # Pre-aggregated counters written by the agent: a handful of shard reads
+            agg = None
+            if read_stats is not None:
+                try:
+                    agg = read_stats(db, now, reset_at)
+                except Exception:
+                    agg = None
+            if agg is None:
+                agg = _scan_stats(db, now, reset_at)
+            stats["h1"] = agg["h1"]
+            stats["h24"] = agg["h24"]
+            stats["lastProcessedAt"] = agg["lastProcessedAt"]
             # If admin has never reset status, use 24h window as baseline
             if reset_at is None:
                 stats["status"]["since"] = t24.isoformat()
@@ -180,12 +275,53 @@ def create_app():
                 stats["status"]["indicator"] = "red" if stats["h24"]["error"] > 0 else "green"
             else:
                 stats["status"]["since"] = reset_at.isoformat()
-                stats["status"]["errorsSinceReset"] = errors_since_reset
-                stats["status"]["indicator"] = "red" if errors_since_reset > 0 else "green"
+                stats["status"]["errorsSinceReset"] = agg["errorsSinceReset"]
+                stats["status"]["indicator"] = "red" if agg["errorsSinceReset"] > 0 else "green"
         except Exception:
             pass
         return stats
 
+    def _scan_stats(db, now, reset_at):
+        """Fallback: count the last 24h of mail documents (used until shard counters exist)."""
+        agg = {
+            "h1": {"sent": 0, "error": 0, "retry": 0},
+            "h24": {"sent": 0, "error": 0, "retry": 0},
+            "lastProcessedAt": None,
+            "errorsSinceReset": 0,
+        }
+        t1 = now - timedelta(hours=1)
+        t24 = now - timedelta(hours=24)
+        # Query last 24h processed docs
+        q24 = (
+            db.collection(config.MAIL_COLLECTION)
+            .where("smtpAgent.lastUpdatedAt", ">=", t24)
+            .select(STATS_FIELDS)
+        )
+        docs = q24.stream()
+        last_ts = None
+        for d in docs:
+            data = d.to_dict() or {}
+            sa = data.get("smtpAgent", {}) or {}
+            st = (sa.get("state") or "").upper()
+            ts = sa.get("lastUpdatedAt")
+            if ts and (last_ts is None or ts > last_ts):
+                last_ts = ts
+            if st == "SENT":
+                agg["h24"]["sent"] += 1
+            elif st == "ERROR":
+                agg["h24"]["error"] += 1
+            # track 1h inside same loop
+            if ts and ts >= t1:
+                if st == "SENT":
+                    agg["h1"]["sent"] += 1
+                elif st == "ERROR":
+                    agg["h1"]["error"] += 1
+            # errors since reset
+            if reset_at and ts and ts >= reset_at and st == "ERROR":
+                agg["errorsSinceReset"] += 1
+        agg["lastProcessedAt"] = last_ts
+        return agg
+
     @app.get("/")
     @require_auth
     def index():
@@ -200,16 +336,26 @@ def create_app():
             except Exception:
                 merged = {
                     "pollInterval": config.POLL_INTERVAL,
+                    "pollIntervalMin": config.POLL_INTERVAL_MIN,
+                    "pollIntervalMax": config.POLL_INTERVAL_MAX,
                     "processFromAfter": config.PROCESS_FROM_AFTER or "",
                     "maxRetryCount": config.MAX_RETRY_COUNT,
+                    "maxConcurrentSends": config.MAX_CONCURRENT_SENDS,
+                    "maxSendsPerSecond": config.RATE_LIMIT_PER_SECOND,
+                    "maxSendsPerConnectionPerSecond": config.RATE_LIMIT_PER_CONNECTION,
                     "logLevel": config.LOG_LEVEL,
                     "dashboardRefreshSec": None,
                 }
         else:
             merged = {
                 "pollInterval": config.POLL_INTERVAL,
+                "pollIntervalMin": config.POLL_INTERVAL_MIN,
+                "pollIntervalMax": config.POLL_INTERVAL_MAX,
                 "processFromAfter": config.PROCESS_FROM_AFTER or "",
                 "maxRetryCount": config.MAX_RETRY_COUNT,
+                "maxConcurrentSends": config.MAX_CONCURRENT_SENDS,
+                "maxSendsPerSecond": config.RATE_LIMIT_PER_SECOND,
+                "maxSendsPerConnectionPerSecond": config.RATE_LIMIT_PER_CONNECTION,
                 "logLevel": config.LOG_LEVEL,
                 "dashboardRefreshSec": None,
             }
@@ -218,8 +364,12 @@ def create_app():
             cfg={
                 "mailCollection": config.MAIL_COLLECTION,
                 "pollInterval": merged.get("pollInterval"),
+                "pollIntervalMin": merged.get("pollIntervalMin"),
+                "pollIntervalMax": merged.get("pollIntervalMax"),
                 "processFromAfter": merged.get("processFromAfter"),
                 "maxRetryCount": merged.get("maxRetryCount"),
+                "maxConcurrentSends": merged.get("maxConcurrentSends"),
+                "maxSendsPerSecond": merged.get("maxSendsPerSecond"),
                 "logLevel": merged.get("logLevel"),
                 "dashboardRefreshSec": merged.get("dashboardRefreshSec") or 30,
             },
@@ -248,11 +398,13 @@ def create_app():
     @app.get("/emails")
     @require_auth
     def emails_list():
-        """List recently processed emails filtered by state (SENT or ERROR)."""
+        """List processed emails filtered by state (SENT or ERROR), newest first, one page at a time."""
         state = (request.args.get("state") or "").upper()
         limit = int(request.args.get("limit") or 50)
         limit = max(1, min(limit, 200))
+        after = request.args.get("after") or None
         items = []
+        next_cursor = None
         error = None
         if firestore is None:
             error = "Firestore not available"
@@ -260,37 +412,40 @@ def create_app():
             try:
                 db = firestore.client()
                 col = db.collection(config.MAIL_COLLECTION)
-                q = col
-                if state in ("SENT", "ERROR"):
-                    try:
-                        q = q.where("smtpAgent.state", "==", state)
-                    except Exception:
-                        pass
-                # order by lastUpdatedAt desc
-                try:
-                    q = q.order_by("smtpAgent.lastUpdatedAt", direction=firestore.Query.DESCENDING)
-                except Exception:
-                    pass
-                try:
-                    q = q.limit(limit)
-                except Exception:
-                    pass
-                docs = q.stream()
-                for d in docs:
+                q = _ordered_query(col, state, firestore.Query.DESCENDING)
+                cursor = _decode_cursor(after)
+                if cursor is not None:
+                    q = q.start_after({"smtpAgent.lastUpdatedAt": cursor[0], "__name__": cursor[1]})
+                # One extra document tells us whether there is a next page
+                q = q.limit(limit + 1).select(LIST_FIELDS)
+                docs = list(q.stream())
+                has_more = len(docs) > limit
+                for d in docs[:limit]:
                     data = d.to_dict() or {}
                     sa = data.get("smtpAgent", {}) or {}
                     items.append({
                         "id": d.id,
                         "to": data.get("to"),
-                        "subject": data.get("message", {}).get("subject") or data.get("subject"),
+                        "subject": (data.get("message", {}) or {}).get("subject") or data.get("subject"),
                         "state": sa.get("state"),
                         "createdAt": data.get("createdAt"),
                         "lastUpdatedAt": sa.get("lastUpdatedAt"),
                         "error": (sa.get("lastAttempt", {}) or {}).get("errorMessage"),
                     })
+                if has_more and items and isinstance(items[-1]["lastUpdatedAt"], datetime):
+                    next_cursor = _encode_cursor(items[-1]["lastUpdatedAt"], items[-1]["id"])
+                _listing_cache[state] = (time.monotonic(), [it["id"] for it in items])
             except Exception as e:
                 error = str(e)
-        return render_template("emails_list.html", items=items, state=state, limit=limit, error=error)
+        return render_template(
+            "emails_list.html",
+            items=items,
+            state=state,
+            limit=limit,
+            after=after,
+            next_cursor=next_cursor,
+            error=error,
+        )
 
     @app.get("/emails/<doc_id>")
     @require_auth
@@ -299,6 +454,7 @@ def create_app():
         doc = None
         error = None
         state = (request.args.get("state") or "").upper()
+        as_json = (request.args.get("format") or "").lower() == "json"
         next_id = None
         prev_id = None
         if firestore is None:
@@ -320,21 +476,20 @@ def create_app():
                         "smtpAgent": d.get("smtpAgent", {}) or {},
                         "createdAt": d.get("createdAt"),
                     }
-                    # Determine neighbors within current filter
+                    # Determine neighbors within current filter: from the cached listing
+                    # when possible, otherwise with one limit(1) query per direction
                     try:
                         col = db.collection(config.MAIL_COLLECTION)
-                        q = col
-                        if state in ("SENT", "ERROR"):
-                            q = q.where("smtpAgent.state", "==", state)
-                        q = q.order_by("smtpAgent.lastUpdatedAt", direction=firestore.Query.DESCENDING).limit(200)
-                        ordered = list(q.stream())
-                        ids = [s.id for s in ordered]
-                        if doc_id in ids:
-                            idx = ids.index(doc_id)
-                            if idx > 0:
-                                next_id = ids[idx - 1]  # next newer (since desc)
-                            if idx < len(ids) - 1:
-                                prev_id = ids[idx + 1]  # previous older
+                        next_id, prev_id = _cached_neighbors(state, doc_id)
+                        updated_at = doc["smtpAgent"].get("lastUpdatedAt")
+                        # The JSON modal has no prev/next links
+                        if not as_json and isinstance(updated_at, datetime):
+                            if next_id is None:
+                                # next newer (list is newest first)
+                                next_id = _neighbor(col, state, doc_id, updated_at, firestore.Query.ASCENDING)
+                            if prev_id is None:
+                                # previous older
+                                prev_id = _neighbor(col, state, doc_id, updated_at, firestore.Query.DESCENDING)
                     except Exception:
                         # If ordering not supported, skip neighbors silently
                         pass
@@ -343,37 +498,81 @@ def create_app():
             except Exception as e:
                 error = str(e)
         # JSON response for modal usage
-        if (request.args.get("format") or "").lower() == "json":
+        if as_json:
             if error:
                 return jsonify({"error": error}), 404
             return jsonify(doc)
         return render_template("email_detail.html", doc=doc, error=error, state=state, next_id=next_id, prev_id=prev_id)
 
+    @app.get("/metrics")
+    @require_auth
+    def prometheus_metrics():
+        """Agent metrics in the Prometheus text exposition format."""
+        return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
     @app.get("/logs")
     @require_auth
     def get_logs():
+        """Last lines of the log file (?lines=, ?level=, ?q=); ?follow=1 keeps appending via /logs/stream."""
+        n = max(1, min(request.args.get("lines", type=int) or 500, 5000))
+        min_level, needle = _log_filter_args()
         try:
-            with open(config.LOG_FILE, 'r') as f:
-                lines = f.readlines()[-500:]
-            return "<pre>" + "".join(lines) + "</pre>"
+            lines = [line for line in tail_lines(config.LOG_FILE, n) if _log_line_matches(line, min_level, needle)]
         except Exception as e:
-            return f"<pre>Failed to read log file: {e}</pre>", 500
+            return f"<pre>Failed to read log file: {html.escape(str(e))}</pre>", 500
+        body = "<pre id=\"log\">" + html.escape("".join(lines)) + "</pre>"
+        if request.args.get("follow"):
+            query = request.query_string.decode("utf-8", errors="replace")
+            stream_url = json.dumps("/logs/stream?" + query).replace("</", "<\\/")
+            body += (
+                "<script>"
+                "const pre = document.getElementById('log');"
+                f"const es = new EventSource({stream_url});"
+                "es.onmessage = (e) => { pre.append(e.data + '\\n'); window.scrollTo(0, document.body.scrollHeight); };"
+                "</script>"
+            )
+        return body
+
+    @app.get("/logs/stream")
+    @require_auth
+    def stream_logs():
+        """Server-Sent Events: new log lines as they are written, filtered by ?level= and ?q=."""
+        min_level, needle = _log_filter_args()
+        path = config.LOG_FILE
+
+        def events():
+            for line in follow_file(path):
+                if line is None:
+                    # keep-alive comment; also lets the server notice a closed connection
+                    yield ": keep-alive\n\n"
+                elif _log_line_matches(line, min_level, needle):
+                    yield f"data: {line.rstrip()}\n\n"
+
+        if not path:
+            return jsonify({"error": "LOG_FILE not configured"}), 404
+        return Response(
+            stream_with_context(events()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
     # Admin Config
     def _read_admin_config(db):
         try:
-            snap = db.document("admin/smtpAgentConfig").get()
-            if snap.exists:
-                d = snap.to_dict() or {}
-            else:
-                d = {}
+            d = get_config_provider(db).get()
         except Exception:
             d = {}
         # Merge with defaults from code
         merged = {
             "pollInterval": d.get("pollInterval", config.POLL_INTERVAL),
+            "pollIntervalMin": d.get("pollIntervalMin", config.POLL_INTERVAL_MIN),
+            # pollInterval is the ceiling for configs saved before pollIntervalMax existed
+            "pollIntervalMax": d.get("pollIntervalMax", d.get("pollInterval", config.POLL_INTERVAL_MAX)),
             "processFromAfter": d.get("processFromAfter", config.PROCESS_FROM_AFTER),
             "maxRetryCount": d.get("maxRetryCount", config.MAX_RETRY_COUNT),
+            "maxConcurrentSends": d.get("maxConcurrentSends", config.MAX_CONCURRENT_SENDS),
+            "maxSendsPerSecond": d.get("maxSendsPerSecond", config.RATE_LIMIT_PER_SECOND),
+            "maxSendsPerConnectionPerSecond": d.get("maxSendsPerConnectionPerSecond", config.RATE_LIMIT_PER_CONNECTION),
             "logLevel": d.get("logLevel", config.LOG_LEVEL),
             "dashboardRefreshSec": d.get("dashboardRefreshSec"),
         }
@@ -395,27 +594,49 @@ def create_app():
             return render_template("admin_config.html", error="Firestore not available", cfg=None), 500
         db = firestore.client()
         # Basic validation and normalization
-        poll = request.form.get("pollInterval", type=int)
+        poll_min = request.form.get("pollIntervalMin", type=int)
+        poll_max = request.form.get("pollIntervalMax", type=int)
         mrc = request.form.get("maxRetryCount", type=int)
+        mcs = request.form.get("maxConcurrentSends", type=int)
+        msps = request.form.get("maxSendsPerSecond", type=float)
+        mspc = request.form.get("maxSendsPerConnectionPerSecond", type=float)
         pfa = (request.form.get("processFromAfter") or "").strip()
         lvl = (request.form.get("logLevel") or "").upper() or config.LOG_LEVEL
         drs = request.form.get("dashboardRefreshSec", type=int)
-        if poll is None or poll <= 0:
-            poll = config.POLL_INTERVAL
+        if poll_max is None or poll_max <= 0:
+            poll_max = config.POLL_INTERVAL_MAX
+        if poll_min is None or poll_min <= 0:
+            poll_min = config.POLL_INTERVAL_MIN
+        poll_min = min(poll_min, poll_max)
         if mrc is None or mrc <= 0:
             mrc = config.MAX_RETRY_COUNT
+        if mcs is None or mcs <= 0:
+            mcs = config.MAX_CONCURRENT_SENDS
+        # 0 means unlimited
+        if msps is None or msps < 0:
+            msps = config.RATE_LIMIT_PER_SECOND
+        if mspc is None or mspc < 0:
+            mspc = config.RATE_LIMIT_PER_CONNECTION
         if drs is None or drs <= 0:
             drs = None
         # Store
         try:
             db.document("admin/smtpAgentConfig").set({
-                "pollInterval": poll,
+                # pollInterval mirrors the ceiling for readers that predate the adaptive bounds
+                "pollInterval": poll_max,
+                "pollIntervalMin": poll_min,
+                "pollIntervalMax": poll_max,
                 "processFromAfter": pfa,
                 "maxRetryCount": mrc,
+                "maxConcurrentSends": mcs,
+                "maxSendsPerSecond": msps,
+                "maxSendsPerConnectionPerSecond": mspc,
                 "logLevel": lvl,
                 "dashboardRefreshSec": drs,
                 "updatedAt": firestore.SERVER_TIMESTAMP,
             }, merge=True)
+            # Show the saved values right away rather than waiting for the snapshot
+            get_config_provider(db).invalidate()
         except Exception as e:
             cfg = _read_admin_config(db)
             return render_template("admin_config.html", cfg=cfg, error=str(e)), 500
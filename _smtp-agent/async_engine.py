@@ -0,0 +1,284 @@
+"""
+Asyncio delivery engine: one event loop instead of a thread per in-flight send
+"""
+import asyncio
+import logging
+from datetime import datetime
+
+from firebase_admin import firestore, firestore_async
+
+import config
+import metrics
+from async_smtp import AsyncSMTPSender
+from firestore_listener import FirestoreListener, POLL_CYCLES, POLL_CYCLE_SECONDS, GROUPED_DOCS, group_jobs
+from lease_manager import claim_update
+from utils import aiter_query_pages
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('async_engine')
+
+
+@firestore_async.async_transactional
+async def _claim_in_transaction(transaction, doc_ref, owner, fields, lease_until):
+    """Async counterpart of lease_manager._claim_in_transaction."""
+    payload = claim_update(await doc_ref.get(transaction=transaction), owner, fields, lease_until)
+    if payload is None:
+        return False
+    transaction.update(doc_ref, payload)
+    return True
+
+
+class AsyncDeliveryEngine(FirestoreListener):
+    """
+    FirestoreListener driven by asyncio (ENGINE=asyncio)
+
+    Candidate queries and lease claims go through the async Firestore client
+    and messages through AsyncSMTPSender, whose sessions pipeline MAIL/RCPT/
+    DATA. Up to ASYNC_MAX_IN_FLIGHT send tasks (a document, or a group of
+    same-content documents) run concurrently on a single thread. Filtering, result payloads, batched writes, retries,
+    leases and stats are inherited, so documents go through exactly the same
+    smtpAgent states as with the threaded engine. Only LISTEN_MODE=poll is
+    supported. Messages actually on the wire are capped by SMTP_POOL_SIZE
+    sessions; the remaining tasks wait for a session or on Firestore.
+    """
+    LISTEN_MODES = ('poll',)
+
+    def __init__(self):
+        super().__init__()
+        self.async_db = firestore_async.client()
+        self.async_collection = self.async_db.collection(config.MAIL_COLLECTION)
+        self.max_in_flight = max(1, config.ASYNC_MAX_IN_FLIGHT)
+        self._loop = None
+        self._slots = None
+        self._async_wake = None
+        self._tasks = set()
+
+    def _create_sender(self):
+        return AsyncSMTPSender()
+
+    def _register_gauges(self):
+        super()._register_gauges()
+        # Concurrency is bounded by the in-flight semaphore rather than a worker pool
+        metrics.gauge('smtp_agent_max_concurrent_sends', 'Configured worker pool size') \
+            .set_function(lambda: self.max_in_flight)
+
+    def start_listening(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        """Poll for work every poll_interval seconds until cancelled."""
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._async_wake = asyncio.Event()
+        logger.info(f"Starting to monitor '{config.MAIL_COLLECTION}' collection (engine=asyncio, max in flight={self.max_in_flight}, SMTP sessions={config.SMTP_POOL_SIZE})")
+        self.stats.start()
+        self.config_provider.subscribe(self._on_config_change)
+        if self.retry_scheduler is not None:
+            await asyncio.to_thread(self.retry_scheduler.rebuild)
+            self.retry_scheduler.start()
+        if self.lease_reaper is not None:
+            self.lease_reaper.start()
+        self.send_scheduler.start()
+
+        while not self.shutdown.requested.is_set():
+            try:
+                # A cache miss reads Firestore with the blocking client
+                await asyncio.to_thread(self._load_overrides)
+                await self._check_pending_emails_async()
+                await self.smtp_sender.pool.close_idle()
+                self._adapt_poll_interval()
+            except Exception as e:
+                logger.error(f"Error in listener loop: {str(e)}")
+            await self._sleep_async(self.poll_interval)
+        await self.shutdown.drain_async()
+
+    async def _sleep_async(self, seconds):
+        try:
+            await asyncio.wait_for(self._async_wake.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        self._async_wake.clear()
+
+    def _on_config_change(self, data):
+        super()._on_config_change(data)
+        # Called on the config listener's thread
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._async_wake.set)
+
+    def stop_claiming(self):
+        # Called from the signal handler, which runs on the event loop's thread
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._async_wake.set)
+
+    def pending_tasks(self):
+        return set(self._tasks)
+
+    def close_workers(self):
+        # No worker pool; SMTP sessions are closed on the event loop by drain_async
+        pass
+
+    async def _check_pending_emails_async(self):
+        with POLL_CYCLE_SECONDS.time():
+            await self._run_poll_queries_async()
+        POLL_CYCLES.inc()
+        self.last_check_time = datetime.now()
+        logger.debug(f"SMTP pool stats: {self.smtp_sender.pool_stats()}")
+
+    async def _run_poll_queries_async(self):
+        await self._process_query_results_async(
+            self._build_candidate_query(self.async_collection),
+            self._build_fallback_query(self.async_collection)
+        )
+        if self.retry_scheduler is None:
+            await self._process_query_results_async(
+                self._build_due_retry_query(self.async_collection),
+                self.async_collection.where('smtpAgent.state', '==', 'ERROR')
+            )
+
+    async def _process_query_results_async(self, query, fallback_query=None):
+        """Process query results page by page, falling back to a broader query (e.g. missing index)."""
+        try:
+            async for page in aiter_query_pages(query, self.page_size):
+                if self.shutdown.requested.is_set():
+                    break
+                await self._process_page_async(page)
+        except Exception as e:
+            if fallback_query is None:
+                logger.error(f"Query failed: {e}")
+                return
+            logger.warning(f"Primary query failed (possibly missing composite index): {e}")
+            try:
+                logger.info("Falling back to broader query; filtering in code")
+                async for page in aiter_query_pages(fallback_query, self.page_size):
+                    if self.shutdown.requested.is_set():
+                        break
+                    await self._process_page_async(page)
+            except Exception as e2:
+                logger.error(f"Fallback query also failed: {e2}")
+
+    async def _process_page_async(self, docs):
+        """Send one page of documents concurrently and wait for it to finish."""
+        pending = set(await self._submit_docs_async([(doc.id, doc.to_dict()) for doc in docs]))
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=self._peek_wait())
+            if pending and self._peek_due():
+                await self._peek_urgent_async()
+        # Results are durable before the next page (and the next cycle) is read
+        await asyncio.to_thread(self.writer.flush)
+
+    async def _peek_urgent_async(self):
+        """Coroutine version of FirestoreListener._peek_urgent."""
+        query = self._build_urgent_query(self.async_collection)
+        if query is None:
+            return
+        try:
+            docs = [doc async for doc in query.stream()]
+            await self._submit_docs_async([(doc.id, doc.to_dict()) for doc in docs])
+        except Exception as e:
+            logger.warning(f"Urgent mail query failed: {e}")
+
+    async def _submit_docs_async(self, docs):
+        """
+        Prepare (doc_id, doc_data) pairs into the priority lanes and start one task per send group
+
+        Returns:
+            list: The started tasks
+        """
+        # Writes go through the shared WriteBatcher, which takes references of the blocking client
+        jobs = self._prepare_batch((doc_id, doc_data, self.mail_collection.document(doc_id)) for doc_id, doc_data in docs)
+        if self.idempotency.enabled and jobs:
+            delivered = await self.idempotency.lookup_async(self.async_db, [job['message_hash'] for job in jobs])
+            jobs = self._drop_duplicates(jobs, delivered)
+        tasks = []
+        for group in group_jobs(jobs, self.send_grouping, config.SEND_GROUP_MAX):
+            self.lanes.push(group[0]['priority'], group)
+            task = asyncio.ensure_future(self._run_next_async())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            tasks.append(task)
+        return tasks
+
+    def _dispatch_due(self, docs):
+        """Retry/send scheduler callback (scheduler thread): hand due documents to the event loop."""
+        if self._loop is None:
+            return
+        batch = [(doc.id, doc.to_dict()) for doc in docs]
+        future = asyncio.run_coroutine_threadsafe(self._submit_docs_async(batch), self._loop)
+        future.add_done_callback(lambda f, n=len(batch): self._log_dispatch_failure(f, n))
+
+    @staticmethod
+    def _log_dispatch_failure(future, count):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Failed to dispatch {count} due documents: {future.exception()}")
+
+    async def _run_next_async(self):
+        """Send task: once a slot is free, send the group the priority lanes pick."""
+        async with self._slots:
+            jobs = self.lanes.pop()
+            if jobs is None:
+                return
+            try:
+                await self._send_jobs_async(jobs)
+            except Exception as e:
+                logger.error(f"Send task failed for {', '.join(job['doc_id'] for job in jobs)}: {e}")
+            finally:
+                self._finish_jobs(jobs)
+
+    async def _send_jobs_async(self, jobs):
+        """Coroutine version of FirestoreListener._send_jobs."""
+        if self.shutdown.requested.is_set():
+            return
+        claims = await asyncio.gather(*(
+            self._claim_processing_async(job['doc_ref'], firestore.SERVER_TIMESTAMP) for job in jobs
+        ))
+        claimed = [job for job, ok in zip(jobs, claims) if ok]
+        if not claimed:
+            return
+        if self.shutdown.requested.is_set():
+            self._relinquish(claimed)
+            return
+        try:
+            first = claimed[0]
+            if len(claimed) == 1:
+                results = [await self.smtp_sender.send_email(first['to_primary'], first['subject'], first['html'], first['content_hash'])]
+            else:
+                GROUPED_DOCS.inc(len(claimed))
+                results = await self.smtp_sender.send_group(
+                    [job['to_resolved'] for job in claimed], first['subject'], first['html'],
+                    bcc=self.send_grouping == 'bcc', content_key=first['content_hash']
+                )
+            for job, result in zip(claimed, results):
+                self._update_agent_result(
+                    job['doc_ref'],
+                    result=result,
+                    to_resolved=job['to_resolved'],
+                    message_hash=job['message_hash'],
+                    attempts=job['attempts']
+                )
+        except Exception as e:
+            for job in claimed:
+                logger.error(f"Error processing document {job['doc_id']}: {str(e)}")
+                self._update_agent_error(job['doc_ref'], 'EXCEPTION', str(e), attempts=job['attempts'])
+        finally:
+            for job in claimed:
+                self.leases.release(job['doc_id'])
+
+    async def _claim_processing_async(self, doc_ref, start_ts):
+        """Claim through an async transaction; the lease is then tracked and renewed like any other."""
+        try:
+            ok = await _claim_in_transaction(
+                self.async_db.transaction(),
+                self.async_collection.document(doc_ref.id),
+                self.owner,
+                self._claim_fields(start_ts),
+                self.leases.lease_until()
+            )
+        except Exception as e:
+            logger.warning(f"Claim of {doc_ref.id} failed: {e}")
+            ok = False
+        return self.leases.record_claim(doc_ref, ok)
@@ -0,0 +1,442 @@
+"""
+Asyncio SMTP client and connection pool used by the asyncio delivery engine
+"""
+import asyncio
+import base64
+import logging
+import re
+import smtplib
+import socket
+import ssl
+import time
+
+import config
+from smtp_sender import (
+    SMTPSender, _PooledConnection, _RECONNECT_ERRORS, _smtp_code,
+    _PHASE_CONNECT, _PHASE_TLS, _PHASE_AUTH, _PHASE_DATA,
+)
+from rate_limiter import THROTTLE_CODES
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('async_smtp')
+
+_EOL_RE = re.compile(rb'\r\n|\n|\r(?!\n)')
+_DOT_RE = re.compile(rb'(?m)^\.')
+
+
+def _dot_stuff(payload):
+    """CRLF line endings, leading dots doubled and the terminating <CRLF>.<CRLF> appended."""
+    data = _DOT_RE.sub(b'..', _EOL_RE.sub(b'\r\n', payload))
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+async def _wait_for_token(try_acquire):
+    """Await a rate limiter/token bucket without blocking the event loop."""
+    while True:
+        wait = try_acquire()
+        if wait <= 0:
+            return
+        await asyncio.sleep(wait)
+
+
+class AsyncSMTP:
+    """
+    Minimal asyncio SMTP client
+
+    Covers what the agent needs: EHLO/HELO, STARTTLS, AUTH PLAIN/LOGIN and
+    sendmail. When the server advertises PIPELINING (RFC 2920) the MAIL FROM,
+    RCPT TO and DATA commands of a message go out in one write and their
+    replies are read back in order, saving two round trips per message.
+    Failures raise the smtplib exception types so callers can treat both
+    clients alike.
+    """
+    def __init__(self, host, port, timeout=30, local_hostname=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.local_hostname = local_hostname or socket.getfqdn()
+        self.esmtp_features = {}
+        self._reader = None
+        self._writer = None
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        code, msg = await self._read_reply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, msg)
+        await self.ehlo()
+
+    async def ehlo(self):
+        code, msg = await self.command(f'EHLO {self.local_hostname}')
+        if code != 250:
+            code, msg = await self.command(f'HELO {self.local_hostname}')
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, msg)
+            self.esmtp_features = {}
+            return
+        features = {}
+        for line in msg.decode('utf-8', errors='replace').split('\n')[1:]:
+            parts = line.strip().split(None, 1)
+            if parts:
+                features[parts[0].lower()] = parts[1] if len(parts) > 1 else ''
+        self.esmtp_features = features
+
+    def has_extn(self, name):
+        return name.lower() in self.esmtp_features
+
+    async def starttls(self, context=None):
+        if not self.has_extn('starttls'):
+            raise smtplib.SMTPNotSupportedError('STARTTLS extension not supported by server.')
+        code, msg = await self.command('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, msg)
+        context = context or ssl.create_default_context()
+        if hasattr(self._writer, 'start_tls'):
+            await self._writer.start_tls(context, server_hostname=self.host)
+        else:
+            # Python < 3.11: upgrade the transport and rebuild the writer around it
+            loop = asyncio.get_running_loop()
+            transport = self._writer.transport
+            protocol = transport.get_protocol()
+            tls = await loop.start_tls(transport, protocol, context, server_hostname=self.host)
+            self._writer = asyncio.StreamWriter(tls, protocol, self._reader, loop)
+        # Capabilities may differ once the session is encrypted
+        await self.ehlo()
+
+    async def login(self, username, password):
+        mechanisms = self.esmtp_features.get('auth', '').upper().split()
+        if 'PLAIN' in mechanisms or not mechanisms:
+            token = base64.b64encode(f'\0{username}\0{password}'.encode('utf-8')).decode('ascii')
+            code, msg = await self.command(f'AUTH PLAIN {token}')
+        else:
+            code, msg = await self.command('AUTH LOGIN')
+            if code == 334:
+                code, msg = await self.command(base64.b64encode(username.encode('utf-8')).decode('ascii'))
+            if code == 334:
+                code, msg = await self.command(base64.b64encode(password.encode('utf-8')).decode('ascii'))
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, msg)
+
+    async def sendmail(self, from_addr, to_addrs, payload):
+        """
+        Send payload (str or bytes) to to_addrs
+
+        Returns:
+            dict: Refused recipients ({address: (code, message)}) when some were accepted
+
+        Raises:
+            smtplib.SMTPSenderRefused, SMTPRecipientsRefused or SMTPDataError
+        """
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        commands = [f'MAIL FROM:<{from_addr}>'] + [f'RCPT TO:<{addr}>' for addr in to_addrs] + ['DATA']
+        if self.has_extn('pipelining'):
+            self._write(''.join(f'{c}\r\n' for c in commands).encode('utf-8'))
+            await self._drain()
+            replies = [await self._read_reply() for _ in commands]
+        else:
+            replies = [await self.command(commands[0])]
+            if replies[0][0] == 250:
+                for c in commands[1:-1]:
+                    replies.append(await self.command(c))
+                if any(code in (250, 251) for code, _ in replies[1:]):
+                    replies.append(await self.command('DATA'))
+        mail_reply = replies[0]
+        if mail_reply[0] != 250:
+            await self._abort(replies)
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+        refused = {}
+        for addr, reply in zip(to_addrs, replies[1:1 + len(to_addrs)]):
+            if reply[0] not in (250, 251):
+                refused[addr] = reply
+        if len(refused) == len(to_addrs):
+            await self._abort(replies)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        data_reply = replies[-1]
+        if data_reply[0] != 354:
+            await self._abort(replies)
+            raise smtplib.SMTPDataError(data_reply[0], data_reply[1])
+        self._write(_dot_stuff(payload))
+        await self._drain()
+        code, msg = await self._read_reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, msg)
+        return refused
+
+    async def noop(self):
+        return await self.command('NOOP')
+
+    async def quit(self):
+        try:
+            return await self.command('QUIT')
+        finally:
+            self.close()
+
+    def close(self):
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+
+    def is_closing(self):
+        return self._writer is None or self._writer.is_closing()
+
+    async def command(self, line):
+        self._write(f'{line}\r\n'.encode('utf-8'))
+        await self._drain()
+        return await self._read_reply()
+
+    async def _abort(self, replies):
+        # A pipelined DATA that was accepted must still be terminated before RSET
+        if replies and replies[-1][0] == 354:
+            self._write(b'.\r\n')
+            await self._drain()
+            await self._read_reply()
+        await self.command('RSET')
+
+    def _write(self, data):
+        if self._writer is None:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        self._writer.write(data)
+
+    async def _drain(self):
+        await asyncio.wait_for(self._writer.drain(), self.timeout)
+
+    async def _read_reply(self):
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self._reader.readline(), self.timeout)
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip())
+            try:
+                code = int(line[:3])
+            except ValueError:
+                code = -1
+                break
+            # "250-..." continues a multi-line reply, "250 ..." ends it
+            if line[3:4] != b'-':
+                break
+        return code, b'\n'.join(lines)
+
+
+class AsyncSMTPConnectionPool:
+    """
+    Bounded pool of authenticated AsyncSMTP sessions
+
+    Mirrors SMTPConnectionPool. Idle sessions are reused without a NOOP
+    probe: a session the server has dropped fails on the next send, which
+    AsyncSMTPSender retries once on a fresh session.
+    """
+    def __init__(self, connect, max_size, max_messages, idle_timeout, bucket_factory=None):
+        self._connect = connect
+        self._bucket_factory = bucket_factory
+        self.max_size = max(1, max_size)
+        self.max_messages = max(1, max_messages)
+        self.idle_timeout = idle_timeout
+        self._idle = []  # LIFO so the warmest session is reused first
+        self._slots = None  # created on first use, inside the running loop
+        self._in_use = 0
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    async def acquire(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_size)
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                conn = self._idle.pop()
+                if self._expired(conn) or conn.server.is_closing():
+                    await self._close(conn)
+                    continue
+                self.hits += 1
+                self._in_use += 1
+                return conn
+            bucket = self._bucket_factory() if self._bucket_factory else None
+            conn = _PooledConnection(await self._connect(), bucket)
+            self.misses += 1
+            self._in_use += 1
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, conn, reusable=True):
+        try:
+            self._in_use -= 1
+            if reusable and conn.messages_sent < self.max_messages:
+                conn.last_used_at = time.monotonic()
+                self._idle.append(conn)
+            else:
+                await self._close(conn)
+        finally:
+            self._slots.release()
+
+    async def close_idle(self):
+        """Close sessions that have been idle longer than idle_timeout."""
+        expired = [c for c in self._idle if self._expired(c)]
+        self._idle = [c for c in self._idle if c not in expired]
+        for conn in expired:
+            logger.debug("Closing idle SMTP session")
+            await self._close(conn)
+
+    async def close_all(self):
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            await self._close(conn)
+
+    def stats(self):
+        return {
+            'size': self.max_size,
+            'idle': len(self._idle),
+            'inUse': self._in_use,
+            'hits': self.hits,
+            'misses': self.misses,
+            'discarded': self.discarded,
+        }
+
+    def _expired(self, conn):
+        return self.idle_timeout > 0 and (time.monotonic() - conn.last_used_at) > self.idle_timeout
+
+    async def _close(self, conn):
+        self.discarded += 1
+        try:
+            await asyncio.wait_for(conn.server.quit(), 5)
+        except Exception:
+            conn.server.close()
+
+
+class AsyncSMTPSender(SMTPSender):
+    """
+    SMTPSender for the asyncio engine
+
+    Same settings, message rendering, result format and adaptive rate
+    limiter; sessions come from an AsyncSMTPConnectionPool and sends are
+    coroutines.
+    """
+    def __init__(self):
+        super().__init__()
+        self.pool = AsyncSMTPConnectionPool(
+            self._open_connection,
+            max_size=config.SMTP_POOL_SIZE,
+            max_messages=config.SMTP_MAX_MESSAGES_PER_CONNECTION,
+            idle_timeout=config.SMTP_IDLE_TIMEOUT,
+            bucket_factory=self.rate_limiter.connection_bucket,
+        )
+
+    async def _open_connection(self):
+        """Open, secure and authenticate a new SMTP session"""
+        logger.info(f"Connecting to SMTP server {self.smtp_server}:{self.smtp_port}")
+        server = AsyncSMTP(self.smtp_server, self.smtp_port, timeout=self.timeout)
+        with _PHASE_CONNECT.time():
+            await server.connect()
+        try:
+            if self.use_tls:
+                with _PHASE_TLS.time():
+                    await server.starttls()
+            if self.username and self.password:
+                logger.debug(f"Logging in as {self.username}")
+                with _PHASE_AUTH.time():
+                    await server.login(self.username, self.password)
+        except BaseException:
+            server.close()
+            raise
+        return server
+
+    async def close(self):
+        await self.pool.close_all()
+
+    async def send_email(self, to_email, subject, html_content, content_key=None):
+        """Coroutine version of SMTPSender.send_email; returns the same result dict."""
+        try:
+            payload = self._render_message(to_email, subject, html_content, content_key)
+        except Exception as e:
+            return self._failed_result(e)
+        outcome = (await self._deliver_all([(to_email, payload)]))[0]
+        return self._outcome_result(outcome, to_email)
+
+    async def send_group(self, recipients, subject, html_content, bcc=False, content_key=None):
+        """Coroutine version of SMTPSender.send_group."""
+        try:
+            chunks, messages = self._group_messages(recipients, subject, html_content, bcc, content_key)
+        except Exception as e:
+            return [self._failed_result(e) for _ in recipients]
+        return self._group_results(recipients, chunks, await self._deliver_all(messages))
+
+    async def _deliver_all(self, messages):
+        """Coroutine version of SMTPSender._deliver_all."""
+        outcomes = []
+        conn = None
+        try:
+            for to_addrs, payload in messages:
+                for attempt in (1, 2):
+                    await _wait_for_token(self.rate_limiter.try_acquire)
+                    if conn is None:
+                        try:
+                            conn = await self.pool.acquire()
+                        except Exception as e:
+                            # No session to be had; the rest of the batch would fail the same way
+                            outcomes.extend([e] * (len(messages) - len(outcomes)))
+                            return outcomes
+                    reused = conn.messages_sent > 0
+                    try:
+                        if conn.bucket is not None:
+                            await _wait_for_token(conn.bucket.try_acquire)
+                        logger.info(f"Sending email to {to_addrs}")
+                        with _PHASE_DATA.time():
+                            outcome = await conn.server.sendmail(self.from_email, to_addrs, payload)
+                        conn.messages_sent += 1
+                        self.rate_limiter.on_success()
+                    except smtplib.SMTPResponseException as e:
+                        if e.smtp_code in THROTTLE_CODES:
+                            self.rate_limiter.on_throttle(e.smtp_code)
+                        outcome = e
+                        # 421: service closing the channel; other codes leave the session usable
+                        if e.smtp_code == 421:
+                            await self.pool.release(conn, reusable=False)
+                            conn = None
+                            if reused and attempt == 1:
+                                logger.info("SMTP session closed by server (421), reconnecting")
+                                continue
+                    except _RECONNECT_ERRORS as e:
+                        await self.pool.release(conn, reusable=False)
+                        conn = None
+                        outcome = e
+                        if reused and attempt == 1:
+                            logger.info(f"SMTP session lost ({e.__class__.__name__}), reconnecting")
+                            continue
+                    except Exception as e:
+                        await self.pool.release(conn, reusable=False)
+                        conn = None
+                        if _smtp_code(e) in THROTTLE_CODES:
+                            self.rate_limiter.on_throttle(_smtp_code(e))
+                        outcome = e
+                    break
+                outcomes.append(outcome)
+                if conn is not None and conn.messages_sent >= self.pool.max_messages:
+                    await self.pool.release(conn)
+                    conn = None
+        except BaseException:
+            # Cancelled mid-transaction: the session is in an unknown state
+            if conn is not None:
+                conn, dropped = None, conn
+                dropped.server.close()
+                await self.pool.release(dropped, reusable=False)
+            raise
+        finally:
+            if conn is not None:
+                await self.pool.release(conn)
+        return outcomes
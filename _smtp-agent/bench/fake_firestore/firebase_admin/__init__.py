@@ -0,0 +1,28 @@
+"""
+In-memory stand-in for the firebase_admin package, used by the benchmark harness
+
+Only the surface the agent touches is implemented. It is put on sys.path by
+bench/run_bench.py when running with --firestore fake; the agent itself
+always imports the real package.
+"""
+_apps = {}
+
+
+class App:
+    def __init__(self, name, credential, options):
+        self.name = name
+        self.credential = credential
+        self.options = options or {}
+
+
+def get_app(name='[DEFAULT]'):
+    if name not in _apps:
+        raise ValueError(f'The Firebase app "{name}" does not exist.')
+    return _apps[name]
+
+
+def initialize_app(credential=None, options=None, name='[DEFAULT]'):
+    if name in _apps:
+        raise ValueError(f'The Firebase app "{name}" already exists.')
+    _apps[name] = App(name, credential, options)
+    return _apps[name]
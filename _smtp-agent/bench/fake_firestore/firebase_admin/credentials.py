@@ -0,0 +1,13 @@
+"""
+Credential stand-ins for the in-memory firebase_admin package
+"""
+
+
+class Base:
+    def get_credential(self):
+        return None
+
+
+class Certificate(Base):
+    def __init__(self, path):
+        self.path = path
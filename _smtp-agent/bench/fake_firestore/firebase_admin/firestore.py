@@ -0,0 +1,524 @@
+"""
+In-memory Firestore client covering the calls the agent makes
+
+Documents live in one dict guarded by a lock. Every read, write, commit and
+transaction is counted in Client.ops so the benchmark can report Firestore
+operations per message. Query semantics follow Firestore where the agent
+depends on them: dotted field paths, implicit ordering by the first
+inequality field and then document id, cursors, projections, merges and
+field transforms.
+"""
+import copy
+import threading
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+class _Sentinel:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+SERVER_TIMESTAMP = _Sentinel('SERVER_TIMESTAMP')
+DELETE_FIELD = _Sentinel('DELETE_FIELD')
+
+
+class Increment:
+    def __init__(self, value):
+        self.value = value
+
+
+class Query:
+    ASCENDING = 'ASCENDING'
+    DESCENDING = 'DESCENDING'
+
+
+class FieldPath:
+    @staticmethod
+    def document_id():
+        return '__name__'
+
+
+_MISSING = object()
+
+
+def _get_path(data, path):
+    for part in path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            return _MISSING
+        data = data[part]
+    return data
+
+
+def _resolve(value, now):
+    if value is SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, Increment):
+        return value.value
+    if isinstance(value, dict):
+        return {k: _resolve(v, now) for k, v in value.items() if v is not DELETE_FIELD}
+    return copy.deepcopy(value)
+
+
+def _apply_value(target, key, value, now):
+    if value is DELETE_FIELD:
+        target.pop(key, None)
+    elif isinstance(value, Increment):
+        current = target.get(key)
+        target[key] = (current if isinstance(current, (int, float)) else 0) + value.value
+    else:
+        target[key] = _resolve(value, now)
+
+
+def _merge(target, data, now):
+    """set(..., merge=True): nested maps are merged, not replaced."""
+    for key, value in data.items():
+        if isinstance(value, dict):
+            sub = target.get(key)
+            if not isinstance(sub, dict):
+                sub = {}
+                target[key] = sub
+            _merge(sub, value, now)
+        else:
+            _apply_value(target, key, value, now)
+
+
+def _update(target, data, now):
+    """update(): keys are field paths; the value at each path is replaced."""
+    for path, value in data.items():
+        parts = path.split('.')
+        node = target
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        _apply_value(node, parts[-1], value, now)
+
+
+_FILTERS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    'in': lambda a, b: a in b,
+    'not-in': lambda a, b: a not in b,
+    'array-contains': lambda a, b: isinstance(a, list) and b in a,
+}
+_INEQUALITIES = ('!=', '<', '<=', '>', '>=', 'not-in')
+
+
+def _matches(data, field, op, value):
+    actual = _get_path(data, field)
+    if actual is _MISSING or (actual is None and op not in ('==', 'in')):
+        return False
+    try:
+        return _FILTERS[op](actual, value)
+    except TypeError:
+        return False
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, read_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.read_time = read_time
+        self.update_time = read_time
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        value = _get_path(self._data or {}, field_path)
+        if value is _MISSING:
+            raise KeyError(field_path)
+        return value
+
+
+class DocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self.path.rsplit('/', 1)[0])
+
+    def collection(self, name):
+        return CollectionReference(self._client, f'{self.path}/{name}')
+
+    def get(self, field_paths=None, transaction=None):
+        return self._client._read(self)
+
+    def set(self, document_data, merge=False):
+        self._client._write([('set', self, document_data, merge)])
+
+    def update(self, field_updates):
+        self._client._write([('update', self, field_updates, None)])
+
+    def create(self, document_data):
+        self._client._write([('create', self, document_data, None)])
+
+    def delete(self):
+        self._client._write([('delete', self, None, None)])
+
+    def on_snapshot(self, callback):
+        def fire(watch):
+            snap = self._client._read(self)
+            if snap._data != watch.state:
+                watch.state = snap._data
+                callback([snap], [], snap.read_time)
+        return self._client._listen(fire)
+
+
+class BaseQuery:
+    def __init__(self, client, parent_path, filters=(), orders=(), limit=None,
+                 cursor=None, projection=None):
+        self._client = client
+        self._parent_path = parent_path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._cursor = cursor
+        self._projection = projection
+
+    def _copy(self, **changes):
+        fields = dict(
+            filters=self._filters,
+            orders=self._orders,
+            limit=self._limit,
+            cursor=self._cursor,
+            projection=self._projection,
+        )
+        fields.update(changes)
+        return BaseQuery(self._client, self._parent_path, **fields)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction=Query.ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(cursor=document_fields_or_snapshot)
+
+    def select(self, field_paths):
+        return self._copy(projection=tuple(field_paths))
+
+    def _effective_orders(self):
+        orders = list(self._orders)
+        if not orders:
+            for field, op, _ in self._filters:
+                if op in _INEQUALITIES:
+                    orders.append((field, Query.ASCENDING))
+                    break
+        if not any(field == '__name__' for field, _ in orders):
+            direction = orders[-1][1] if orders else Query.ASCENDING
+            orders.append(('__name__', direction))
+        return orders
+
+    @staticmethod
+    def _sort_value(path, data, field):
+        return path.rsplit('/', 1)[-1] if field == '__name__' else _get_path(data, field)
+
+    def _cursor_values(self, orders):
+        cursor = self._cursor
+        if isinstance(cursor, DocumentSnapshot):
+            data = cursor._data or {}
+            return [self._sort_value(cursor.reference.path, data, f) for f, _ in orders]
+        values = []
+        for field, _ in orders:
+            value = cursor.get(field, _MISSING)
+            if value is _MISSING:
+                value = _get_path(cursor, field)
+            if isinstance(value, DocumentReference):
+                value = value.id
+            values.append(value)
+        return values
+
+    def _after_cursor(self, key, cursor_key, orders):
+        for value, bound, (_, direction) in zip(key, cursor_key, orders):
+            if bound is _MISSING or value == bound:
+                continue
+            if direction == Query.DESCENDING:
+                return value < bound
+            return value > bound
+        return False
+
+    def _run(self, count_reads=True):
+        client = self._client
+        orders = self._effective_orders()
+        with client._lock:
+            rows = []
+            for path, data in client._docs.items():
+                if path.rsplit('/', 1)[0] != self._parent_path:
+                    continue
+                if not all(_matches(data, f, op, v) for f, op, v in self._filters):
+                    continue
+                key = [self._sort_value(path, data, f) for f, _ in orders]
+                if any(v is _MISSING for v in key):
+                    continue
+                rows.append((key, path, data))
+            for index in reversed(range(len(orders))):
+                rows.sort(key=lambda row: row[0][index], reverse=orders[index][1] == Query.DESCENDING)
+            if self._cursor is not None:
+                cursor_key = self._cursor_values(orders)
+                rows = [row for row in rows if self._after_cursor(row[0], cursor_key, orders)]
+            if self._limit is not None:
+                rows = rows[:self._limit]
+            if count_reads:
+                # Firestore bills at least one read per query
+                client.ops['reads'] += max(1, len(rows))
+            now = datetime.now(timezone.utc)
+            snaps = []
+            for _, path, data in rows:
+                data = copy.deepcopy(data)
+                if self._projection is not None:
+                    projected = {}
+                    for field in self._projection:
+                        value = _get_path(data, field)
+                        if value is not _MISSING:
+                            _update(projected, {field: value}, now)
+                    data = projected
+                snaps.append(DocumentSnapshot(DocumentReference(client, path), data, now))
+            return snaps
+
+    def get(self, transaction=None):
+        return self._run()
+
+    def stream(self, transaction=None):
+        return iter(self._run())
+
+    def on_snapshot(self, callback):
+        def fire(watch):
+            # Listeners are billed per changed document, not per re-evaluation
+            docs = self._run(count_reads=False)
+            current = {snap.id: snap for snap in docs}
+            previous = watch.state or {}
+            changes = []
+            for doc_id, snap in current.items():
+                if doc_id not in previous:
+                    changes.append(DocumentChange('ADDED', snap))
+                elif previous[doc_id]._data != snap._data:
+                    changes.append(DocumentChange('MODIFIED', snap))
+            for doc_id, snap in previous.items():
+                if doc_id not in current:
+                    changes.append(DocumentChange('REMOVED', snap))
+            watch.state = current
+            with self._client._lock:
+                self._client.ops['reads'] += max(1, len(changes)) if watch.first else len(changes)
+            if changes or watch.first:
+                callback(docs, changes, datetime.now(timezone.utc))
+        return self._client._listen(fire)
+
+
+class CollectionReference(BaseQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def document(self, document_id=None):
+        return DocumentReference(self._client, f'{self.path}/{document_id or uuid.uuid4().hex[:20]}')
+
+    def add(self, document_data):
+        ref = self.document()
+        ref.set(document_data)
+        return datetime.now(timezone.utc), ref
+
+
+class _ChangeType:
+    def __init__(self, name):
+        self.name = name
+
+
+class DocumentChange:
+    def __init__(self, change_type, document):
+        self.type = _ChangeType(change_type)
+        self.document = document
+
+
+class Watch:
+    """One listener; changes are coalesced and delivered from its own thread."""
+    def __init__(self, client, fire):
+        self._client = client
+        self._fire = fire
+        self._event = threading.Event()
+        self._closed = False
+        self.state = None
+        self.first = True
+        self._thread = threading.Thread(target=self._run, name='fake-firestore-watch', daemon=True)
+        self._event.set()
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            self._event.clear()
+            if self._closed:
+                return
+            try:
+                self._fire(self)
+            except Exception:
+                pass
+            self.first = False
+
+    def notify(self):
+        self._event.set()
+
+    def unsubscribe(self):
+        self._closed = True
+        self._event.set()
+        with self._client._lock:
+            if self in self._client._watches:
+                self._client._watches.remove(self)
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, merge))
+
+    def update(self, reference, field_updates):
+        self._writes.append(('update', reference, field_updates, None))
+
+    def create(self, reference, document_data):
+        self._writes.append(('create', reference, document_data, None))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None, None))
+
+    def commit(self):
+        self._client.ops['commits'] += 1
+        self._client._write(self._writes)
+        self._writes = []
+        return []
+
+
+class Transaction(WriteBatch):
+    pass
+
+
+def transactional(func):
+    """Run func(transaction, ...) atomically and commit its writes."""
+    def wrapper(transaction, *args, **kwargs):
+        client = transaction._client
+        with client._lock:
+            client.ops['transactions'] += 1
+            result = func(transaction, *args, **kwargs)
+            transaction.commit()
+            return result
+    return wrapper
+
+
+class Client:
+    def __init__(self):
+        self._docs = {}
+        self._lock = threading.RLock()
+        self._watches = []
+        self.ops = Counter()
+
+    def collection(self, collection_id):
+        return CollectionReference(self, collection_id)
+
+    def document(self, document_path):
+        return DocumentReference(self, document_path)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return Transaction(self)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        for ref in references:
+            yield self._read(ref)
+
+    def reset_ops(self):
+        with self._lock:
+            self.ops.clear()
+
+    @contextmanager
+    def uncounted(self):
+        """Reads and writes made inside the block are left out of ops (harness bookkeeping)."""
+        with self._lock:
+            saved = Counter(self.ops)
+            try:
+                yield self
+            finally:
+                self.ops = saved
+
+    def _read(self, ref):
+        with self._lock:
+            self.ops['reads'] += 1
+            data = self._docs.get(ref.path)
+            return DocumentSnapshot(ref, copy.deepcopy(data), datetime.now(timezone.utc))
+
+    def _write(self, writes):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            # Validate first so a failing write leaves the batch unapplied
+            for op, ref, _, _ in writes:
+                if op == 'update' and ref.path not in self._docs:
+                    raise KeyError(f'No document to update: {ref.path}')
+                if op == 'create' and ref.path in self._docs:
+                    raise KeyError(f'Document already exists: {ref.path}')
+            for op, ref, data, merge in writes:
+                self.ops['writes'] += 1
+                if op == 'delete':
+                    self._docs.pop(ref.path, None)
+                elif op == 'update':
+                    _update(self._docs[ref.path], data, now)
+                elif op == 'set' and merge:
+                    _merge(self._docs.setdefault(ref.path, {}), data, now)
+                else:
+                    self._docs[ref.path] = _resolve(data, now)
+            watches = list(self._watches)
+        for watch in watches:
+            watch.notify()
+
+    def _listen(self, fire):
+        with self._lock:
+            self.ops['listens'] += 1
+        watch = Watch(self, fire)
+        with self._lock:
+            self._watches.append(watch)
+        return watch
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def client(app=None):
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Client()
+        return _client
@@ -0,0 +1,108 @@
+"""
+Async facade over the in-memory Firestore client
+
+Shares documents and op counters with firebase_admin.firestore.client(), so
+the benchmark sees the asyncio engine's reads and writes the same way.
+"""
+from . import firestore as _sync
+
+
+class AsyncQuery:
+    def __init__(self, query):
+        self._query = query
+
+    def where(self, *args, **kwargs):
+        return AsyncQuery(self._query.where(*args, **kwargs))
+
+    def order_by(self, *args, **kwargs):
+        return AsyncQuery(self._query.order_by(*args, **kwargs))
+
+    def limit(self, count):
+        return AsyncQuery(self._query.limit(count))
+
+    def start_after(self, document_fields_or_snapshot):
+        return AsyncQuery(self._query.start_after(document_fields_or_snapshot))
+
+    def select(self, field_paths):
+        return AsyncQuery(self._query.select(field_paths))
+
+    async def get(self, transaction=None):
+        return self._query.get()
+
+    async def stream(self, transaction=None):
+        for snap in self._query.stream():
+            yield snap
+
+
+class AsyncDocumentReference:
+    def __init__(self, ref):
+        self._ref = ref
+        self.id = ref.id
+        self.path = ref.path
+
+    def collection(self, collection_id):
+        return AsyncCollectionReference(self._ref.collection(collection_id))
+
+    async def get(self, field_paths=None, transaction=None):
+        return self._ref.get()
+
+    async def set(self, document_data, merge=False):
+        self._ref.set(document_data, merge=merge)
+
+    async def update(self, field_updates):
+        self._ref.update(field_updates)
+
+
+class AsyncCollectionReference(AsyncQuery):
+    def __init__(self, collection):
+        super().__init__(collection)
+        self.id = collection.id
+
+    def document(self, document_id=None):
+        return AsyncDocumentReference(self._query.document(document_id))
+
+
+class AsyncTransaction(_sync.Transaction):
+    def _unwrap(self, reference):
+        return reference._ref if isinstance(reference, AsyncDocumentReference) else reference
+
+    def set(self, reference, document_data, merge=False):
+        super().set(self._unwrap(reference), document_data, merge)
+
+    def update(self, reference, field_updates):
+        super().update(self._unwrap(reference), field_updates)
+
+
+def async_transactional(func):
+    """Run the coroutine func(transaction, ...) atomically and commit its writes."""
+    async def wrapper(transaction, *args, **kwargs):
+        client = transaction._client
+        # The fake never really suspends, so holding the lock across awaits is safe
+        with client._lock:
+            client.ops['transactions'] += 1
+            result = await func(transaction, *args, **kwargs)
+            transaction.commit()
+            return result
+    return wrapper
+
+
+class AsyncClient:
+    def __init__(self, client):
+        self._client = client
+
+    def collection(self, collection_id):
+        return AsyncCollectionReference(self._client.collection(collection_id))
+
+    def document(self, document_path):
+        return AsyncDocumentReference(self._client.document(document_path))
+
+    def transaction(self, **kwargs):
+        return AsyncTransaction(self._client)
+
+    async def get_all(self, references, field_paths=None, transaction=None):
+        for ref in references:
+            yield self._client._read(ref._ref)
+
+
+def client(app=None):
+    return AsyncClient(_sync.client(app))
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput benchmark for the SMTP agent
+
+Seeds N mail documents, runs the delivery engine (FirestoreListener or, with
+--engine asyncio, AsyncDeliveryEngine) against them and a local SMTP sink, and reports msgs/sec, pickup-to-delivered latency percentiles,
+Firestore operations per message and peak RSS as JSON.
+
+Firestore backends:
+  fake      in-memory client from bench/fake_firestore (default; counts ops)
+  emulator  the Firestore emulator at FIRESTORE_EMULATOR_HOST (ops not counted)
+
+Examples:
+  python bench/run_bench.py --docs 500 --data-latency-ms 20 --out bench-results.json
+  python bench/run_bench.py --docs 500 --compare bench-results.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+AGENT_DIR = os.path.dirname(BENCH_DIR)
+
+# Lower is better for these when comparing runs
+LOWER_IS_BETTER = (
+    'p50', 'p99', 'createdToDeliveredP50', 'createdToDeliveredP99',
+    'opsPerMessage', 'peakRssMb', 'elapsedSeconds',
+)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--docs', type=int, default=200, help='mail documents to seed')
+    p.add_argument('--firestore', choices=('fake', 'emulator'), default='fake')
+    p.add_argument('--engine', choices=('thread', 'asyncio'), default='thread')
+    p.add_argument('--listen-mode', choices=('poll', 'snapshot', 'delta'), default='poll')
+    p.add_argument('--poll-interval', type=int, default=1, help='seconds')
+    p.add_argument('--concurrency', type=int, default=4, help='MAX_CONCURRENT_SENDS')
+    p.add_argument('--max-in-flight', type=int, default=200, help='ASYNC_MAX_IN_FLIGHT (--engine asyncio)')
+    p.add_argument('--pool-size', type=int, default=4, help='SMTP_POOL_SIZE')
+    p.add_argument('--rate', type=float, default=0, help='RATE_LIMIT_PER_SECOND (0 = unlimited)')
+    p.add_argument('--connect-latency-ms', type=int, default=0)
+    p.add_argument('--data-latency-ms', type=int, default=10)
+    p.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of messages answered 451')
+    p.add_argument('--reject-rate', type=float, default=0.0, help='fraction of messages answered 554')
+    p.add_argument('--max-retries', type=int, default=3)
+    p.add_argument('--shared-content', type=float, default=0.0,
+                   help='fraction of documents carrying one identical announcement')
+    p.add_argument('--duplicates', type=float, default=0.0,
+                   help='fraction of documents repeating the message and recipient of an earlier one')
+    p.add_argument('--grouping', choices=('off', 'connection', 'bcc'), default='connection', help='SEND_GROUPING')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--timeout', type=float, default=300, help='give up after this many seconds')
+    p.add_argument('--out', help='write the JSON result to this file')
+    p.add_argument('--compare', help='previous JSON result to compare against')
+    return p.parse_args(argv)
+
+
+def configure_environment(args, smtp_port):
+    """The agent reads its settings from the environment at import time."""
+    os.environ.update({
+        'SMTP_SERVER': '127.0.0.1',
+        'SMTP_PORT': str(smtp_port),
+        'SMTP_USE_TLS': 'False',
+        'SMTP_PASSWORD': '',
+        'SMTP_POOL_SIZE': str(args.pool_size),
+        'MAX_CONCURRENT_SENDS': str(args.concurrency),
+        'ENGINE': args.engine,
+        'ASYNC_MAX_IN_FLIGHT': str(args.max_in_flight),
+        'SEND_GROUPING': args.grouping,
+        'RATE_LIMIT_PER_SECOND': str(args.rate),
+        'RATE_LIMIT_PAUSE_SECONDS': '1',
+        'RETRY_BASE_SECONDS': '1',
+        'RETRY_MAX_SECONDS': '5',
+        'MAX_RETRY_COUNT': str(args.max_retries),
+        'POLL_INTERVAL': str(args.poll_interval),
+        'LISTEN_MODE': args.listen_mode,
+        'PROCESS_FROM_AFTER': '',
+        'STATS_FLUSH_INTERVAL': '5',
+        'LOG_FILE': '',
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+    })
+    if args.firestore == 'fake':
+        sys.path.insert(0, os.path.join(BENCH_DIR, 'fake_firestore'))
+    sys.path.insert(0, AGENT_DIR)
+
+
+def initialize_emulator():
+    """Initialize firebase_admin with anonymous credentials for the emulator."""
+    if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        sys.exit('--firestore emulator needs FIRESTORE_EMULATOR_HOST (e.g. localhost:8080)')
+    import firebase_admin
+    from firebase_admin import credentials
+    from google.auth.credentials import AnonymousCredentials
+
+    class EmulatorCredential(credentials.Base):
+        def get_credential(self):
+            return AnonymousCredentials()
+
+    project = os.environ.get('GCLOUD_PROJECT', 'smtp-agent-bench')
+    firebase_admin.initialize_app(EmulatorCredential(), {'projectId': project})
+
+
+def seed(db, collection, n, shared_content=0.0, duplicates=0.0):
+    now = datetime.now(timezone.utc)
+    shared = int(n * shared_content)
+    # The last documents repeat the first ones, like an upstream function writing a mail twice
+    originals = n - int(n * duplicates)
+    batch = db.batch()
+    for i in range(n):
+        ref = db.collection(collection).document(f'bench-{i:06d}')
+        j = i if i < originals else (i - originals) % max(1, originals)
+        if j < shared:
+            message = {
+                'subject': 'Benchmark announcement',
+                'html': '<p>Race update</p>' + '<p>Lorem ipsum dolor sit amet.</p>' * 20,
+            }
+        else:
+            message = {
+                'subject': f'Benchmark message {j}',
+                'html': f'<p>Hello user {j}</p>' + '<p>Lorem ipsum dolor sit amet.</p>' * 20,
+            }
+        batch.set(ref, {
+            'to': f'user{j}@bench{j % 10}.example',
+            'message': message,
+            'createdAt': now,
+            # Producers initialise the agent namespace so the candidate query can see the doc
+            'smtpAgent': {'state': 'PENDING', 'lastUpdatedAt': now},
+        })
+        if len(batch) >= 400:
+            batch.commit()
+            batch = db.batch()
+    if len(batch):
+        batch.commit()
+
+
+def collect(db, collection, max_retries):
+    """States and latencies of the seeded documents (not counted as agent operations)."""
+    if hasattr(db, 'uncounted'):
+        with db.uncounted():
+            return _collect(db, collection, max_retries)
+    return _collect(db, collection, max_retries)
+
+
+def _collect(db, collection, max_retries):
+    states = {}
+    pickup = []
+    created = []
+    finished = 0
+    for snap in db.collection(collection).stream():
+        data = snap.to_dict() or {}
+        sa = data.get('smtpAgent', {}) or {}
+        state = sa.get('state') or 'NEW'
+        states[state] = states.get(state, 0) + 1
+        done_at = sa.get('lastSuccessAt')
+        if state == 'SENT' and isinstance(done_at, datetime):
+            claimed_at = (sa.get('processing', {}) or {}).get('claimedAt')
+            if isinstance(claimed_at, datetime):
+                pickup.append((done_at - claimed_at).total_seconds())
+            if isinstance(data.get('createdAt'), datetime):
+                created.append((done_at - data['createdAt']).total_seconds())
+        if state in ('SENT', 'SKIPPED') or (state == 'ERROR' and (sa.get('attempts') or 0) >= max_retries):
+            finished += 1
+    return states, finished, pickup, created
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100.0 * (len(ordered) - 1)))))
+    return round(ordered[index], 4)
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0, 1)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=AGENT_DIR,
+            capture_output=True, text=True, timeout=10,
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(current, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)['results']
+    print(f"\nCompared with {previous_path}:")
+    for key, value in current.items():
+        old = previous.get(key)
+        numeric = all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in (value, old))
+        if not numeric or not old:
+            continue
+        change = (value - old) / old * 100.0
+        better = change < 0 if key in LOWER_IS_BETTER else change > 0
+        flag = '' if abs(change) < 5 else (' (better)' if better else ' (WORSE)')
+        print(f"  {key:>22}: {old} -> {value} ({change:+.1f}%){flag}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sys.path.insert(0, BENCH_DIR)
+    from smtp_sink import SMTPSink
+
+    sink = SMTPSink(
+        connect_latency_ms=args.connect_latency_ms,
+        data_latency_ms=args.data_latency_ms,
+        throttle_rate=args.throttle_rate,
+        reject_rate=args.reject_rate,
+        seed=args.seed,
+    ).start()
+    configure_environment(args, sink.port)
+    if args.firestore == 'emulator':
+        initialize_emulator()
+
+    import config
+    from firebase_admin import firestore
+    if args.engine == 'asyncio':
+        from async_engine import AsyncDeliveryEngine as Engine
+    else:
+        from firestore_listener import FirestoreListener as Engine
+
+    db = firestore.client()
+    seed(db, config.MAIL_COLLECTION, args.docs, args.shared_content, args.duplicates)
+    listener = Engine()
+    counts_ops = hasattr(db, 'reset_ops')
+    if counts_ops:
+        db.reset_ops()
+
+    started = time.monotonic()
+    threading.Thread(target=listener.start_listening, name='bench-listener', daemon=True).start()
+    finished = 0
+    while time.monotonic() - started < args.timeout:
+        time.sleep(0.25)
+        _, finished, _, _ = collect(db, config.MAIL_COLLECTION, args.max_retries)
+        if finished >= args.docs:
+            break
+    elapsed = time.monotonic() - started
+    listener.writer.flush()
+    ops = dict(db.ops) if counts_ops else None
+    states, finished, pickup, created = collect(db, config.MAIL_COLLECTION, args.max_retries)
+    sent = states.get('SENT', 0)
+
+    results = {
+        'completed': finished >= args.docs,
+        'elapsedSeconds': round(elapsed, 3),
+        'sent': sent,
+        'msgsPerSecond': round(sent / elapsed, 2) if elapsed > 0 else None,
+        'p50': percentile(pickup, 50),
+        'p99': percentile(pickup, 99),
+        'createdToDeliveredP50': percentile(created, 50),
+        'createdToDeliveredP99': percentile(created, 99),
+        'opsPerMessage': round((ops.get('reads', 0) + ops.get('writes', 0)) / sent, 2) if ops and sent else None,
+        'peakRssMb': peak_rss_mb(),
+    }
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'agentVersion': listener.version,
+        'gitRevision': git_revision(),
+        'python': platform.python_version(),
+        'params': vars(args),
+        'results': results,
+        'states': states,
+        'firestoreOps': ops,
+        'smtpSink': sink.stats.as_dict(),
+        'smtpPool': listener.smtp_sender.pool_stats(),
+    }
+    sink.stop()
+
+    text = json.dumps(report, indent=2, default=str)
+    print(text)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    if args.compare:
+        compare(results, args.compare)
+    return 0 if results['completed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Local SMTP sink for benchmarks
+
+A minimal threaded SMTP server that accepts and discards mail. Latency can be
+injected on connect and on DATA, and a fraction of messages can be answered
+with a throttling (451) or permanent (554) reply. Supports the commands
+smtplib needs without TLS or AUTH.
+"""
+import random
+import socketserver
+import threading
+import time
+
+
+class SinkStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.accepted = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.recipients = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'connections': self.connections,
+                'accepted': self.accepted,
+                'throttled': self.throttled,
+                'rejected': self.rejected,
+                'recipients': self.recipients,
+            }
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # Replies to pipelined commands are separate small writes; with Nagle on they
+    # would wait for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def _reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        server.stats.add(connections=1)
+        if server.connect_latency:
+            time.sleep(server.connect_latency)
+        self._reply('220 bench-sink ESMTP ready')
+        rcpts = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', errors='replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.wfile.write(b'250-bench-sink\r\n250-PIPELINING\r\n250-8BITMIME\r\n250 SIZE 52428800\r\n')
+                self.wfile.flush()
+            elif verb == 'HELO':
+                self._reply('250 bench-sink')
+            elif verb == 'MAIL':
+                rcpts = 0
+                self._reply('250 OK')
+            elif verb == 'RCPT':
+                rcpts += 1
+                self._reply('250 OK')
+            elif verb == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data in (b'.\r\n', b'.\n'):
+                        break
+                if server.data_latency:
+                    time.sleep(server.data_latency)
+                roll = server.random.random()
+                if roll < server.throttle_rate:
+                    server.stats.add(throttled=1)
+                    self._reply('451 4.7.1 Rate limited, try again later')
+                elif roll < server.throttle_rate + server.reject_rate:
+                    server.stats.add(rejected=1)
+                    self._reply('554 5.7.1 Message rejected')
+                else:
+                    server.stats.add(accepted=1, recipients=rcpts)
+                    self._reply('250 OK queued')
+                rcpts = 0
+            elif verb in ('RSET', 'NOOP'):
+                self._reply('250 OK')
+            elif verb == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # A pool opens all of its sessions at once; the default backlog of 5 drops some
+    request_queue_size = 128
+
+    def __init__(self, host='127.0.0.1', port=0, connect_latency_ms=0, data_latency_ms=0,
+                 throttle_rate=0.0, reject_rate=0.0, seed=None):
+        super().__init__((host, port), _Handler)
+        self.connect_latency = connect_latency_ms / 1000.0
+        self.data_latency = data_latency_ms / 1000.0
+        self.throttle_rate = throttle_rate
+        self.reject_rate = reject_rate
+        self.random = random.Random(seed)
+        self.stats = SinkStats()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='smtp-sink', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
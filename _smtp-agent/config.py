@@ -26,13 +26,90 @@ SMTP_USE_TLS = os.getenv('SMTP_USE_TLS', 'True').lower() == 'true'
 SMTP_FROM_EMAIL = os.getenv('SMTP_FROM_EMAIL', 'post@krultra.no')
 SMTP_FROM_NAME = os.getenv('SMTP_FROM_NAME', 'RunnersHub')
 
+# SMTP connection pool
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', 4))  # max concurrent sessions
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.getenv('SMTP_MAX_MESSAGES_PER_CONNECTION', 100))
+SMTP_IDLE_TIMEOUT = int(os.getenv('SMTP_IDLE_TIMEOUT', 60))  # seconds before an idle session is closed
+SMTP_TIMEOUT = int(os.getenv('SMTP_TIMEOUT', 30))  # socket timeout in seconds
+
+# Same-content grouping: 'connection' sends a group back to back over one session,
+# 'bcc' shares SMTP transactions between recipients (they see an undisclosed To), 'off'
+SEND_GROUPING = os.getenv('SEND_GROUPING', 'connection').strip().lower()
+SEND_GROUP_MAX = int(os.getenv('SEND_GROUP_MAX', 20))  # documents per group
+BCC_MAX_RECIPIENTS = int(os.getenv('BCC_MAX_RECIPIENTS', 50))  # RCPT TO per shared transaction
+MIME_CACHE_SIZE = int(os.getenv('MIME_CACHE_SIZE', 64))  # encoded message bodies kept for reuse across recipients
+
+# SMTP rate limiting (0 = unlimited); backs off on 421/451/452 and ramps back up
+RATE_LIMIT_PER_SECOND = float(os.getenv('RATE_LIMIT_PER_SECOND', 0))  # fixed cap, opt-in
+RATE_LIMIT_PER_CONNECTION = float(os.getenv('RATE_LIMIT_PER_CONNECTION', 0))  # per pooled session
+RATE_LIMIT_MIN_PER_SECOND = float(os.getenv('RATE_LIMIT_MIN_PER_SECOND', 0.2))
+RATE_LIMIT_RAMP_INTERVAL = int(os.getenv('RATE_LIMIT_RAMP_INTERVAL', 10))  # seconds between rate increases
+RATE_LIMIT_PAUSE_SECONDS = int(os.getenv('RATE_LIMIT_PAUSE_SECONDS', 5))  # cool-down after throttling
+RATE_LIMIT_MAX_PAUSE_SECONDS = int(os.getenv('RATE_LIMIT_MAX_PAUSE_SECONDS', 120))
+
 # Logging configuration
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 MAX_RETRY_COUNT = int(os.getenv("MAX_RETRY_COUNT", "5"))
 LOG_FILE = os.getenv('LOG_FILE', 'smtp_agent.log')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))  # rotate the log file at this size
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))  # rotated files kept
 
 # Application configuration
 POLL_INTERVAL = int(os.getenv('POLL_INTERVAL', 60))  # seconds
+# Adaptive polling: the interval drops to the min after a cycle that found work and doubles toward the max when idle
+POLL_INTERVAL_MIN = int(os.getenv('POLL_INTERVAL_MIN', 5))  # seconds
+POLL_INTERVAL_MAX = int(os.getenv('POLL_INTERVAL_MAX', POLL_INTERVAL))  # seconds
+MAX_CONCURRENT_SENDS = int(os.getenv('MAX_CONCURRENT_SENDS', 4))  # parallel send workers
+# Delivery engine: 'thread' (worker pool) or 'asyncio' (event loop, pipelined SMTP)
+ENGINE = os.getenv('ENGINE', 'thread').strip().lower()
+# Concurrent send tasks with ENGINE=asyncio; messages on the wire are still capped by SMTP_POOL_SIZE sessions
+ASYNC_MAX_IN_FLIGHT = int(os.getenv('ASYNC_MAX_IN_FLIGHT', 200))
+# Priority lanes (classes from the mail `type`, see priority.py): relative share of send slots under contention
+PRIORITY_WEIGHTS = os.getenv('PRIORITY_WEIGHTS', 'high:8,normal:3,bulk:1')
+PRIORITY_PEEK_INTERVAL = float(os.getenv('PRIORITY_PEEK_INTERVAL', 5))  # seconds; urgent-mail check while a page drains
+QUERY_PAGE_SIZE = int(os.getenv('QUERY_PAGE_SIZE', 200))  # documents read per query page
+CONFIG_CACHE_TTL = int(os.getenv('CONFIG_CACHE_TTL', 30))  # seconds; admin/smtpAgentConfig cache
+HEALTH_CACHE_TTL = int(os.getenv('HEALTH_CACHE_TTL', 15))  # seconds; Firestore check in /health
+SHUTDOWN_GRACE_SECONDS = int(os.getenv('SHUTDOWN_GRACE_SECONDS', 25))  # wait for in-flight sends on SIGTERM
+
+# Listener mode: 'poll' re-runs the mail query every POLL_INTERVAL, 'snapshot' streams changes,
+# 'delta' polls only documents created/updated since the last cycle. ENGINE=asyncio supports 'poll' only
+LISTEN_MODE = os.getenv('LISTEN_MODE', 'poll').strip().lower()
+DELTA_OVERLAP_SECONDS = int(os.getenv('DELTA_OVERLAP_SECONDS', 10))  # re-read window behind the high-water mark
+DELTA_RECONCILE_INTERVAL = int(os.getenv('DELTA_RECONCILE_INTERVAL', 900))  # seconds between full scans in delta mode
+SNAPSHOT_RESYNC_INTERVAL = int(os.getenv('SNAPSHOT_RESYNC_INTERVAL', 300))  # seconds between safety-net sweeps
+SNAPSHOT_MAX_BACKOFF = int(os.getenv('SNAPSHOT_MAX_BACKOFF', 60))  # max seconds between reconnect attempts
+
+# Retry scheduling: failed sends are retried after RETRY_BASE_SECONDS * 2^(attempts-1), capped
+RETRY_SCHEDULER = os.getenv('RETRY_SCHEDULER', 'True').lower() == 'true'
+RETRY_BASE_SECONDS = int(os.getenv('RETRY_BASE_SECONDS', 60))
+RETRY_MAX_SECONDS = int(os.getenv('RETRY_MAX_SECONDS', 3600))
+RETRY_JITTER = float(os.getenv('RETRY_JITTER', 0.2))  # +/- fraction of the delay
+RETRY_RESYNC_INTERVAL = int(os.getenv('RETRY_RESYNC_INTERVAL', 300))  # seconds between re-reads of ERROR docs
+
+# Multi-instance operation
+LEASE_SECONDS = int(os.getenv('LEASE_SECONDS', 120))  # PROCESSING lease, renewed while a send is running
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 1))  # number of agent instances partitioning the queue
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', 0))  # this instance's shard, 0..SHARD_COUNT-1
+SHARD_TAKEOVER_SECONDS = int(os.getenv('SHARD_TAKEOVER_SECONDS', 300))  # idle time before another shard's doc is taken
+LEASE_REAPER = os.getenv('LEASE_REAPER', 'True').lower() == 'true'  # requeue PROCESSING docs with expired leases
+LEASE_REAP_INTERVAL = int(os.getenv('LEASE_REAP_INTERVAL', 60))  # seconds between scans of PROCESSING docs
+
+# Scheduled sends: documents with a future sendAt are held as SCHEDULED and fired at that time
+SCHEDULE_HORIZON = int(os.getenv('SCHEDULE_HORIZON', 3600))  # seconds ahead kept in memory
+SCHEDULE_LOAD_INTERVAL = int(os.getenv('SCHEDULE_LOAD_INTERVAL', 60))  # seconds between loads of newly due SCHEDULED docs
+
+# Pre-aggregated delivery counters (admin/smtpAgentStats/shards)
+STATS_SHARDS = int(os.getenv('STATS_SHARDS', 4))
+STATS_FLUSH_INTERVAL = int(os.getenv('STATS_FLUSH_INTERVAL', 15))  # seconds
+
+# Duplicate suppression: identical (subject, html, recipients) messages delivered within the window are skipped
+IDEMPOTENCY_WINDOW = int(os.getenv('IDEMPOTENCY_WINDOW', 3600))  # seconds, 0 disables
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000))  # hashes kept in memory
+
+# Batched Firestore writes for smtpAgent state updates
+WRITE_BATCH_MAX_OPS = int(os.getenv('WRITE_BATCH_MAX_OPS', 500))  # Firestore caps a batch at 500
+WRITE_BATCH_WINDOW_MS = int(os.getenv('WRITE_BATCH_WINDOW_MS', 50))  # max time a write waits for company
 
 # Process cutoff configuration (ISO 8601, e.g., 2025-08-07T00:00:00Z or YYYY-MM-DD)
 PROCESS_FROM_AFTER = os.getenv('PROCESS_FROM_AFTER', '').strip()
@@ -0,0 +1,139 @@
+"""
+Cached access to the admin/smtpAgentConfig overrides document
+"""
+import logging
+import threading
+import time
+
+import config
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('config_provider')
+
+CONFIG_DOC = 'admin/smtpAgentConfig'
+
+
+class ConfigProvider:
+    """
+    TTL cache of the admin overrides document
+
+    A snapshot listener on the document replaces the cached copy as soon as
+    it changes and notifies subscribers, so overrides apply without waiting
+    for the next poll. While the listener is active and has delivered a
+    snapshot, get() serves the cached copy without reading. The TTL only
+    matters if the listener is down: then a stale copy is re-read at most
+    once every CONFIG_CACHE_TTL seconds.
+    """
+    def __init__(self, db, ttl=None):
+        self.db = db
+        self.ttl = config.CONFIG_CACHE_TTL if ttl is None else ttl
+        self._data = None
+        self._loaded_at = 0.0
+        self._invalidated = False  # re-read on the next get() even if the listener is active
+        self._lock = threading.Lock()
+        self._watch = None
+        self._watch_synced = False  # the listener has delivered at least one snapshot
+        self._subscribers = []
+        self.reads = 0
+
+    def get(self):
+        """Current overrides as a dict (empty if the document does not exist)."""
+        self._ensure_watch()
+        with self._lock:
+            fresh = self._watch_alive() and not self._invalidated
+            if self._data is not None and (fresh or time.monotonic() - self._loaded_at < self.ttl):
+                return dict(self._data)
+        return dict(self.refresh())
+
+    def refresh(self):
+        """Read the document now, bypassing the cache."""
+        try:
+            snap = self.db.document(CONFIG_DOC).get()
+            data = (snap.to_dict() or {}) if snap.exists else {}
+        except Exception as e:
+            logger.warning(f"Failed to read {CONFIG_DOC}: {e}")
+            with self._lock:
+                # Serve the last known copy rather than dropping all overrides
+                return self._data if self._data is not None else {}
+        self._store(data)
+        return data
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = 0.0
+            self._invalidated = True
+
+    def subscribe(self, callback):
+        """Call callback(data) whenever the snapshot listener delivers a change."""
+        with self._lock:
+            self._subscribers.append(callback)
+        self._ensure_watch()
+
+    def stop(self):
+        with self._lock:
+            watch, self._watch = self._watch, False
+        if watch:
+            try:
+                watch.unsubscribe()
+            except Exception:
+                pass
+
+    def _store(self, data):
+        with self._lock:
+            self.reads += 1
+            self._data = data
+            self._loaded_at = time.monotonic()
+            self._invalidated = False
+
+    def _watch_alive(self):
+        """Whether the snapshot listener keeps the cached copy current (caller holds the lock)."""
+        # The SDK's Watch closes itself after an unrecoverable stream error
+        return bool(self._watch) and self._watch_synced and getattr(self._watch, 'is_active', True)
+
+    def _ensure_watch(self):
+        if self._watch is not None:
+            return
+        with self._lock:
+            if self._watch is not None:
+                return
+            try:
+                self._watch = self.db.document(CONFIG_DOC).on_snapshot(self._on_snapshot)
+            except Exception as e:
+                # Without the listener the TTL alone bounds staleness
+                logger.warning(f"Config snapshot listener unavailable: {e}")
+                self._watch = False
+
+    def _on_snapshot(self, doc_snapshots, changes, read_time):
+        snap = doc_snapshots[0] if doc_snapshots else None
+        data = (snap.to_dict() or {}) if snap is not None and snap.exists else {}
+        with self._lock:
+            changed = data != self._data
+            subscribers = list(self._subscribers)
+            self._watch_synced = True
+        self._store(data)
+        if not changed:
+            return
+        logger.debug(f"{CONFIG_DOC} changed")
+        for callback in subscribers:
+            try:
+                callback(dict(data))
+            except Exception as e:
+                logger.error(f"Config subscriber failed: {e}")
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_config_provider(db):
+    """Process-wide provider shared by the listener and the admin app."""
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            _provider = ConfigProvider(db)
+        return _provider
@@ -0,0 +1,182 @@
+"""
+Rolling delivery counters, aggregated in memory and flushed to sharded Firestore stats documents
+"""
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from firebase_admin import firestore
+
+import config
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('delivery_stats')
+
+# ERROR counts documents that failed for good; RETRY counts failed attempts (throttling included) that will be retried
+STATES = ('SENT', 'ERROR', 'SKIPPED', 'RETRY')
+# Buckets older than this are pruned from the shard documents
+RETENTION_MINUTES = 24 * 60 + 60
+# Seconds between sweeps of stale buckets across all shard documents
+PRUNE_INTERVAL = 15 * 60
+
+
+def _minute(ts: datetime) -> int:
+    return int(ts.timestamp() // 60)
+
+
+def shards_collection(db):
+    """admin/smtpAgentStats/shards/{n}: one document per shard."""
+    return db.collection('admin').document('smtpAgentStats').collection('shards')
+
+
+class DeliveryStats:
+    """
+    Per-minute SENT/ERROR/SKIPPED/RETRY counters
+
+    record() only touches an in-memory dict. A background thread flushes the
+    pending increments every STATS_FLUSH_INTERVAL seconds into one of
+    STATS_SHARDS shard documents (picked at random to spread write load) as
+    buckets.{minute}.{state} increments. Every PRUNE_INTERVAL seconds the
+    same thread reads the shard documents and deletes buckets past retention,
+    whichever process (or earlier run of this one) wrote them.
+    """
+    def __init__(self, db, shard_count=None, flush_interval=None):
+        self.db = db
+        self.shard_count = max(1, shard_count or config.STATS_SHARDS)
+        self.flush_interval = flush_interval or config.STATS_FLUSH_INTERVAL
+        self._pending = {}  # minute -> {state: count}
+        self._last_processed_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, state, when=None):
+        state = (state or '').upper()
+        if state not in STATES:
+            return
+        when = when or datetime.now(timezone.utc)
+        minute = _minute(when)
+        with self._lock:
+            bucket = self._pending.setdefault(minute, {})
+            bucket[state] = bucket.get(state, 0) + 1
+            if self._last_processed_at is None or when > self._last_processed_at:
+                self._last_processed_at = when
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="delivery-stats", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def flush(self):
+        """Write pending increments to one shard document."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            last_processed_at = self._last_processed_at
+        if not pending:
+            return
+        shard = random.randrange(self.shard_count)
+        buckets = {}
+        for minute, counts in pending.items():
+            buckets[str(minute)] = {state.lower(): firestore.Increment(n) for state, n in counts.items()}
+        payload = {
+            'buckets': buckets,
+            'lastProcessedAt': last_processed_at,
+            'updatedAt': firestore.SERVER_TIMESTAMP,
+        }
+        try:
+            shards_collection(self.db).document(str(shard)).set(payload, merge=True)
+        except Exception as e:
+            logger.warning(f"Failed to flush delivery stats: {e}")
+            # Put the counts back so they go out with the next flush
+            with self._lock:
+                for minute, counts in pending.items():
+                    bucket = self._pending.setdefault(minute, {})
+                    for state, n in counts.items():
+                        bucket[state] = bucket.get(state, 0) + n
+
+    def prune(self):
+        """Delete buckets past retention from every shard document."""
+        cutoff = _minute(datetime.now(timezone.utc)) - RETENTION_MINUTES
+        removed = 0
+        try:
+            for snap in shards_collection(self.db).select(['buckets']).stream():
+                stale = {}
+                for key in ((snap.to_dict() or {}).get('buckets') or {}):
+                    try:
+                        if int(key) < cutoff:
+                            stale[key] = firestore.DELETE_FIELD
+                    except (TypeError, ValueError):
+                        continue
+                if stale:
+                    snap.reference.set({'buckets': stale}, merge=True)
+                    removed += len(stale)
+        except Exception as e:
+            logger.warning(f"Failed to prune delivery stats: {e}")
+        if removed:
+            logger.info(f"Pruned {removed} stale delivery stats buckets")
+        return removed
+
+    def _run(self):
+        next_prune = time.monotonic()
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+            if time.monotonic() >= next_prune:
+                self.prune()
+                next_prune = time.monotonic() + PRUNE_INTERVAL
+
+
+def read_stats(db, now, reset_at=None):
+    """
+    Aggregate the shard documents into dashboard counters
+
+    Returns None when no shard documents exist yet, so callers can fall back.
+    """
+    shards = list(shards_collection(db).stream())
+    if not shards:
+        return None
+    m_now = _minute(now)
+    m1 = m_now - 60
+    m24 = m_now - 24 * 60
+    m_reset = _minute(reset_at) if isinstance(reset_at, datetime) else None
+    out = {
+        'h1': {'sent': 0, 'error': 0, 'retry': 0},
+        'h24': {'sent': 0, 'error': 0, 'retry': 0},
+        'lastProcessedAt': None,
+        'errorsSinceReset': 0,
+    }
+    for snap in shards:
+        data = snap.to_dict() or {}
+        ts = data.get('lastProcessedAt')
+        if ts and (out['lastProcessedAt'] is None or ts > out['lastProcessedAt']):
+            out['lastProcessedAt'] = ts
+        for key, counts in (data.get('buckets') or {}).items():
+            try:
+                minute = int(key)
+            except (TypeError, ValueError):
+                continue
+            if minute < m24 or not isinstance(counts, dict):
+                continue
+            sent = int(counts.get('sent') or 0)
+            error = int(counts.get('error') or 0)
+            retry = int(counts.get('retry') or 0)
+            out['h24']['sent'] += sent
+            out['h24']['error'] += error
+            out['h24']['retry'] += retry
+            if minute >= m1:
+                out['h1']['sent'] += sent
+                out['h1']['error'] += error
+                out['h1']['retry'] += retry
+            if m_reset is not None and minute >= m_reset:
+                out['errorsSinceReset'] += error
+    return out
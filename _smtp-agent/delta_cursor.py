@@ -0,0 +1,142 @@
+"""
+High-water marks for delta polling (LISTEN_MODE=delta)
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from firebase_admin import firestore
+
+import config
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('delta_cursor')
+
+# Document fields tracked by a mark: creation by producers, and any later change
+# (producers resetting a document to PENDING bump smtpAgent.lastUpdatedAt too)
+DELTA_FIELDS = ('createdAt', 'smtpAgent.lastUpdatedAt')
+
+
+def marks_collection(db):
+    """admin/smtpAgentDelta/marks/{shard}: one document of high-water marks per shard."""
+    return db.collection('admin').document('smtpAgentDelta').collection('marks')
+
+
+def _field_value(data, field):
+    for part in field.split('.'):
+        data = data.get(part) if isinstance(data, dict) else None
+    return data
+
+
+class DeltaCursor:
+    """
+    Where the last delta cycle got to, per tracked field
+
+    Each cycle reads only the PENDING documents whose createdAt or
+    smtpAgent.lastUpdatedAt is past the field's mark minus
+    DELTA_OVERLAP_SECONDS. The overlap covers server timestamps that become
+    visible out of order. Documents read again inside the overlap are
+    dropped unless their value changed. The marks are saved through the
+    write batcher, so a restart carries on where it stopped instead of
+    scanning the whole queue. A full scan still runs every
+    DELTA_RECONCILE_INTERVAL seconds, and on first start, to catch anything
+    the deltas cannot see, e.g. retries and another shard's documents due
+    for takeover.
+    """
+    def __init__(self, db, writer, shard, overlap=None, reconcile_interval=None):
+        self.writer = writer
+        self.ref = marks_collection(db).document(str(shard))
+        self.overlap = timedelta(seconds=config.DELTA_OVERLAP_SECONDS if overlap is None else overlap)
+        self.reconcile_interval = reconcile_interval or config.DELTA_RECONCILE_INTERVAL
+        self.marks = {field: None for field in DELTA_FIELDS}
+        self._seen = {field: {} for field in DELTA_FIELDS}  # doc_id -> value read inside the overlap
+        self._cycle = set()
+        self._next_reconcile = 0.0
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Resume from the saved marks; without them the first cycle is a full scan."""
+        try:
+            snap = self.ref.get()
+            data = (snap.to_dict() or {}) if snap.exists else {}
+        except Exception as e:
+            logger.warning(f"Could not read delta marks: {e}")
+            data = {}
+        for field in DELTA_FIELDS:
+            value = data.get(field.rsplit('.', 1)[-1])
+            if isinstance(value, datetime):
+                self.marks[field] = value
+        if all(self.marks.values()):
+            logger.info(f"Resuming delta polling from {self._describe()}")
+            self._next_reconcile = time.monotonic() + self.reconcile_interval
+
+    def reconcile_due(self):
+        return time.monotonic() >= self._next_reconcile or not all(self.marks.values())
+
+    def request_reconcile(self):
+        self._next_reconcile = 0.0
+
+    def reconciled(self, started_at):
+        """A full scan begun at started_at finished: anything older is covered."""
+        floor = started_at - self.overlap
+        with self._lock:
+            for field in DELTA_FIELDS:
+                if self.marks[field] is None or self.marks[field] < floor:
+                    self.marks[field] = floor
+                    self._dirty = True
+        self._next_reconcile = time.monotonic() + self.reconcile_interval
+        logger.debug(f"Full scan done; delta marks at {self._describe()}")
+
+    def query(self, collection, field):
+        """PENDING documents whose `field` moved past its mark (less the overlap), oldest first."""
+        return (
+            collection
+            .where('smtpAgent.state', '==', 'PENDING')
+            .where(field, '>', self.marks[field] - self.overlap)
+            .order_by(field)
+        )
+
+    def begin_cycle(self):
+        self._cycle = set()
+
+    def fresh(self, field, docs):
+        """Drop documents already handled (same value, or seen this cycle) and advance the mark."""
+        out = []
+        with self._lock:
+            seen = self._seen[field]
+            for snap in docs:
+                value = _field_value(snap.to_dict() or {}, field)
+                if snap.id in self._cycle or (value is not None and seen.get(snap.id) == value):
+                    continue
+                self._cycle.add(snap.id)
+                out.append(snap)
+                if not isinstance(value, datetime):
+                    continue
+                seen[snap.id] = value
+                if value > self.marks[field]:
+                    self.marks[field] = value
+                    self._dirty = True
+        return out
+
+    def save(self):
+        """Forget values that fell out of the overlap and persist the marks if they moved."""
+        with self._lock:
+            for field in DELTA_FIELDS:
+                floor = self.marks[field] - self.overlap
+                self._seen[field] = {doc_id: value for doc_id, value in self._seen[field].items() if value >= floor}
+            if not self._dirty:
+                return
+            payload = {field.rsplit('.', 1)[-1]: self.marks[field] for field in DELTA_FIELDS}
+            self._dirty = False
+        payload['savedAt'] = firestore.SERVER_TIMESTAMP
+        self.writer.set(self.ref, payload, merge=True)
+
+    def _describe(self):
+        return ', '.join(f"{field} > {mark.isoformat()}" for field, mark in self.marks.items() if mark)
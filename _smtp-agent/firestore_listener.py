@@ -6,6 +6,8 @@ import time
 import socket
 import os
 import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timezone, timedelta
 from typing import Dict, Any
 
@@ -13,7 +15,21 @@ import firebase_admin
 from firebase_admin import credentials, firestore
 
 import config
+import metrics
 from smtp_sender import SMTPSender
+from write_batcher import WriteBatcher
+from retry_scheduler import RetryScheduler, next_retry_time
+from utils import iter_query_pages
+from lease_manager import LeaseManager, shard_of
+from lease_reaper import LeaseReaper
+from send_scheduler import SendScheduler, parse_send_at
+from delta_cursor import DeltaCursor, DELTA_FIELDS
+from poll_interval import AdaptivePollInterval
+from delivery_stats import DeliveryStats
+from idempotency import IdempotencyIndex
+from shutdown import ShutdownCoordinator
+from priority import PriorityLanes, build_priority_map, DEFAULT_CLASS, PRIORITY_CLASSES
+from config_provider import get_config_provider
 
 # Configure logging
 logging.basicConfig(
@@ -23,27 +39,134 @@ logging.basicConfig(
 )
 logger = logging.getLogger('firestore_listener')
 
+POLL_CYCLES = metrics.counter('smtp_agent_poll_cycles_total', 'Completed poll cycles')
+POLL_CYCLE_SECONDS = metrics.histogram('smtp_agent_poll_cycle_seconds', 'Duration of one poll cycle')
+DOCS_SCANNED = metrics.counter('smtp_agent_docs_scanned_total', 'Mail documents evaluated by the agent')
+DOCS_SENT = metrics.counter('smtp_agent_docs_sent_total', 'Mail documents delivered and marked SENT')
+GROUPED_DOCS = metrics.counter('smtp_agent_grouped_documents_total', 'Documents sent as part of a same-content group')
+DUPLICATE_DOCS = metrics.counter('smtp_agent_duplicate_documents_total', 'Documents skipped because an identical message was already delivered')
+
+
+def group_jobs(jobs, mode, max_size):
+    """
+    Split prepared jobs into send groups
+
+    With grouping off every job is its own group. Otherwise jobs with the same
+    priority and content hash are grouped, and large groups are split into
+    evenly sized chunks of at most max_size so a bulk send still spreads over
+    the workers.
+    """
+    if mode == 'off' or max_size <= 1:
+        return [[job] for job in jobs]
+    by_content = {}
+    for job in jobs:
+        by_content.setdefault((job.get('priority'), job['content_hash']), []).append(job)
+    groups = []
+    for same in by_content.values():
+        size = -(-len(same) // -(-len(same) // max_size))
+        groups.extend(same[i:i + size] for i in range(0, len(same), size))
+    return groups
+
 class FirestoreListener:
     """
     Monitors Firestore 'mail' collection for new or failed email documents
     """
+    # LISTEN_MODE values this engine implements
+    LISTEN_MODES = ('poll', 'snapshot', 'delta')
+
     def __init__(self):
+        if config.LISTEN_MODE not in self.LISTEN_MODES:
+            raise ValueError(f"LISTEN_MODE={config.LISTEN_MODE} is not supported by this engine (use one of: {', '.join(self.LISTEN_MODES)})")
         self.initialize_firebase()
         self.db = firestore.client()
         self.mail_collection = self.db.collection(config.MAIL_COLLECTION)
-        self.smtp_sender = SMTPSender()
+        self.smtp_sender = self._create_sender()
+        self.writer = WriteBatcher(self.db)
+        self.stats = DeliveryStats(self.db)
+        self.idempotency = IdempotencyIndex(self.db, self.writer)
         self.last_check_time = datetime.now()
         self.host = socket.gethostname()
         self.pid = os.getpid()
         self.version = "0.2.0"
-        # Effective, reloadable config
-        self.poll_interval = config.POLL_INTERVAL
+        self.owner = f"{self.host}:{self.pid}"
+        # Multi-instance: transactional leases, optional doc-id sharding
+        self.leases = LeaseManager(self.db, self.owner, self.writer)
+        self.shard_count = max(1, config.SHARD_COUNT)
+        self.shard_index = config.SHARD_INDEX % self.shard_count
+        # Effective, reloadable config; the poll interval adapts to queue activity within its bounds
+        self.poller = AdaptivePollInterval(config.POLL_INTERVAL_MIN, config.POLL_INTERVAL_MAX)
+        self.poll_interval = self.poller.current
+        self._found_work = False
         self.max_retry_count = config.MAX_RETRY_COUNT
         self.process_from_after_dt = config.PROCESS_FROM_AFTER_DT
         self.log_level = config.LOG_LEVEL
+        self.max_concurrent_sends = config.MAX_CONCURRENT_SENDS
+        self.page_size = config.QUERY_PAGE_SIZE
+        self.send_grouping = config.SEND_GROUPING if config.SEND_GROUPING in ('off', 'connection', 'bcc') else 'connection'
+        # Send groups wait in per-class lanes; workers take the next one by weight
+        self.priority_map = build_priority_map()
+        self.lanes = PriorityLanes()
+        self._next_peek = 0.0
+        self._executor = None
+        self._executor_size = None
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+        self._executor_lock = threading.RLock()
+        # ERROR documents are retried by the scheduler instead of being rescanned every poll
+        self.retry_scheduler = RetryScheduler(self.db, self.mail_collection, self._dispatch_due) if config.RETRY_SCHEDULER else None
+        # PROCESSING documents whose lease ran out (crashed sender) are requeued
+        self.lease_reaper = LeaseReaper(self.db, self.mail_collection, self.leases, self._on_requeue) if config.LEASE_REAPER else None
+        # Documents with a future sendAt wait in a timer wheel instead of being rescanned every poll
+        self.send_scheduler = SendScheduler(self.db, self.mail_collection, self._dispatch_due)
+        # Snapshot streaming state
+        self.listen_mode = config.LISTEN_MODE
+        # Delta polling: only documents changed since the last cycle, plus periodic full scans
+        self.delta = DeltaCursor(self.db, self.writer, self.shard_index) if self.listen_mode == 'delta' else None
+        self.snapshot_resync_interval = config.SNAPSHOT_RESYNC_INTERVAL
+        self._watch = None
+        self._snapshot_error = None
+        self._snapshot_backoff = 1
+        self._snapshot_retry_at = 0
+        self._last_resync = time.monotonic()
+        # Overrides come from a shared cache kept current by a snapshot listener
+        self.config_provider = get_config_provider(self.db)
+        self._wake = threading.Event()
+        self.shutdown = ShutdownCoordinator(self)
         # Initial load of overrides
         self._load_overrides()
+        self._register_gauges()
         
+    def _register_gauges(self):
+        """Gauges read from live state at scrape time, so the send path pays nothing for them."""
+        metrics.gauge('smtp_agent_in_flight_documents', 'Documents submitted to the worker pool and not yet finished') \
+            .set_function(lambda: len(self._in_flight))
+        metrics.gauge('smtp_agent_max_concurrent_sends', 'Configured worker pool size') \
+            .set_function(lambda: self.max_concurrent_sends)
+        metrics.gauge('smtp_agent_write_queue_depth', 'Firestore writes waiting to be batched') \
+            .set_function(self.writer.pending)
+        metrics.gauge('smtp_agent_retry_backlog', 'ERROR documents scheduled for a retry') \
+            .set_function(lambda: self.retry_scheduler.backlog() if self.retry_scheduler is not None else None)
+        metrics.gauge('smtp_agent_leases_held', 'Documents this instance currently holds a lease on') \
+            .set_function(lambda: len(self.leases.held()))
+        metrics.gauge('smtp_agent_lease_reaper_tracked', 'PROCESSING documents indexed by lease expiry') \
+            .set_function(lambda: self.lease_reaper.tracked() if self.lease_reaper is not None else None)
+        metrics.gauge('smtp_agent_scheduled_documents', 'SCHEDULED documents held in the send timer wheel') \
+            .set_function(self.send_scheduler.scheduled)
+        depth = metrics.gauge('smtp_agent_priority_queue_depth', 'Send groups waiting in each priority lane', ('priority',))
+        for cls in PRIORITY_CLASSES:
+            depth.labels(cls).set_function(lambda cls=cls: self.lanes.depth(cls))
+        metrics.gauge('smtp_agent_poll_interval_seconds', 'Effective poll interval') \
+            .set_function(lambda: self.poll_interval)
+        metrics.gauge('smtp_agent_send_rate_per_second', 'Current adaptive send rate limit (0 = unlimited)') \
+            .set_function(lambda: self.smtp_sender.rate_limiter.current_rate)
+        pool = metrics.gauge('smtp_agent_smtp_pool_connections', 'Pooled SMTP sessions by state', ('state',))
+        pool.labels('in_use').set_function(lambda: self.smtp_sender.pool_stats()['inUse'])
+        pool.labels('idle').set_function(lambda: self.smtp_sender.pool_stats()['idle'])
+        pool.labels('max').set_function(lambda: self.smtp_sender.pool_stats()['size'])
+
+    def _create_sender(self):
+        return SMTPSender()
+
     def initialize_firebase(self):
         """Initialize Firebase Admin SDK"""
         try:
@@ -60,146 +183,614 @@ class FirestoreListener:
     def start_listening(self):
         """
         Start listening for new or failed email documents
+
+        In 'poll' mode the candidate query is re-run every poll_interval seconds.
+        In 'delta' mode each cycle only reads documents created or updated since
+        the previous one, with a full candidate query every DELTA_RECONCILE_INTERVAL.
+        In 'snapshot' mode a Firestore listener delivers new/changed documents as they
+        arrive; the loop then only supervises the stream, runs a periodic resync sweep
+        (retries, missed changes) and falls back to polling while the stream is down.
         """
-        logger.info(f"Starting to monitor '{config.MAIL_COLLECTION}' collection")
+        logger.info(f"Starting to monitor '{config.MAIL_COLLECTION}' collection (mode={self.listen_mode})")
+        self.stats.start()
+        self.config_provider.subscribe(self._on_config_change)
+        if self.retry_scheduler is not None:
+            self._ensure_executor()
+            self.retry_scheduler.rebuild()
+            self.retry_scheduler.start()
+        if self.lease_reaper is not None:
+            self.lease_reaper.start()
+        self.send_scheduler.start()
+        if self.delta is not None:
+            self.delta.load()
 
-        while True:
+        while not self.shutdown.requested.is_set():
             try:
-                # Reload admin overrides each cycle (lightweight read)
+                # Re-apply admin overrides each cycle (served from the config cache)
                 self._load_overrides()
-                self._check_pending_emails()
-                time.sleep(self.poll_interval)
+                if self.listen_mode == 'snapshot':
+                    self._supervise_snapshot()
+                else:
+                    self._check_pending_emails()
+                self._adapt_poll_interval()
+                self._sleep(self.poll_interval)
             except Exception as e:
                 logger.error(f"Error in listener loop: {str(e)}")
-                time.sleep(self.poll_interval)
-    
-    def _check_pending_emails(self):
-        """
-        Check for pending emails in Firestore
-        """
+                self._sleep(self.poll_interval)
+        self.shutdown.drain()
+
+    def _adapt_poll_interval(self):
+        """Poll sooner after a cycle that found documents to send, back off after an idle one."""
+        found, self._found_work = self._found_work, False
+        interval = self.poller.update(found)
+        if interval != self.poll_interval:
+            logger.debug(f"Poll interval {self.poll_interval:g}s -> {interval:g}s")
+        self.poll_interval = interval
+
+    def _sleep(self, seconds):
+        """Sleep until the next cycle, or until a config change wakes the loop."""
+        self._wake.wait(seconds)
+        self._wake.clear()
+
+    def _on_config_change(self, data):
+        logger.info("Admin config changed; applying overrides")
+        self._load_overrides(data)
+        self._wake.set()
+
+    def stop_claiming(self):
+        """Shutdown hook: wake the loop so it notices the request and exits."""
+        self._wake.set()
+
+    def in_flight_count(self):
+        with self._in_flight_lock:
+            return len(self._in_flight)
+
+    def close_workers(self):
+        """Shutdown hook: stop the send worker pool and close pooled SMTP sessions."""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+        self.smtp_sender.close()
+
+    def _build_candidate_query(self, collection=None):
+        """Build the query selecting new and in-progress documents the agent may have to send."""
         # Build base query: createdAt >= cutoff (if configured)
-        query = self.mail_collection
+        query = self.mail_collection if collection is None else collection
         if self.process_from_after_dt:
             cutoff = self.process_from_after_dt
             logger.debug(f"Applying cutoff createdAt >= {cutoff.isoformat()}")
             query = query.where('createdAt', '>=', cutoff)
 
-        # Ignore already-finished docs to reduce re-scans
+        # Ignore finished docs; ERROR docs are picked up by the retry scheduler or the due-retry query,
+        # SCHEDULED docs by the send scheduler
         try:
-            query = query.where('smtpAgent.state', 'not-in', ['SENT', 'SKIPPED'])
+            query = query.where('smtpAgent.state', 'not-in', ['SENT', 'SKIPPED', 'ERROR', 'SCHEDULED'])
         except Exception:
             # Older Firestore emulator/SDK may not support 'not-in'; fall back to filtering in code
             pass
+        return query
+
+    def _build_fallback_query(self, collection=None):
+        """Cutoff-only query used when the candidate query's composite index is missing."""
+        query = self.mail_collection if collection is None else collection
+        if self.process_from_after_dt:
+            query = query.where('createdAt', '>=', self.process_from_after_dt)
+        return query
+
+    def _build_urgent_query(self, collection=None):
+        """New documents of high-priority types, or None if no type maps to 'high'."""
+        # Equality filters only, so Firestore serves it from single-field indexes
+        types = sorted(t for t, cls in self.priority_map.items() if cls == 'high')[:30]
+        if not types:
+            return None
+        return (
+            (self.mail_collection if collection is None else collection)
+            .where('smtpAgent.state', '==', 'PENDING')
+            .where('type', 'in', types)
+            .limit(self.page_size)
+        )
+
+    def _build_due_retry_query(self, collection=None):
+        """Failed documents whose nextRetryAt has passed; the attempts cap is applied when they are prepared."""
+        # A single range filter, so it is served by the (state, nextRetryAt) index
+        return (
+            (self.mail_collection if collection is None else collection)
+            .where('smtpAgent.state', '==', 'ERROR')
+            .where('smtpAgent.nextRetryAt', '<=', datetime.now(timezone.utc))
+        )
+
+    def _check_pending_emails(self):
+        """
+        Check for pending emails in Firestore
+        """
+        with POLL_CYCLE_SECONDS.time():
+            self._run_poll_queries()
+        POLL_CYCLES.inc()
 
-        # Get candidate docs and filter in code
-        self._process_query_results(query)
-        
         # Update last check time
         self.last_check_time = datetime.now()
-        
-    def _process_query_results(self, query):
+        logger.debug(f"SMTP pool stats: {self.smtp_sender.pool_stats()}")
+
+    def _run_poll_queries(self):
+        if self.delta is not None and not self.delta.reconcile_due():
+            self._run_delta_queries()
+        else:
+            started_at = datetime.now(timezone.utc)
+            self._process_query_results(self._build_candidate_query(), self._build_fallback_query())
+            if self.delta is not None and not self.shutdown.requested.is_set():
+                self.delta.reconciled(started_at)
+        if self.retry_scheduler is None:
+            # Without the scheduler, due retries are found query-side instead of by rescanning ERROR docs
+            self._process_query_results(
+                self._build_due_retry_query(),
+                self.mail_collection.where('smtpAgent.state', '==', 'ERROR')
+            )
+
+    def _run_delta_queries(self):
+        """Read only the PENDING documents created or updated since the last cycle."""
+        self.delta.begin_cycle()
+        for field in DELTA_FIELDS:
+            try:
+                for page in iter_query_pages(self.delta.query(self.mail_collection, field), self.page_size):
+                    if self.shutdown.requested.is_set():
+                        break
+                    docs = self.delta.fresh(field, page)
+                    if docs:
+                        self._process_page(docs)
+            except Exception as e:
+                logger.warning(f"Delta query on {field} failed: {e}; running a full scan next cycle")
+                self.delta.request_reconcile()
+        self.delta.save()
+
+    def _supervise_snapshot(self):
         """
-        Process query results and send emails
-        
-        Args:
-            query: Firestore query object
+        Keep the snapshot stream alive and run polling sweeps when needed
+
+        While the stream is down a full poll runs every cycle; while it is up a
+        sweep only runs every snapshot_resync_interval seconds.
         """
-        # Execute query with fallback in case composite index for 'not-in' is missing
+        if not self._snapshot_alive():
+            self._stop_snapshot()
+            now = time.monotonic()
+            if now >= self._snapshot_retry_at:
+                self._start_snapshot()
+            if not self._snapshot_alive():
+                logger.info("Snapshot stream unavailable; polling this cycle")
+                self._check_pending_emails()
+                self._last_resync = time.monotonic()
+                return
+        if time.monotonic() - self._last_resync >= self.snapshot_resync_interval:
+            logger.debug("Running periodic resync sweep")
+            self._check_pending_emails()
+            self._last_resync = time.monotonic()
+
+    def _start_snapshot(self):
         try:
-            docs = query.get()
+            self._ensure_executor()
+            self._watch = self._build_candidate_query().on_snapshot(self._on_snapshot)
+            self._snapshot_error = None
+            logger.info("Snapshot stream started")
         except Exception as e:
-            logger.warning(f"Primary query failed (possibly missing index for 'not-in'): {e}")
-            # Fallback: drop the not-in filter by rebuilding query only with cutoff
-            fb_query = self.mail_collection
-            if self.process_from_after_dt:
-                fb_query = fb_query.where('createdAt', '>=', self.process_from_after_dt)
-            try:
-                docs = fb_query.get()
-                logger.info("Falling back to createdAt-only query; filtering finished docs in code")
-            except Exception as e2:
-                logger.error(f"Fallback query also failed: {e2}")
-                return
-        for doc in docs:
-            doc_id = doc.id
-            doc_data = doc.to_dict()
+            self._watch = None
+            self._snapshot_failed(e)
 
-            logger.debug(f"Processing document {doc_id}")
-            
-            # Skip if before cutoff (if createdAt missing, treat as now and allow)
+    def _stop_snapshot(self):
+        watch, self._watch = self._watch, None
+        if watch is not None:
             try:
-                created_at = doc_data.get('createdAt')
-                if self.process_from_after_dt and isinstance(created_at, datetime):
-                    # Firestore returns aware datetimes
-                    if created_at < self.process_from_after_dt:
-                        logger.debug(f"Skipping {doc_id}: before cutoff")
-                        self._update_agent_state(doc.reference, state='SKIPPED', reason='before_cutoff')
-                        continue
+                watch.unsubscribe()
             except Exception:
                 pass
 
-            smtp_agent = doc_data.get('smtpAgent', {}) or {}
-            state = smtp_agent.get('state')
-            if state == 'SENT' or state == 'SKIPPED':
-                logger.debug(f"Skipping {doc_id}: state={state}")
-                continue
+    def _snapshot_alive(self):
+        if self._watch is None or self._snapshot_error is not None:
+            return False
+        # The SDK marks the watch closed when the stream terminates for good
+        return not getattr(self._watch, '_closed', False)
+
+    def _snapshot_failed(self, error):
+        self._snapshot_error = error
+        self._snapshot_retry_at = time.monotonic() + self._snapshot_backoff
+        logger.warning(f"Snapshot stream failed ({error}); reconnecting in {self._snapshot_backoff}s")
+        self._snapshot_backoff = min(self._snapshot_backoff * 2, config.SNAPSHOT_MAX_BACKOFF)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        """Snapshot callback: dispatch ADDED/MODIFIED documents to the send workers."""
+        try:
+            self._snapshot_backoff = 1
+            docs = []
+            for change in changes:
+                if change.type.name not in ('ADDED', 'MODIFIED'):
+                    continue
+                doc = change.document
+                state = ((doc.to_dict() or {}).get('smtpAgent') or {}).get('state')
+                if state == 'PROCESSING':
+                    # Either our own in-flight marker or another worker's; sweeps handle stale ones
+                    continue
+                docs.append(doc)
+            self._submit_docs(docs)
+        except Exception as e:
+            self._snapshot_failed(e)
 
-            # Retry/backoff: skip until nextRetryAt, and stop after MAX_RETRY_COUNT
+    def _submit_docs(self, docs):
+        """
+        Prepare documents and submit them to the send workers
+
+        Documents already in flight are ignored. The rest are grouped by
+        content (see group_jobs) into the priority lanes, with one worker task
+        per group that sends whichever group the lanes pick when it runs.
+
+        Returns:
+            list: Futures of the submitted tasks
+        """
+        executor = self._ensure_executor()
+        futures = []
+        jobs = self._prepare_batch((doc.id, doc.to_dict(), doc.reference) for doc in docs)
+        if self.idempotency.enabled and jobs:
+            jobs = self._drop_duplicates(jobs, self.idempotency.lookup([job['message_hash'] for job in jobs]))
+        for group in group_jobs(jobs, self.send_grouping, config.SEND_GROUP_MAX):
+            self.lanes.push(group[0]['priority'], group)
             try:
-                attempts = int(smtp_agent.get('attempts') or 0)
+                futures.append(executor.submit(self._run_next))
             except Exception:
-                attempts = 0
-            next_retry_at = smtp_agent.get('nextRetryAt')
-            now = datetime.now(timezone.utc)
-            if next_retry_at and isinstance(next_retry_at, datetime) and next_retry_at > now:
-                logger.debug(f"Skipping {doc_id}: nextRetryAt in future {next_retry_at}")
-                continue
-            if attempts >= self.max_retry_count:
-                logger.debug(f"Skipping {doc_id}: attempts {attempts} >= MAX_RETRY_COUNT")
-                self._update_agent_state(doc.reference, state='SKIPPED', reason='max_retries')
-                continue
-                
-            # Extract email data
-            try:
-                to_email = doc_data.get('to')
-                # subject is inside message upstream
-                subject = doc_data.get('message', {}).get('subject') or doc_data.get('subject')
-                html_content = doc_data.get('message', {}).get('html')
-                
-                # Validate required fields
-                if not all([to_email, subject, html_content]):
-                    logger.error(f"Document {doc_id} missing required fields")
-                    self._update_agent_error(doc.reference, 'VALIDATION', 'Missing required fields')
+                # One group too many is queued now; drop one
+                self._finish_jobs(self.lanes.pop() or [])
+                raise
+        return futures
+
+    def _prepare_batch(self, docs):
+        """
+        Mark documents in flight and prepare them
+
+        Args:
+            docs: (doc_id, doc_data, doc_ref) tuples
+
+        Returns:
+            list: Jobs (see _prepare_document) of the documents to send now
+        """
+        jobs = []
+        if self.shutdown.requested.is_set():
+            return jobs
+        for doc_id, doc_data, doc_ref in docs:
+            with self._in_flight_lock:
+                if doc_id in self._in_flight:
                     continue
-                
-                # Normalize recipient(s)
-                if isinstance(to_email, list):
-                    to_resolved = to_email
-                    to_primary = ','.join(to_email)
-                else:
-                    to_resolved = [to_email]
-                    to_primary = to_email
+                self._in_flight.add(doc_id)
+            job = None
+            try:
+                job = self._prepare_document(doc_id, doc_data, doc_ref)
+            finally:
+                if job is None:
+                    with self._in_flight_lock:
+                        self._in_flight.discard(doc_id)
+            if job is not None:
+                jobs.append(job)
+        if jobs:
+            self._found_work = True
+        return jobs
 
-                # Idempotency hash
-                message_hash = self._message_hash(subject, html_content, to_resolved)
+    def _drop_duplicates(self, jobs, delivered):
+        """
+        Skip jobs whose message was delivered within IDEMPOTENCY_WINDOW
+
+        Args:
+            jobs: Prepared jobs
+            delivered: {message_hash: (delivered_at, doc_id)} from the idempotency index
+
+        Returns:
+            list: The jobs to send, each holding a reservation on its message hash
+        """
+        keep = []
+        for job in jobs:
+            entry = delivered.get(job['message_hash'])
+            if entry is not None and entry[1] == job['doc_id'] and job['state'] in ('PROCESSING', 'SENT'):
+                # Delivered by this very document: a stale read taken before its SENT write landed
+                logger.debug(f"Skipping {job['doc_id']}: already delivered")
+                self._release_in_flight(job)
+            elif entry is not None:
+                # Includes a document put back to PENDING after its own delivery
+                self._mark_duplicate(job, entry)
+                self._release_in_flight(job)
+            elif not self.idempotency.reserve(job['message_hash']):
+                # An identical message is being sent; this one is looked at again on a later pass
+                logger.debug(f"Deferring {job['doc_id']}: identical message in flight")
+                self._release_in_flight(job)
+            else:
+                keep.append(job)
+        return keep
+
+    def _mark_duplicate(self, job, entry):
+        delivered_at, doc_id = entry
+        logger.info(f"Skipping {job['doc_id']}: identical message delivered by {doc_id} at {delivered_at}")
+        DUPLICATE_DOCS.inc()
+        self._update_agent_state(
+            job['doc_ref'],
+            state='SKIPPED',
+            reason=f"duplicate of {doc_id}",
+            code='DUPLICATE',
+            extra={'idempotency': {'messageHash': job['message_hash'], 'duplicateOf': doc_id}}
+        )
+
+    def _release_in_flight(self, job):
+        with self._in_flight_lock:
+            self._in_flight.discard(job['doc_id'])
 
-                # Mark as PROCESSING with a short lease
-                start_ts = firestore.SERVER_TIMESTAMP
-                self._set_processing(doc.reference, start_ts)
+    def _finish_jobs(self, jobs):
+        with self._in_flight_lock:
+            for job in jobs:
+                self._in_flight.discard(job['doc_id'])
+        if self.idempotency.enabled:
+            for job in jobs:
+                self.idempotency.release(job['message_hash'])
 
-                # Send email
-                result = self.smtp_sender.send_email(to_primary, subject, html_content)
+    def _dispatch_due(self, docs):
+        """Retry/send scheduler callback: send documents whose nextRetryAt or sendAt has passed."""
+        self._submit_docs(docs)
 
+    def _run_next(self):
+        """Worker task: send the group the priority lanes pick next."""
+        jobs = self.lanes.pop()
+        if jobs is None:
+            return
+        try:
+            self._send_jobs(jobs)
+        finally:
+            self._finish_jobs(jobs)
+
+    def _process_query_results(self, query, fallback_query=None):
+        """
+        Process query results page by page and send emails
+        
+        Args:
+            query: Firestore query object
+            fallback_query: Broader query to use if the primary one fails (e.g. missing index)
+        """
+        # Execute query with fallback in case a composite index is missing
+        try:
+            for page in iter_query_pages(query, self.page_size):
+                if self.shutdown.requested.is_set():
+                    break
+                self._process_page(page)
+        except Exception as e:
+            if fallback_query is None:
+                logger.error(f"Query failed: {e}")
+                return
+            logger.warning(f"Primary query failed (possibly missing composite index): {e}")
+            try:
+                logger.info("Falling back to broader query; filtering in code")
+                for page in iter_query_pages(fallback_query, self.page_size):
+                    if self.shutdown.requested.is_set():
+                        break
+                    self._process_page(page)
+            except Exception as e2:
+                logger.error(f"Fallback query also failed: {e2}")
+
+    def _process_page(self, docs):
+        """Send one page of documents on the worker pool and wait for it to finish."""
+        pending = set(self._submit_docs(docs))
+        while pending:
+            done, pending = wait(pending, timeout=self._peek_wait())
+            for future in done:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Send worker failed: {e}")
+            if pending and self._peek_due():
+                # A long sweep (e.g. a bulk backlog) must not hold back urgent mail further down the query
+                self._peek_urgent()
+        # Results are durable before the next page (and the next cycle) is read
+        self.writer.flush()
+
+    def _peek_wait(self):
+        return max(0.0, self._next_peek - time.monotonic())
+
+    def _peek_due(self):
+        """True at most every PRIORITY_PEEK_INTERVAL seconds while a sweep is sending."""
+        now = time.monotonic()
+        if now < self._next_peek:
+            return False
+        # Advanced even while draining, so _peek_wait() keeps the page wait from spinning
+        self._next_peek = now + config.PRIORITY_PEEK_INTERVAL
+        return not self.shutdown.requested.is_set()
+
+    def _peek_urgent(self):
+        """Queue new high-priority documents without waiting for the query to reach them."""
+        query = self._build_urgent_query()
+        if query is None:
+            return
+        try:
+            self._submit_docs(list(query.stream()))
+        except Exception as e:
+            logger.warning(f"Urgent mail query failed: {e}")
+
+    def _ensure_executor(self):
+        """Return the send worker pool, resizing it if maxConcurrentSends changed."""
+        size = self.max_concurrent_sends
+        with self._executor_lock:
+            if self._executor is None or self._executor_size != size:
+                old = self._executor
+                with self._in_flight_lock:
+                    self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='send-worker')
+                if old is not None:
+                    logger.info(f"Resizing send worker pool {self._executor_size} -> {size}")
+                    # Already-submitted sends finish on the old pool
+                    old.shutdown(wait=False)
+                self._executor_size = size
+            return self._executor
+
+    def _send_jobs(self, jobs):
+        """
+        Claim, send and record a group of prepared documents sharing one message body
+
+        A single document is sent on its own. A larger group goes out over one
+        SMTP session (SEND_GROUPING=connection) or in shared BCC transactions
+        (SEND_GROUPING=bcc); each document still gets its own smtpAgent result.
+        """
+        if self.shutdown.requested.is_set():
+            return
+        # Claim the documents with a lease; another instance may already hold some
+        claimed = [job for job in jobs if self._claim_processing(job['doc_ref'], firestore.SERVER_TIMESTAMP)]
+        if not claimed:
+            return
+        if self.shutdown.requested.is_set():
+            self._relinquish(claimed)
+            return
+        try:
+            results = self._send_claimed(claimed)
+            for job, result in zip(claimed, results):
                 # Update document with result in smtpAgent namespace
                 self._update_agent_result(
-                    doc.reference,
+                    job['doc_ref'],
                     result=result,
-                    to_resolved=to_resolved,
-                    message_hash=message_hash
+                    to_resolved=job['to_resolved'],
+                    message_hash=job['message_hash'],
+                    attempts=job['attempts']
                 )
-                
-            except Exception as e:
-                logger.error(f"Error processing document {doc_id}: {str(e)}")
-                self._update_agent_error(doc.reference, 'EXCEPTION', str(e))
+        except Exception as e:
+            for job in claimed:
+                logger.error(f"Error processing document {job['doc_id']}: {str(e)}")
+                self._update_agent_error(job['doc_ref'], 'EXCEPTION', str(e), attempts=job['attempts'])
+        finally:
+            for job in claimed:
+                self.leases.release(job['doc_id'])
+
+    def _relinquish(self, jobs):
+        """Shutting down before sending: hand the claimed documents straight back."""
+        for job in jobs:
+            logger.info(f"Releasing {job['doc_id']} unsent (shutting down)")
+            self.leases.relinquish(job['doc_ref'])
+
+    def _send_claimed(self, jobs):
+        first = jobs[0]
+        if len(jobs) == 1:
+            return [self.smtp_sender.send_email(first['to_primary'], first['subject'], first['html'], first['content_hash'])]
+        GROUPED_DOCS.inc(len(jobs))
+        return self.smtp_sender.send_group(
+            [job['to_resolved'] for job in jobs], first['subject'], first['html'],
+            bcc=self.send_grouping == 'bcc', content_key=first['content_hash']
+        )
+
+    def _prepare_document(self, doc_id, doc_data, doc_ref):
+        """
+        Apply the cutoff, state, retry, shard and validation checks to a candidate
+
+        Documents that are filtered out are marked SKIPPED/ERROR or scheduled
+        for a retry as needed. Shared by the threaded and the asyncio engine.
+
+        Returns:
+            dict: The message to send (to_primary, subject, html, to_resolved,
+                message_hash, attempts, state), or None if the document is not sent now
+        """
+        doc_data = doc_data or {}
+        DOCS_SCANNED.inc()
+
+        logger.debug(f"Processing document {doc_id}")
+        
+        # Skip if before cutoff (if createdAt missing, treat as now and allow)
+        try:
+            created_at = doc_data.get('createdAt')
+            if self.process_from_after_dt and isinstance(created_at, datetime):
+                # Firestore returns aware datetimes
+                if created_at < self.process_from_after_dt:
+                    logger.debug(f"Skipping {doc_id}: before cutoff")
+                    self._update_agent_state(doc_ref, state='SKIPPED', reason='before_cutoff')
+                    return None
+        except Exception:
+            pass
+
+        smtp_agent = doc_data.get('smtpAgent', {}) or {}
+        state = smtp_agent.get('state')
+        if state == 'SENT' or state == 'SKIPPED':
+            logger.debug(f"Skipping {doc_id}: state={state}")
+            return None
+
+        # Future sendAt: park the document as SCHEDULED until the send scheduler fires it
+        send_at = parse_send_at(doc_data.get('sendAt'))
+        if send_at is not None and send_at > datetime.now(timezone.utc):
+            logger.debug(f"Skipping {doc_id}: scheduled for {send_at.isoformat()}")
+            if state != 'SCHEDULED' or smtp_agent.get('sendAt') != send_at:
+                self._update_agent_state(doc_ref, state='SCHEDULED', extra={'sendAt': send_at})
+            self.send_scheduler.schedule(doc_id, send_at)
+            return None
+
+        # Retry/backoff: skip until nextRetryAt, and stop after MAX_RETRY_COUNT
+        try:
+            attempts = int(smtp_agent.get('attempts') or 0)
+        except Exception:
+            attempts = 0
+        next_retry_at = smtp_agent.get('nextRetryAt')
+        now = datetime.now(timezone.utc)
+        if next_retry_at and isinstance(next_retry_at, datetime) and next_retry_at > now:
+            logger.debug(f"Skipping {doc_id}: nextRetryAt in future {next_retry_at}")
+            if self.retry_scheduler is not None:
+                self.retry_scheduler.schedule(doc_id, next_retry_at)
+            return None
+        if not self._in_my_shard(doc_id, smtp_agent, doc_data):
+            logger.debug(f"Skipping {doc_id}: belongs to another shard")
+            if state == 'ERROR' and self.retry_scheduler is not None:
+                # Check back after the takeover grace period in case its owner is gone
+                self.retry_scheduler.schedule(doc_id, now + timedelta(seconds=config.SHARD_TAKEOVER_SECONDS))
+            return None
+        if attempts >= self.max_retry_count:
+            logger.debug(f"Skipping {doc_id}: attempts {attempts} >= MAX_RETRY_COUNT")
+            self._update_agent_state(doc_ref, state='SKIPPED', reason='max_retries')
+            return None
+            
+        # Extract email data
+        try:
+            to_email = doc_data.get('to')
+            # subject is inside message upstream
+            subject = doc_data.get('message', {}).get('subject') or doc_data.get('subject')
+            html_content = doc_data.get('message', {}).get('html')
+            
+            # Validate required fields
+            if not all([to_email, subject, html_content]):
+                logger.error(f"Document {doc_id} missing required fields")
+                self._update_agent_error(doc_ref, 'VALIDATION', 'Missing required fields', attempts=attempts)
+                return None
+            
+            # Normalize recipient(s)
+            if isinstance(to_email, list):
+                to_resolved = to_email
+                to_primary = ','.join(to_email)
+            else:
+                to_resolved = [to_email]
+                to_primary = to_email
+
+            return {
+                'doc_id': doc_id,
+                'doc_ref': doc_ref,
+                'to_primary': to_primary,
+                'subject': subject,
+                'html': html_content,
+                'to_resolved': to_resolved,
+                # Idempotency hash
+                'message_hash': self._message_hash(subject, html_content, to_resolved),
+                'content_hash': self._content_hash(subject, html_content),
+                'attempts': attempts,
+                'priority': self.priority_map.get(doc_data.get('type'), DEFAULT_CLASS),
+                'state': state,
+            }
+        except Exception as e:
+            logger.error(f"Error processing document {doc_id}: {str(e)}")
+            self._update_agent_error(doc_ref, 'EXCEPTION', str(e), attempts=attempts)
+            return None
+
+    def _in_my_shard(self, doc_id, smtp_agent, doc_data):
+        """
+        Whether this instance should handle doc_id
+
+        Documents hash to one of shard_count shards. Another shard's document is
+        taken over once it has gone untouched for SHARD_TAKEOVER_SECONDS, so work
+        still drains if its owner is down.
+        """
+        if self.shard_count <= 1 or shard_of(doc_id, self.shard_count) == self.shard_index:
+            return True
+        touched = smtp_agent.get('lastUpdatedAt') or doc_data.get('createdAt')
+        if not isinstance(touched, datetime):
+            return False
+        return (datetime.now(timezone.utc) - touched).total_seconds() > config.SHARD_TAKEOVER_SECONDS
 
     def _update_document_status(self, doc_ref, result: Dict[str, Any]):
         """
@@ -224,46 +815,40 @@ class FirestoreListener:
         except Exception as e:
             logger.error(f"Failed to update document {doc_ref.id}: {str(e)}")
 
-    def _set_processing(self, doc_ref, start_ts):
-        try:
-            doc_ref.update({
-                'smtpAgent': {
-                    'version': self.version,
-                    'host': self.host,
-                    'pid': self.pid,
-                    'state': 'PROCESSING',
-                    'lastUpdatedAt': firestore.SERVER_TIMESTAMP,
-                    'processing': {
-                        'by': f"{self.host}:{self.pid}",
-                        'leaseExpireTime': firestore.SERVER_TIMESTAMP
-                    },
-                    'lastAttempt': {
-                        'startTime': start_ts
-                    }
-                }
-            })
-        except Exception as e:
-            logger.warning(f"Failed to set processing state: {e}")
+    def _claim_processing(self, doc_ref, start_ts):
+        """Transactionally mark the document PROCESSING under a lease held by this instance."""
+        return self.leases.claim(doc_ref, self._claim_fields(start_ts))
 
-    def _update_agent_result(self, doc_ref, result: Dict[str, Any], to_resolved, message_hash: str):
+    def _claim_fields(self, start_ts):
+        # Dotted paths keep attempts/nextRetryAt; updating 'smtpAgent' as a whole would replace the map
+        return {
+            'smtpAgent.version': self.version,
+            'smtpAgent.host': self.host,
+            'smtpAgent.pid': self.pid,
+            'smtpAgent.lastUpdatedAt': firestore.SERVER_TIMESTAMP,
+            'smtpAgent.lastAttempt': {
+                'startTime': start_ts
+            }
+        }
+
+    def _update_agent_result(self, doc_ref, result: Dict[str, Any], to_resolved, message_hash: str, attempts: int = 0):
         try:
             success = result.get('success')
             state = 'SENT' if success else 'ERROR'
             error_msg = result.get('error')
-            # Compute nextRetryAt for failures with exponential backoff
-            next_retry = None
-            if not success:
-                # Fetch existing attempts count by increment intention (best-effort)
-                # Backoff: 60s * 2^min(attempts, 6) capped around ~1h
-                try:
-                    # We cannot read attempts atomically here without a read; use a simple progression
-                    base_seconds = 60
-                    # approximate attempts from previous value + 1 after this update
-                    # let attempts grow indirectly via Increment; schedule next attempt conservatively
-                    backoff_seconds = base_seconds * 2
-                except Exception:
-                    backoff_seconds = 120
-                next_retry = datetime.now(timezone.utc) + timedelta(seconds=backoff_seconds)
+            throttled = bool(result.get('throttled'))
+            if success:
+                next_retry = None
+                DOCS_SENT.inc()
+                if self.idempotency.enabled:
+                    self.idempotency.record(message_hash, doc_ref.id)
+            elif throttled:
+                # Provider asked us to slow down: retry once the limiter has cooled off,
+                # without spending one of the message's attempts
+                next_retry = datetime.now(timezone.utc) + timedelta(seconds=self.smtp_sender.rate_limiter.retry_after())
+            else:
+                # Exponential backoff based on the attempt count including this one
+                next_retry = next_retry_time(attempts + 1)
             update_payload = {
                 'smtpAgent': {
                     'version': self.version,
@@ -271,19 +856,19 @@ class FirestoreListener:
                     'pid': self.pid,
                     'state': state,
                     'lastUpdatedAt': firestore.SERVER_TIMESTAMP,
-                    'attempts': firestore.Increment(1),
+                    'attempts': firestore.Increment(0 if throttled else 1),
                     'lastSuccessAt': firestore.SERVER_TIMESTAMP if success else None,
                     'nextRetryAt': None if success else next_retry,
                     'lastAttempt': {
                         'endTime': firestore.SERVER_TIMESTAMP,
                         'success': success,
-                        'errorCode': None if success else 'SMTP',
+                        'errorCode': None if success else ('SMTP_THROTTLED' if throttled else 'SMTP'),
                         'errorMessage': None if success else (str(error_msg)[:300] if error_msg else None),
-                        'smtpResponse': None,
+                        'smtpResponse': result.get('smtpCode'),
                         'toResolved': to_resolved,
                     },
                     'processing': {
-                        'by': f"{self.host}:{self.pid}",
+                        'by': self.owner,
                         'leaseExpireTime': None
                     },
                     'idempotency': {
@@ -298,16 +883,19 @@ class FirestoreListener:
                     }
                 }
             }
-            doc_ref.set(update_payload, merge=True)
+            self.writer.set(doc_ref, update_payload, merge=True)
+            self.stats.record(state if success else self._failure_outcome(attempts, throttled))
+            if next_retry is not None:
+                self._schedule_retry(doc_ref.id, next_retry)
             logger.info(f"Updated smtpAgent for {doc_ref.id}: state={state}")
         except Exception as e:
             logger.error(f"Failed to update smtpAgent result for {doc_ref.id}: {e}")
 
-    def _update_agent_error(self, doc_ref, code: str, message: str):
+    def _update_agent_error(self, doc_ref, code: str, message: str, attempts: int = 0):
         try:
             # schedule a retry with backoff
-            next_retry = datetime.now(timezone.utc) + timedelta(seconds=120)
-            doc_ref.set({
+            next_retry = next_retry_time(attempts + 1)
+            self.writer.set(doc_ref, {
                 'smtpAgent': {
                     'version': self.version,
                     'host': self.host,
@@ -323,15 +911,31 @@ class FirestoreListener:
                         'errorMessage': (message or '')[:300]
                     },
                     'processing': {
-                        'by': f"{self.host}:{self.pid}",
+                        'by': self.owner,
                         'leaseExpireTime': None
                     }
                 }
             }, merge=True)
+            self.stats.record(self._failure_outcome(attempts))
+            self._schedule_retry(doc_ref.id, next_retry)
         except Exception as e:
             logger.error(f"Failed to update smtpAgent error for {doc_ref.id}: {e}")
 
-    def _update_agent_state(self, doc_ref, state: str, reason: str = None):
+    def _failure_outcome(self, attempts, throttled=False):
+        """Stats outcome of a failed attempt: ERROR once it was the last one allowed, else RETRY."""
+        if not throttled and attempts + 1 >= self.max_retry_count:
+            return 'ERROR'
+        return 'RETRY'
+
+    def _schedule_retry(self, doc_id, next_retry):
+        if self.retry_scheduler is not None:
+            self.retry_scheduler.schedule(doc_id, next_retry)
+
+    def _on_requeue(self, doc_id):
+        """Lease reaper callback: send a reclaimed document now (or with the next poll)."""
+        self._schedule_retry(doc_id, None)
+
+    def _update_agent_state(self, doc_ref, state: str, reason: str = None, code: str = 'SKIP', extra: Dict[str, Any] = None):
         try:
             payload = {
                 'smtpAgent': {
@@ -346,13 +950,24 @@ class FirestoreListener:
                 payload['smtpAgent']['lastAttempt'] = {
                     'endTime': firestore.SERVER_TIMESTAMP,
                     'success': False,
-                    'errorCode': 'SKIP',
+                    'errorCode': code,
                     'errorMessage': reason
                 }
-            doc_ref.set(payload, merge=True)
+            if extra:
+                payload['smtpAgent'].update(extra)
+            self.writer.set(doc_ref, payload, merge=True)
+            self.stats.record(state)
         except Exception as e:
             logger.error(f"Failed to set smtpAgent state for {doc_ref.id}: {e}")
 
+    def _content_hash(self, subject: str, html: str):
+        """Hash of the message body alone; documents sharing it can be sent as a group."""
+        h = hashlib.sha256()
+        h.update((subject or '').encode('utf-8'))
+        h.update(b'\0')
+        h.update((html or '').encode('utf-8'))
+        return h.hexdigest()[:16]
+
     def _message_hash(self, subject: str, html: str, to_list):
         h = hashlib.sha256()
         h.update((subject or '').encode('utf-8'))
@@ -360,24 +975,26 @@ class FirestoreListener:
         h.update(('|'.join(sorted(to_list))).encode('utf-8'))
         return h.hexdigest()[:16]
 
-    def _load_overrides(self):
-        """Load admin config overrides from Firestore and apply live."""
-        try:
-            snap = self.db.document('admin/smtpAgentConfig').get()
-            data = snap.to_dict() if snap.exists else {}
-        except Exception:
-            data = {}
-        # pollInterval
+    def _load_overrides(self, data=None):
+        """Apply admin config overrides live (from the config cache unless data is given)."""
+        if data is None:
+            try:
+                data = self.config_provider.get()
+            except Exception:
+                data = {}
+        # pollIntervalMin / pollIntervalMax (pollInterval is the fallback for the max)
         try:
             pi = int(data.get('pollInterval')) if data and data.get('pollInterval') is not None else None
-            if pi and pi > 0:
-                if pi != self.poll_interval:
-                    logger.info(f"Applying override: pollInterval {self.poll_interval} -> {pi}")
-                self.poll_interval = pi
-            else:
-                self.poll_interval = config.POLL_INTERVAL
+            pmax = int(data.get('pollIntervalMax')) if data and data.get('pollIntervalMax') is not None else None
+            pmin = int(data.get('pollIntervalMin')) if data and data.get('pollIntervalMin') is not None else None
+            ceiling = pmax if pmax and pmax > 0 else (pi if pi and pi > 0 else config.POLL_INTERVAL_MAX)
+            floor = pmin if pmin and pmin > 0 else config.POLL_INTERVAL_MIN
         except Exception:
-            self.poll_interval = config.POLL_INTERVAL
+            floor, ceiling = config.POLL_INTERVAL_MIN, config.POLL_INTERVAL_MAX
+        if (min(floor, ceiling), ceiling) != (self.poller.floor, self.poller.ceiling):
+            logger.info(f"Applying override: poll interval {self.poller.floor}-{self.poller.ceiling}s -> {min(floor, ceiling)}-{ceiling}s")
+        self.poller.configure(floor, ceiling)
+        self.poll_interval = self.poller.current
         # maxRetryCount
         try:
             mrc = int(data.get('maxRetryCount')) if data and data.get('maxRetryCount') is not None else None
@@ -389,6 +1006,32 @@ class FirestoreListener:
                 self.max_retry_count = config.MAX_RETRY_COUNT
         except Exception:
             self.max_retry_count = config.MAX_RETRY_COUNT
+        # maxConcurrentSends
+        try:
+            mcs = int(data.get('maxConcurrentSends')) if data and data.get('maxConcurrentSends') is not None else None
+            if mcs and mcs > 0:
+                if mcs != self.max_concurrent_sends:
+                    logger.info(f"Applying override: maxConcurrentSends {self.max_concurrent_sends} -> {mcs}")
+                self.max_concurrent_sends = mcs
+            else:
+                self.max_concurrent_sends = config.MAX_CONCURRENT_SENDS
+        except Exception:
+            self.max_concurrent_sends = config.MAX_CONCURRENT_SENDS
+        # maxSendsPerSecond / maxSendsPerConnectionPerSecond (0 = unlimited)
+        try:
+            rate = data.get('maxSendsPerSecond') if data else None
+            rate = float(rate) if rate is not None else config.RATE_LIMIT_PER_SECOND
+            conn_rate = data.get('maxSendsPerConnectionPerSecond') if data else None
+            conn_rate = float(conn_rate) if conn_rate is not None else config.RATE_LIMIT_PER_CONNECTION
+            self.smtp_sender.rate_limiter.configure(max(0.0, rate), max(0.0, conn_rate))
+        except Exception:
+            self.smtp_sender.rate_limiter.configure(config.RATE_LIMIT_PER_SECOND, config.RATE_LIMIT_PER_CONNECTION)
+        # priorityMap ({type: 'high' | 'normal' | 'bulk'}, merged over the defaults)
+        try:
+            pm = data.get('priorityMap') if data else None
+            self.priority_map = build_priority_map(pm if isinstance(pm, dict) else None)
+        except Exception:
+            self.priority_map = build_priority_map()
         # processFromAfter
         try:
             pfa = (data.get('processFromAfter') or '').strip() if data else ''
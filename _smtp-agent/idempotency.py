@@ -0,0 +1,139 @@
+"""
+Index of recently delivered message hashes, used to skip duplicate sends
+"""
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+
+import config
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('idempotency')
+
+
+def index_collection(db):
+    """admin/smtpAgentIdempotency/hashes/{messageHash}: one small document per delivered message."""
+    return db.collection('admin').document('smtpAgentIdempotency').collection('hashes')
+
+
+class IdempotencyIndex:
+    """
+    Which message hashes (subject, html, recipients) were delivered recently
+
+    Lookups are answered from an in-memory LRU of IDEMPOTENCY_CACHE_SIZE
+    entries; misses are read from the index collection in one get_all, which
+    also covers restarts and other instances. Every delivery is recorded in
+    both. Index documents carry an expireAt field so a Firestore TTL policy
+    can prune them.
+
+    Hashes of messages being sent right now are reserved, so an identical
+    copy waits for the first one's result instead of racing it.
+    """
+    def __init__(self, db, writer, window=None, capacity=None):
+        self.db = db
+        self.writer = writer
+        self.window = config.IDEMPOTENCY_WINDOW if window is None else window
+        self.capacity = max(1, capacity or config.IDEMPOTENCY_CACHE_SIZE)
+        self.collection = index_collection(db)
+        self._lru = OrderedDict()  # message hash -> (delivered_at, doc_id)
+        self._reserved = set()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def reserve(self, message_hash):
+        """Mark message_hash as being sent; False if another send of it is in progress."""
+        with self._lock:
+            if message_hash in self._reserved:
+                return False
+            self._reserved.add(message_hash)
+            return True
+
+    def release(self, message_hash):
+        with self._lock:
+            self._reserved.discard(message_hash)
+
+    def cached(self, hashes):
+        """
+        Answer what the LRU can
+
+        Returns:
+            tuple: ({hash: (delivered_at, doc_id)} delivered within the window, [hashes to look up])
+        """
+        now = datetime.now(timezone.utc)
+        delivered, unknown = {}, []
+        with self._lock:
+            for message_hash in dict.fromkeys(hashes):
+                entry = self._lru.get(message_hash)
+                if entry is not None and self._fresh(entry, now):
+                    self._lru.move_to_end(message_hash)
+                    delivered[message_hash] = entry
+                else:
+                    unknown.append(message_hash)
+        return delivered, unknown
+
+    def lookup(self, hashes):
+        """{hash: (delivered_at, doc_id)} for the hashes delivered within the window."""
+        delivered, unknown = self.cached(hashes)
+        if unknown:
+            try:
+                snaps = self.db.get_all([self.collection.document(h) for h in unknown])
+                delivered.update(self._absorb(snaps))
+            except Exception as e:
+                # Fail open: a missed duplicate is better than a missed email
+                logger.warning(f"Idempotency lookup failed: {e}")
+        return delivered
+
+    async def lookup_async(self, async_db, hashes):
+        """lookup() through the async Firestore client."""
+        delivered, unknown = self.cached(hashes)
+        if unknown:
+            try:
+                collection = index_collection(async_db)
+                snaps = [snap async for snap in async_db.get_all([collection.document(h) for h in unknown])]
+                delivered.update(self._absorb(snaps))
+            except Exception as e:
+                logger.warning(f"Idempotency lookup failed: {e}")
+        return delivered
+
+    def record(self, message_hash, doc_id):
+        """Remember that doc_id delivered message_hash just now."""
+        now = datetime.now(timezone.utc)
+        self._remember(message_hash, (now, doc_id))
+        self.writer.set(self.collection.document(message_hash), {
+            'docId': doc_id,
+            'deliveredAt': now,
+            'expireAt': now + timedelta(seconds=self.window),
+        })
+
+    def _absorb(self, snaps):
+        now = datetime.now(timezone.utc)
+        found = {}
+        for snap in snaps:
+            if not snap.exists:
+                continue
+            data = snap.to_dict() or {}
+            entry = (data.get('deliveredAt'), data.get('docId'))
+            if self._fresh(entry, now):
+                self._remember(snap.id, entry)
+                found[snap.id] = entry
+        return found
+
+    def _remember(self, message_hash, entry):
+        with self._lock:
+            self._lru[message_hash] = entry
+            self._lru.move_to_end(message_hash)
+            while len(self._lru) > self.capacity:
+                self._lru.popitem(last=False)
+
+    def _fresh(self, entry, now):
+        delivered_at = entry[0]
+        return isinstance(delivered_at, datetime) and (now - delivered_at).total_seconds() < self.window
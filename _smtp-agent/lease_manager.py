@@ -0,0 +1,172 @@
+"""
+Lease manager for claiming mail documents safely across agent instances
+"""
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone, timedelta
+
+from firebase_admin import firestore
+
+import config
+from send_scheduler import parse_send_at
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('lease_manager')
+
+
+def claim_update(snap, owner, fields, lease_until):
+    """
+    Update that claims the document read in snap, or None if it may not be claimed
+
+    A document is not claimable when it is finished, not yet due, or leased by
+    someone else. Shared by the threaded and the asyncio claim transactions.
+    """
+    if not snap.exists:
+        return None
+    data = snap.to_dict() or {}
+    sa = data.get('smtpAgent', {}) or {}
+    state = sa.get('state')
+    now = datetime.now(timezone.utc)
+    if state in ('SENT', 'SKIPPED'):
+        return None
+    next_retry_at = sa.get('nextRetryAt')
+    if state == 'ERROR' and isinstance(next_retry_at, datetime) and next_retry_at > now:
+        return None
+    send_at = parse_send_at(data.get('sendAt'))
+    if send_at is not None and send_at > now:
+        return None
+    if state == 'PROCESSING':
+        # A live lease blocks everyone, this instance included: its own lease on a
+        # document it is no longer sending means the result write is still queued
+        expires = (sa.get('processing', {}) or {}).get('leaseExpireTime')
+        if isinstance(expires, datetime) and expires > now:
+            return None
+    payload = dict(fields)
+    payload['smtpAgent.state'] = 'PROCESSING'
+    payload['smtpAgent.processing'] = {
+        'by': owner,
+        'claimedAt': firestore.SERVER_TIMESTAMP,
+        'leaseExpireTime': lease_until,
+    }
+    return payload
+
+
+@firestore.transactional
+def _claim_in_transaction(transaction, doc_ref, owner, fields, lease_until):
+    """Claim doc_ref unless it is finished, not yet due, or leased by someone else."""
+    payload = claim_update(doc_ref.get(transaction=transaction), owner, fields, lease_until)
+    if payload is None:
+        return False
+    transaction.update(doc_ref, payload)
+    return True
+
+
+class LeaseManager:
+    """
+    Transactional document claims with a real lease duration
+
+    A claim succeeds only if the document is not finished and not held by a
+    live lease (this instance's own included); expired leases are reclaimed. Leases of
+    documents still being sent are renewed in the background every third of
+    the lease duration.
+    """
+    def __init__(self, db, owner, writer, lease_seconds=None):
+        self.db = db
+        self.owner = owner
+        self.writer = writer
+        self.lease_seconds = lease_seconds or config.LEASE_SECONDS
+        self._held = {}  # doc_id -> doc_ref
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.claims = 0
+        self.claim_conflicts = 0
+
+    def lease_until(self):
+        return datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)
+
+    def claim(self, doc_ref, fields):
+        """
+        Atomically mark doc_ref PROCESSING for this instance
+
+        Args:
+            doc_ref: Firestore document reference
+            fields: Extra dotted-path fields written with the claim
+
+        Returns:
+            bool: True if this instance now holds the lease
+        """
+        try:
+            ok = _claim_in_transaction(self.db.transaction(), doc_ref, self.owner, fields, self.lease_until())
+        except Exception as e:
+            logger.warning(f"Claim of {doc_ref.id} failed: {e}")
+            ok = False
+        return self.record_claim(doc_ref, ok)
+
+    def record_claim(self, doc_ref, ok):
+        """Track the outcome of a claim made by claim() or by an async caller."""
+        if ok:
+            with self._lock:
+                self._held[doc_ref.id] = doc_ref
+                self.claims += 1
+            self._ensure_renewer()
+        else:
+            with self._lock:
+                self.claim_conflicts += 1
+            logger.debug(f"Not claimed {doc_ref.id}: finished, not due or leased elsewhere")
+        return ok
+
+    def release(self, doc_id):
+        """Stop renewing doc_id; the result write clears the lease itself."""
+        with self._lock:
+            self._held.pop(doc_id, None)
+
+    def relinquish(self, doc_ref):
+        """Give up a claim that was never acted on: stop renewing and expire the lease now."""
+        self.release(doc_ref.id)
+        self.writer.update(doc_ref, {
+            'smtpAgent.processing.leaseExpireTime': None,
+            'smtpAgent.lastUpdatedAt': firestore.SERVER_TIMESTAMP,
+        })
+
+    def held(self):
+        with self._lock:
+            return list(self._held.values())
+
+    def renew_all(self):
+        """Push the lease of every held document forward."""
+        lease_until = self.lease_until()
+        for doc_ref in self.held():
+            self.writer.update(doc_ref, {'smtpAgent.processing.leaseExpireTime': lease_until})
+
+    def stop(self):
+        self._stop.set()
+
+    def _ensure_renewer(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="lease-renewer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        interval = max(1.0, self.lease_seconds / 3.0)
+        while not self._stop.wait(interval):
+            try:
+                self.renew_all()
+            except Exception as e:
+                logger.warning(f"Lease renewal failed: {e}")
+
+
+def shard_of(doc_id, shard_count):
+    """Stable shard number of a document id."""
+    digest = hashlib.md5(doc_id.encode('utf-8')).hexdigest()
+    return int(digest, 16) % shard_count
@@ -0,0 +1,190 @@
+"""
+Lease reaper: requeue documents left in PROCESSING by a crashed sender
+"""
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from firebase_admin import firestore
+
+import config
+import metrics
+from utils import iter_query_pages
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('lease_reaper')
+
+LEASES_RECLAIMED = metrics.counter(
+    'smtp_agent_leases_reclaimed_total', 'PROCESSING documents requeued after their lease expired', ('kind',))
+_RECLAIMED_EXPIRED = LEASES_RECLAIMED.labels('expired')
+_RECLAIMED_RELEASED = LEASES_RECLAIMED.labels('released')
+
+
+@firestore.transactional
+def _reclaim_in_transaction(transaction, doc_ref, owner):
+    """
+    Requeue doc_ref if it is still PROCESSING under an expired lease
+
+    An expired lease counts as a lost attempt: the document goes back to
+    ERROR with attempts + 1, due now. A lease cleared without a result (a
+    claim handed back on shutdown) was never attempted and goes back to
+    PENDING.
+
+    Returns:
+        The live lease expiry if the lease was renewed meanwhile, 'expired' or
+        'released' if the document was requeued, None if it is no longer PROCESSING
+    """
+    snap = doc_ref.get(transaction=transaction)
+    if not snap.exists:
+        return None
+    sa = (snap.to_dict() or {}).get('smtpAgent', {}) or {}
+    if sa.get('state') != 'PROCESSING':
+        return None
+    now = datetime.now(timezone.utc)
+    processing = sa.get('processing', {}) or {}
+    expires = processing.get('leaseExpireTime')
+    if isinstance(expires, datetime) and expires > now:
+        return expires
+    update = {
+        'smtpAgent.lastUpdatedAt': firestore.SERVER_TIMESTAMP,
+        'smtpAgent.processing.leaseExpireTime': None,
+        'smtpAgent.processing.reclaimedBy': owner,
+    }
+    if expires is None:
+        update['smtpAgent.state'] = 'PENDING'
+        transaction.update(doc_ref, update)
+        return 'released'
+    update.update({
+        'smtpAgent.state': 'ERROR',
+        'smtpAgent.attempts': firestore.Increment(1),
+        'smtpAgent.nextRetryAt': now,
+        'smtpAgent.lastAttempt.endTime': firestore.SERVER_TIMESTAMP,
+        'smtpAgent.lastAttempt.success': False,
+        'smtpAgent.lastAttempt.errorCode': 'LEASE_EXPIRED',
+        'smtpAgent.lastAttempt.errorMessage': f"Lease held by {processing.get('by')} expired at {expires.isoformat()}",
+    })
+    transaction.update(doc_ref, update)
+    return 'expired'
+
+
+class LeaseReaper:
+    """
+    Min-heap of (leaseExpireTime, docId) for documents in PROCESSING
+
+    Every LEASE_REAP_INTERVAL seconds the PROCESSING documents are listed
+    (an equality query returning only those, whatever the size of the
+    collection) and their lease expiries indexed. A background thread sleeps
+    until the earliest lease runs out and reclaims it transactionally, so a
+    document abandoned by a crashed instance is requeued within
+    LEASE_SECONDS + LEASE_REAP_INTERVAL. Documents this instance is still
+    sending are left alone; requeued ones are handed to on_requeue.
+    """
+    def __init__(self, db, collection, leases, on_requeue, interval=None):
+        self.db = db
+        self.collection = collection
+        self.leases = leases
+        self.on_requeue = on_requeue
+        self.interval = interval or config.LEASE_REAP_INTERVAL
+        self._heap = []
+        self._expiry = {}  # doc_id -> lease expiry timestamp; heap entries not matching are stale
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.reclaimed = 0
+
+    def track(self, doc_id, expires):
+        """Index doc_id's lease expiry; None (no lease) means reclaimable now."""
+        expires_ts = expires.timestamp() if isinstance(expires, datetime) else time.time()
+        with self._lock:
+            if self._expiry.get(doc_id) == expires_ts:
+                return
+            self._expiry[doc_id] = expires_ts
+            heapq.heappush(self._heap, (expires_ts, doc_id))
+
+    def tracked(self):
+        with self._lock:
+            return len(self._expiry)
+
+    def scan(self):
+        """Re-index every PROCESSING document's lease expiry."""
+        count = 0
+        try:
+            query = self.collection.where('smtpAgent.state', '==', 'PROCESSING')
+            query = query.select(['smtpAgent.processing.leaseExpireTime'])
+            for page in iter_query_pages(query, config.QUERY_PAGE_SIZE):
+                for snap in page:
+                    sa = (snap.to_dict() or {}).get('smtpAgent', {}) or {}
+                    self.track(snap.id, (sa.get('processing', {}) or {}).get('leaseExpireTime'))
+                    count += 1
+        except Exception as e:
+            logger.error(f"Failed to scan PROCESSING leases: {e}")
+        logger.debug(f"{count} PROCESSING documents indexed")
+        return count
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="lease-reaper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def reap_due(self):
+        """Reclaim every indexed lease that has run out."""
+        held = {doc_ref.id for doc_ref in self.leases.held()}
+        for doc_id in self._take_due():
+            if doc_id in held:
+                # Still being sent here; the renewer keeps its lease current
+                continue
+            try:
+                outcome = _reclaim_in_transaction(self.db.transaction(), self.collection.document(doc_id), self.leases.owner)
+            except Exception as e:
+                logger.warning(f"Reclaim of {doc_id} failed: {e}")
+                continue
+            if isinstance(outcome, datetime):
+                self.track(doc_id, outcome)
+            elif outcome is not None:
+                (_RECLAIMED_EXPIRED if outcome == 'expired' else _RECLAIMED_RELEASED).inc()
+                self.reclaimed += 1
+                logger.info(f"Requeued {doc_id}: lease {outcome}")
+                self.on_requeue(doc_id)
+
+    def _take_due(self):
+        now = time.time()
+        ids = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expires_ts, doc_id = heapq.heappop(self._heap)
+                if self._expiry.get(doc_id) == expires_ts:
+                    del self._expiry[doc_id]
+                    ids.append(doc_id)
+        return ids
+
+    def _next_expiry(self):
+        with self._lock:
+            while self._heap and self._expiry.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def _run(self):
+        next_scan = 0.0
+        while not self._stop.is_set():
+            try:
+                if time.time() >= next_scan:
+                    self.scan()
+                    next_scan = time.time() + self.interval
+                self.reap_due()
+            except Exception as e:
+                logger.error(f"Lease reaper failed: {e}")
+            wake = next_scan
+            expiry = self._next_expiry()
+            if expiry is not None:
+                wake = min(wake, expiry)
+            self._stop.wait(max(1.0, wake - time.time()))
@@ -9,33 +9,47 @@ This script starts the Firebase SMTP Agent, which:
 4. Updates document status in Firestore
 """
 import logging
+import logging.handlers
 import os
 import sys
 import signal
-import time
 
 import config
 from firestore_listener import FirestoreListener
 from admin_app.server import run_admin_background
 
-# Configure logging to both file and console
+# Configure logging to both file and console. The file rotates by size so it
+# stays cheap to tail; force replaces the plain handlers installed by the
+# basicConfig calls of the modules imported above.
 logging.basicConfig(
     level=getattr(logging, config.LOG_LEVEL),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler(config.LOG_FILE) if config.LOG_FILE else logging.NullHandler(),
+        logging.handlers.RotatingFileHandler(
+            config.LOG_FILE,
+            maxBytes=config.LOG_MAX_BYTES,
+            backupCount=config.LOG_BACKUP_COUNT,
+        ) if config.LOG_FILE else logging.NullHandler(),
         logging.StreamHandler(sys.stdout)
-    ]
+    ],
+    force=True
 )
 logger = logging.getLogger('main')
 
+# Delivery engine, once constructed; the signal handler drains it
+listener = None
+
 def signal_handler(sig, frame):
     """Handle termination signals gracefully"""
     logger.info("Received termination signal. Shutting down...")
-    sys.exit(0)
+    if listener is None:
+        sys.exit(0)
+    # The engine's loop drains in-flight sends and returns from start_listening
+    listener.shutdown.request(signal.Signals(sig).name)
 
 def main():
     """Main entry point for the SMTP agent"""
+    global listener
     logger.info("Starting Firebase SMTP Agent")
     
     # Log configuration
@@ -43,6 +57,7 @@ def main():
     logger.info(f"Firebase Service Account: {config.FIREBASE_SERVICE_ACCOUNT_PATH}")
     logger.info(f"Monitoring collection: {config.MAIL_COLLECTION}")
     logger.info(f"Poll interval: {config.POLL_INTERVAL} seconds")
+    logger.info(f"Delivery engine: {config.ENGINE}")
     
     # Check for service account file
     if not os.path.exists(config.FIREBASE_SERVICE_ACCOUNT_PATH):
@@ -63,7 +78,11 @@ def main():
     
     try:
         # Initialize and start the Firestore listener
-        listener = FirestoreListener()
+        if config.ENGINE == 'asyncio':
+            from async_engine import AsyncDeliveryEngine
+            listener = AsyncDeliveryEngine()
+        else:
+            listener = FirestoreListener()
         listener.start_listening()
     except Exception as e:
         logger.error(f"Fatal error: {str(e)}")
@@ -0,0 +1,234 @@
+"""
+In-process metrics rendered in the Prometheus text exposition format
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; covers a fast local relay up to a slow remote DATA phase
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **kwargs):
+        """Child metric for one label combination (created on first use)."""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        return self.labels() if not self.labelnames else None
+
+    def _samples(self):
+        with self._lock:
+            children = sorted(self._children.items())
+        for key, child in children:
+            yield from child._samples(self.name, self.labelnames, key)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class _CounterChild:
+    __slots__ = ('_value', '_lock')
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def _samples(self, name, labelnames, key):
+        yield f'{name}{_format_labels(labelnames, key)} {_format_value(self._value)}'
+
+
+class Counter(_Metric):
+    """Monotonic counter; by convention the name ends in _total."""
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ('_value', '_fn')
+
+    def __init__(self):
+        self._value = 0.0
+        self._fn = None
+
+    def set(self, value):
+        # A single attribute store; no lock needed
+        self._value = value
+
+    def set_function(self, fn):
+        """Read the value from fn() at scrape time instead of storing it."""
+        self._fn = fn
+
+    def get(self):
+        """Current value, or None if the value function fails or has nothing to report."""
+        if self._fn is None:
+            return self._value
+        try:
+            return self._fn()
+        except Exception:
+            return None
+
+    def _samples(self, name, labelnames, key):
+        value = self.get()
+        if value is None:
+            return
+        yield f'{name}{_format_labels(labelnames, key)} {_format_value(value)}'
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, fn):
+        self._default().set_function(fn)
+
+    def get(self):
+        return self._default().get()
+
+
+class _HistogramChild:
+    __slots__ = ('_bounds', '_counts', '_sum', '_lock')
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        # Bucket search happens outside the lock; the critical section is two adds
+        i = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def _samples(self, name, labelnames, key):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        for bound, count in zip(self._bounds + (float('inf'),), counts):
+            cumulative += count
+            le = ('le', _format_value(bound))
+            yield f'{name}_bucket{_format_labels(labelnames, key, le)} {cumulative}'
+        yield f'{name}_sum{_format_labels(labelnames, key)} {_format_value(total)}'
+        yield f'{name}_count{_format_labels(labelnames, key)} {cumulative}'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+class Registry:
+    """Named metrics; registering an existing name returns the existing metric."""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, documentation, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, documentation, **kwargs)
+                self._metrics[name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames=labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames=labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames=labelnames, buckets=buckets)
+
+    def get(self, name):
+        """The metric registered under name, or None."""
+        with self._lock:
+            return self._metrics.get(name)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
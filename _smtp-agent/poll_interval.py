@@ -0,0 +1,33 @@
+"""
+Adaptive poll interval driven by queue activity
+"""
+
+
+class AdaptivePollInterval:
+    """
+    Seconds the listener waits before its next poll cycle
+
+    A cycle that found documents to send drops the interval to the floor,
+    so while mail is flowing it is picked up quickly; each idle cycle
+    doubles it, up to the ceiling, so an empty queue costs few reads.
+    Starts at the floor. floor == ceiling gives a fixed interval.
+    """
+    def __init__(self, floor, ceiling):
+        self.floor = self.ceiling = self.current = None
+        self.configure(floor, ceiling)
+
+    def configure(self, floor, ceiling):
+        """Set the bounds, keeping the current interval within them."""
+        self.ceiling = max(1, ceiling)
+        self.floor = max(1, min(floor, self.ceiling))
+        if self.current is None:
+            self.current = self.floor
+        self.current = min(max(self.current, self.floor), self.ceiling)
+
+    def update(self, found_work):
+        """Interval after a cycle that did (or did not) find work."""
+        if found_work:
+            self.current = self.floor
+        else:
+            self.current = min(self.ceiling, self.current * 2)
+        return self.current
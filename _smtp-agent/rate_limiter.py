@@ -0,0 +1,222 @@
+"""
+Rate limiting for outgoing SMTP traffic
+"""
+import logging
+import random
+import threading
+import time
+
+import config
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('rate_limiter')
+
+# SMTP replies that mean "slow down" rather than "this message is bad"
+THROTTLE_CODES = (421, 451, 452)
+# Seconds over which the achieved send rate is measured
+RATE_WINDOW_SECONDS = 5.0
+
+
+class TokenBucket:
+    """
+    Classic token bucket; rate <= 0 means unlimited
+    """
+    def __init__(self, rate, burst=None):
+        self._lock = threading.Lock()
+        self.rate = 0.0
+        self.burst = 1.0
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self.set_rate(rate, burst)
+        self._tokens = self.burst
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self._refill()
+            self.rate = float(rate or 0)
+            self.burst = float(burst or max(1.0, self.rate))
+            self._tokens = min(self._tokens, self.burst)
+
+    def acquire(self):
+        """Block until a token is available."""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """Take a token if one is available; otherwise return the seconds until one is."""
+        with self._lock:
+            if self.rate <= 0:
+                return 0.0
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class AdaptiveRateLimiter:
+    """
+    Global send rate limit that adapts to provider throttling
+
+    A throttling reply (421/451/452) halves the current rate and pauses all
+    sends for a short cool-down. Replies that arrive during the cool-down or
+    within ramp_interval of the last decrease belong to the same congestion
+    event and are only counted, so concurrent sessions throttled together
+    cause one decrease. The cool-down doubles (up to a max) only when
+    throttling comes back after a ramp-up. After ramp_interval seconds without
+    throttling the rate climbs back by a tenth of max_rate per interval until
+    it reaches max_rate again (AIMD). Without a max_rate (unlimited) the
+    first throttling reply halves the rate actually being achieved, and the
+    limit is lifted again once the ramp gets back to that rate. Per-connection
+    buckets cap how fast a single SMTP session is driven.
+    """
+    def __init__(self, max_rate=None, per_connection_rate=None):
+        self._lock = threading.Lock()
+        self.max_rate = float(config.RATE_LIMIT_PER_SECOND if max_rate is None else max_rate)
+        self.per_connection_rate = float(config.RATE_LIMIT_PER_CONNECTION if per_connection_rate is None else per_connection_rate)
+        self.min_rate = config.RATE_LIMIT_MIN_PER_SECOND
+        self.ramp_interval = config.RATE_LIMIT_RAMP_INTERVAL
+        self.current_rate = self.max_rate
+        self._bucket = TokenBucket(self.current_rate)
+        self._pause_until = 0.0
+        self._pause = config.RATE_LIMIT_PAUSE_SECONDS
+        self._last_change = time.monotonic()
+        self._last_decrease = None
+        self._ramped = False  # ramped up since the last decrease
+        self.throttle_events = 0
+        # Unlimited mode: rate the ramp climbs back to before the limit is lifted
+        self._ceiling = 0.0
+        self._window_start = self._last_change
+        self._window_sent = 0
+        self._observed_rate = 0.0
+
+    def configure(self, max_rate, per_connection_rate):
+        """Apply new limits (e.g. from admin/smtpAgentConfig)."""
+        with self._lock:
+            max_rate = float(max_rate or 0)
+            per_connection_rate = float(per_connection_rate or 0)
+            if max_rate != self.max_rate:
+                logger.info(f"Send rate limit {self.max_rate} -> {max_rate}/s")
+                self.max_rate = max_rate
+                self._ceiling = 0.0
+                if max_rate <= 0 or self.current_rate <= 0:
+                    self.current_rate = max_rate
+                else:
+                    self.current_rate = min(self.current_rate, max_rate)
+                self._bucket.set_rate(self.current_rate)
+            self.per_connection_rate = per_connection_rate
+
+    def connection_bucket(self):
+        """A fresh bucket for one pooled SMTP session, or None when unlimited."""
+        if self.per_connection_rate <= 0:
+            return None
+        return TokenBucket(self.per_connection_rate)
+
+    def acquire(self):
+        """Block until the next message may be sent."""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """
+        Non-blocking acquire for callers that wait on their own (e.g. asyncio)
+
+        Returns 0 when the message may be sent now, otherwise the seconds to
+        wait before asking again.
+        """
+        with self._lock:
+            wait = self._pause_until - time.monotonic()
+        if wait > 0:
+            return wait
+        return self._bucket.try_acquire()
+
+    def on_success(self):
+        with self._lock:
+            now = time.monotonic()
+            self._measure(now)
+            target = self.max_rate if self.max_rate > 0 else self._ceiling
+            if self.current_rate <= 0 or self.current_rate >= target:
+                # Recovered: the next congestion event starts from the base cool-down
+                self._pause = config.RATE_LIMIT_PAUSE_SECONDS
+                self._ramped = False
+                return
+            if now - self._last_change >= self.ramp_interval:
+                self.current_rate = min(target, self.current_rate + max(target / 10.0, self.min_rate))
+                if self.max_rate <= 0 and self.current_rate >= target:
+                    # Back where throttling started: lift the limit again
+                    self.current_rate = 0.0
+                    self._ceiling = 0.0
+                self._last_change = now
+                self._ramped = True
+                self._bucket.set_rate(self.current_rate)
+                if self.current_rate > 0:
+                    logger.info(f"Send rate ramped up to {self.current_rate:.2f}/s")
+                else:
+                    logger.info("Send rate limit lifted")
+
+    def _measure(self, now):
+        """Count a send towards the achieved rate (caller holds the lock)."""
+        self._window_sent += 1
+        elapsed = now - self._window_start
+        if elapsed >= RATE_WINDOW_SECONDS:
+            self._observed_rate = self._window_sent / elapsed
+            self._window_start = now
+            self._window_sent = 0
+
+    def on_throttle(self, code):
+        with self._lock:
+            now = time.monotonic()
+            self.throttle_events += 1
+            if now < self._pause_until or (
+                    self._last_decrease is not None and now - self._last_decrease < self.ramp_interval):
+                # Same congestion event as the last decrease
+                return
+            if self._ramped:
+                # Throttled again after ramping up: back off for longer this time
+                self._pause = min(self._pause * 2, config.RATE_LIMIT_MAX_PAUSE_SECONDS)
+                self._ramped = False
+            if self.current_rate <= 0:
+                # Unlimited: halve the rate actually being achieved and ramp back up to it
+                elapsed = now - self._window_start
+                achieved = max(self._observed_rate, self._window_sent / elapsed if elapsed > 0 else 0.0)
+                self._ceiling = max(self.min_rate, achieved)
+                self.current_rate = self._ceiling
+            self.current_rate = max(self.min_rate, self.current_rate / 2.0)
+            self._bucket.set_rate(self.current_rate)
+            self._pause_until = now + self._pause
+            pause = self._pause
+            self._last_change = self._last_decrease = now
+        logger.warning(f"SMTP throttling ({code}); rate {self.current_rate:.2f}/s, pausing {pause}s")
+
+    def retry_after(self):
+        """Seconds a throttled message should wait before its retry."""
+        with self._lock:
+            pause = max(0.0, self._pause_until - time.monotonic())
+        return pause + self._pause * random.uniform(0.5, 1.5)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'maxRate': self.max_rate,
+                'currentRate': self.current_rate,
+                'perConnectionRate': self.per_connection_rate,
+                'throttleEvents': self.throttle_events,
+                'paused': self._pause_until > time.monotonic(),
+            }
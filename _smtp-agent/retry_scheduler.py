@@ -0,0 +1,183 @@
+"""
+Retry scheduler that wakes up when failed emails are due for another attempt
+"""
+import heapq
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+
+import config
+from utils import iter_query_pages
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('retry_scheduler')
+
+# Documents fetched per get_all() round trip
+FETCH_BATCH_SIZE = 100
+
+
+def compute_backoff(attempts: int) -> float:
+    """
+    Seconds to wait before the next attempt after `attempts` failures
+
+    Exponential: RETRY_BASE_SECONDS * 2^(attempts-1), capped at RETRY_MAX_SECONDS,
+    with +/- RETRY_JITTER relative jitter so failed bulk sends do not retry in lockstep.
+    """
+    attempts = max(1, int(attempts or 1))
+    delay = config.RETRY_BASE_SECONDS * (2 ** min(attempts - 1, 16))
+    delay = min(delay, config.RETRY_MAX_SECONDS)
+    jitter = config.RETRY_JITTER
+    if jitter > 0:
+        delay *= random.uniform(1 - jitter, 1 + jitter)
+    return max(1.0, delay)
+
+
+def next_retry_time(attempts: int) -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=compute_backoff(attempts))
+
+
+class RetryScheduler:
+    """
+    Min-heap of (nextRetryAt, docId) for documents in ERROR state
+
+    The heap is rebuilt from Firestore at startup and kept current by the
+    listener as it records failures. It is also re-synced every
+    RETRY_RESYNC_INTERVAL seconds, so failures written by other instances are
+    picked up here if their owner goes away. A background thread sleeps until
+    the earliest entry is due, fetches exactly those documents by id and
+    hands them to on_due.
+    """
+    def __init__(self, db, collection, on_due, resync_interval=None):
+        self.db = db
+        self.collection = collection
+        self.on_due = on_due
+        self.resync_interval = resync_interval or config.RETRY_RESYNC_INTERVAL
+        self._next_resync = time.monotonic() + self.resync_interval
+        self._heap = []
+        self._due = {}  # doc_id -> due timestamp; heap entries not matching are stale
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def rebuild(self, quiet=False):
+        """Load every ERROR document's nextRetryAt from Firestore; quiet re-syncs leave scheduled ids alone."""
+        self._next_resync = time.monotonic() + self.resync_interval
+        count = 0
+        try:
+            query = self.collection.where('smtpAgent.state', '==', 'ERROR')
+            query = query.select(['smtpAgent.nextRetryAt', 'smtpAgent.attempts'])
+            for page in iter_query_pages(query, config.QUERY_PAGE_SIZE):
+                for snap in page:
+                    sa = (snap.to_dict() or {}).get('smtpAgent', {}) or {}
+                    if quiet and self.scheduled(snap.id):
+                        # Re-sync: keep the time the listener set (e.g. a shard takeover delay)
+                        continue
+                    self.schedule(snap.id, sa.get('nextRetryAt'))
+                    count += 1
+        except Exception as e:
+            logger.error(f"Failed to rebuild retry schedule: {e}")
+        (logger.debug if quiet else logger.info)(f"Retry schedule rebuilt with {count} documents")
+        return count
+
+    def schedule(self, doc_id, due_at):
+        """Schedule (or reschedule) doc_id for due_at; None means now."""
+        due_ts = due_at.timestamp() if isinstance(due_at, datetime) else time.time()
+        with self._cond:
+            if self._due.get(doc_id) == due_ts:
+                return
+            self._due[doc_id] = due_ts
+            heapq.heappush(self._heap, (due_ts, doc_id))
+            if self._heap[0][1] == doc_id:
+                self._cond.notify()
+
+    def scheduled(self, doc_id):
+        with self._cond:
+            return doc_id in self._due
+
+    def cancel(self, doc_id):
+        with self._cond:
+            self._due.pop(doc_id, None)
+
+    def backlog(self):
+        with self._cond:
+            return len(self._due)
+
+    def next_due(self):
+        with self._cond:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="retry-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _drop_stale(self):
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _take_due(self):
+        """
+        Block until at least one entry is due, then pop up to FETCH_BATCH_SIZE due ids
+
+        Returns an empty list when a re-sync is due first, and None once stopped.
+        """
+        with self._cond:
+            while not self._stopped:
+                self._drop_stale()
+                until_resync = self._next_resync - time.monotonic()
+                if until_resync <= 0:
+                    return []
+                if not self._heap:
+                    self._cond.wait(until_resync)
+                    continue
+                wait = self._heap[0][0] - time.time()
+                if wait > 0:
+                    self._cond.wait(min(wait, until_resync))
+                    continue
+                now = time.time()
+                ids = []
+                while self._heap and len(ids) < FETCH_BATCH_SIZE:
+                    due_ts, doc_id = self._heap[0]
+                    if self._due.get(doc_id) != due_ts:
+                        heapq.heappop(self._heap)
+                        continue
+                    if due_ts > now:
+                        break
+                    heapq.heappop(self._heap)
+                    del self._due[doc_id]
+                    ids.append(doc_id)
+                return ids
+            return None
+
+    def _run(self):
+        while True:
+            ids = self._take_due()
+            if ids is None:
+                return
+            if not ids:
+                self.rebuild(quiet=True)
+                continue
+            try:
+                refs = [self.collection.document(doc_id) for doc_id in ids]
+                snaps = [s for s in self.db.get_all(refs) if s.exists]
+                logger.debug(f"{len(snaps)} retries due")
+                self.on_due(snaps)
+            except Exception as e:
+                logger.error(f"Failed to dispatch due retries: {e}")
+                # Try again shortly rather than losing the entries
+                retry_at = datetime.now(timezone.utc) + timedelta(seconds=config.RETRY_BASE_SECONDS)
+                for doc_id in ids:
+                    self.schedule(doc_id, retry_at)
@@ -0,0 +1,249 @@
+"""
+Send scheduler: fires documents with a future sendAt at that time
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+
+import config
+import metrics
+from utils import iter_query_pages
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('send_scheduler')
+
+# Resolution of the lowest wheel level, in seconds
+TICK_SECONDS = 0.1
+# Documents fetched per get_all() round trip
+FETCH_BATCH_SIZE = 100
+
+SCHEDULED_FIRED = metrics.counter('smtp_agent_scheduled_fired_total', 'Scheduled documents handed to the send workers at their sendAt')
+
+
+def parse_send_at(value):
+    """sendAt as an aware UTC datetime (Firestore timestamp or ISO 8601 string), or None."""
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str) and value.strip():
+        return config._parse_cutoff(value)
+    return None
+
+
+class TimerWheel:
+    """
+    Hierarchical timing wheel (Varghese & Lauck)
+
+    Level 0 has `slots` buckets of one tick each, and every level above
+    covers `slots` times the span of the one below, so 4 levels of 64 slots
+    at 100 ms reach about 19 days. A timer lives in the lowest level whose
+    span still separates it from the current tick, and moves down a level
+    each time the clock reaches its bucket. Adding and removing are O(1);
+    advancing touches each timer once per level and skips empty buckets, so
+    an idle stretch costs nothing. Not thread-safe.
+    """
+    def __init__(self, tick=TICK_SECONDS, slots=64, levels=4, now=None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]  # bucket: key -> due tick
+        self._where = {}  # key -> (level, slot)
+        self._current = self._to_tick(time.time() if now is None else now)  # next tick to process
+
+    def __len__(self):
+        return len(self._where)
+
+    def span(self):
+        """Seconds ahead of the current tick that a timer can be placed."""
+        return self.tick * self.slots ** self.levels
+
+    def add(self, key, due):
+        """Fire key at the timestamp `due` (past times fire on the next advance); replaces an earlier timer."""
+        self.remove(key)
+        due_tick = max(self._to_tick(due), self._current)
+        self._place(key, due_tick)
+
+    def remove(self, key):
+        where = self._where.pop(key, None)
+        if where is not None:
+            level, slot = where
+            self._wheels[level][slot].pop(key, None)
+
+    def advance(self, now):
+        """Move the clock to `now`; returns the keys whose time has come."""
+        target = self._to_tick(now)
+        fired = []
+        while self._where:
+            tick = self._next_event()
+            if tick > target:
+                break
+            # Cascade from the top so a timer can drop several levels within one tick
+            self._current = tick
+            for level in range(self.levels - 1, 0, -1):
+                size = self.slots ** level
+                if tick % size == 0:
+                    bucket = self._wheels[level][(tick // size) % self.slots]
+                    moved = list(bucket.items())
+                    bucket.clear()
+                    for key, due_tick in moved:
+                        self._place(key, due_tick)
+            bucket = self._wheels[0][tick % self.slots]
+            for key in bucket:
+                del self._where[key]
+            fired.extend(bucket)
+            bucket.clear()
+            self._current = tick + 1
+        self._current = max(self._current, target + 1)
+        return fired
+
+    def _next_event(self):
+        """First tick from the current one at which a non-empty bucket fires or cascades."""
+        best = None
+        for level in range(self.levels):
+            size = self.slots ** level
+            first = -(-self._current // size)  # first bucket starting at or after the current tick
+            for index in range(first, first + self.slots):
+                if best is not None and index * size >= best:
+                    break
+                if self._wheels[level][index % self.slots]:
+                    best = index * size
+                    break
+        return best
+
+    def _to_tick(self, ts):
+        return int(ts / self.tick)
+
+    def _place(self, key, due_tick):
+        # Lowest level whose higher-order digits are shared with the current tick
+        for level in range(self.levels):
+            above = self.slots ** (level + 1)
+            if due_tick // above == self._current // above:
+                break
+        else:
+            # The top level wraps: a slot behind the clock is next cascaded one rotation later
+            if due_tick - self._current >= self.slots ** self.levels:
+                raise ValueError(f"Timer {key} is beyond the wheel's span")
+            level = self.levels - 1
+        slot = (due_tick // self.slots ** level) % self.slots
+        self._wheels[level][slot][key] = due_tick
+        self._where[key] = (level, slot)
+
+
+class SendScheduler:
+    """
+    Holds SCHEDULED documents due within SCHEDULE_HORIZON in a TimerWheel
+
+    The listener adds documents as it marks them SCHEDULED. A loader also
+    walks the SCHEDULED documents in sendAt order every SCHEDULE_LOAD_INTERVAL
+    seconds, continuing after the last sendAt it saw, so it only reads
+    documents that newly came within the horizon. Once per horizon it starts
+    over from the beginning to pick up documents that other instances
+    scheduled behind that cursor. When timers fire, the documents are
+    fetched by id and handed to on_due, the same callback the retry scheduler
+    uses.
+    """
+    def __init__(self, db, collection, on_due, horizon=None, load_interval=None):
+        self.db = db
+        self.collection = collection
+        self.on_due = on_due
+        self.horizon = horizon or config.SCHEDULE_HORIZON
+        self.load_interval = load_interval or config.SCHEDULE_LOAD_INTERVAL
+        self.wheel = TimerWheel()
+        # The wheel must reach past the horizon and one load interval
+        self.horizon = min(self.horizon, self.wheel.span() - self.load_interval - 1)
+        self._cursor = None  # sendAt of the last document loaded
+        self._full_pass_at = 0.0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def scheduled(self):
+        with self._lock:
+            return len(self.wheel)
+
+    def schedule(self, doc_id, send_at):
+        """Fire doc_id at send_at if that is within the horizon; later ones are loaded when they get close."""
+        if send_at.timestamp() > time.time() + self.horizon:
+            return False
+        with self._lock:
+            self.wheel.add(doc_id, send_at.timestamp())
+        self._wake.set()
+        return True
+
+    def load(self):
+        """Load SCHEDULED documents that came within the horizon since the last load."""
+        now = time.monotonic()
+        if now >= self._full_pass_at:
+            self._cursor = None
+            self._full_pass_at = now + self.horizon
+        until = datetime.now(timezone.utc) + timedelta(seconds=self.horizon)
+        count = 0
+        try:
+            query = (
+                self.collection
+                .where('smtpAgent.state', '==', 'SCHEDULED')
+                .where('smtpAgent.sendAt', '<=', until)
+            )
+            if self._cursor is not None:
+                query = query.where('smtpAgent.sendAt', '>', self._cursor)
+            query = query.order_by('smtpAgent.sendAt').select(['smtpAgent.sendAt'])
+            for page in iter_query_pages(query, config.QUERY_PAGE_SIZE):
+                for snap in page:
+                    send_at = parse_send_at(((snap.to_dict() or {}).get('smtpAgent', {}) or {}).get('sendAt'))
+                    if send_at is None:
+                        continue
+                    self.schedule(snap.id, send_at)
+                    self._cursor = send_at
+                    count += 1
+        except Exception as e:
+            logger.error(f"Failed to load scheduled documents: {e}")
+        if count:
+            logger.info(f"Loaded {count} scheduled documents due before {until.isoformat()}")
+        return count
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="send-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _fire(self, ids):
+        for i in range(0, len(ids), FETCH_BATCH_SIZE):
+            batch = ids[i:i + FETCH_BATCH_SIZE]
+            try:
+                refs = [self.collection.document(doc_id) for doc_id in batch]
+                snaps = [s for s in self.db.get_all(refs) if s.exists]
+                SCHEDULED_FIRED.inc(len(snaps))
+                logger.debug(f"{len(snaps)} scheduled documents due")
+                self.on_due(snaps)
+            except Exception as e:
+                logger.error(f"Failed to dispatch scheduled documents: {e}")
+                # Try again shortly rather than losing them
+                retry_at = time.time() + config.RETRY_BASE_SECONDS
+                with self._lock:
+                    for doc_id in batch:
+                        self.wheel.add(doc_id, retry_at)
+
+    def _run(self):
+        next_load = 0.0
+        while not self._stop.is_set():
+            if time.monotonic() >= next_load:
+                self.load()
+                next_load = time.monotonic() + self.load_interval
+            with self._lock:
+                due = self.wheel.advance(time.time())
+                idle = not len(self.wheel)
+            if due:
+                self._fire(due)
+            # Tick while timers are pending; otherwise sleep until the next load or a new timer
+            self._wake.wait(max(0.0, next_load - time.monotonic()) if idle else TICK_SECONDS)
+            self._wake.clear()
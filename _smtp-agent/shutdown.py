@@ -0,0 +1,100 @@
+"""
+Graceful shutdown: stop claiming, drain in-flight sends, flush state
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+
+import config
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('shutdown')
+
+
+class ShutdownCoordinator:
+    """
+    Orderly stop of a delivery engine on SIGTERM/SIGINT
+
+    request() only flags the engine: no new documents are prepared or
+    claimed, and documents claimed but not yet handed to SMTP have their
+    lease dropped so another instance can take them straight away. The
+    engine's loop then exits and calls drain() (drain_async() on the asyncio
+    engine), which waits up to SHUTDOWN_GRACE_SECONDS for in-flight sends
+    and then stops the background workers, committing queued Firestore
+    writes and delivery counters. Sends still running at the deadline keep
+    their lease, which expires normally. A second signal exits immediately.
+    """
+    def __init__(self, engine, grace_seconds=None):
+        self.engine = engine
+        self.grace_seconds = config.SHUTDOWN_GRACE_SECONDS if grace_seconds is None else grace_seconds
+        self.requested = threading.Event()
+        self._deadline = None
+
+    def request(self, reason='signal'):
+        if self.requested.is_set():
+            logger.warning("Shutdown requested again; exiting without waiting for in-flight sends")
+            os._exit(1)
+        logger.info(f"Shutdown requested ({reason}); draining for up to {self.grace_seconds}s")
+        self._deadline = time.monotonic() + self.grace_seconds
+        self.requested.set()
+        self.engine.stop_claiming()
+
+    def remaining(self):
+        if self._deadline is None:
+            return self.grace_seconds
+        return max(0.0, self._deadline - time.monotonic())
+
+    def drain(self):
+        """Wait for in-flight sends (threaded engine), then close everything."""
+        deadline = time.monotonic() + self.remaining()
+        while self.engine.in_flight_count() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._report()
+        self.close()
+
+    async def drain_async(self):
+        """drain() for the asyncio engine, run on its event loop."""
+        pending = self.engine.pending_tasks()
+        if pending:
+            await asyncio.wait(pending, timeout=self.remaining())
+        self._report()
+        try:
+            await self.engine.smtp_sender.close()
+        except Exception as e:
+            logger.warning(f"Shutdown: closing SMTP sessions failed: {e}")
+        await asyncio.to_thread(self.close)
+
+    def close(self):
+        """Stop the engine's background workers; the write batcher goes last so their writes land."""
+        engine = self.engine
+        steps = [
+            ('retry scheduler', lambda: engine.retry_scheduler and engine.retry_scheduler.stop()),
+            ('send scheduler', engine.send_scheduler.stop),
+            ('lease reaper', lambda: engine.lease_reaper and engine.lease_reaper.stop()),
+            ('snapshot listener', engine._stop_snapshot),
+            ('config listener', engine.config_provider.stop),
+            ('lease renewer', engine.leases.stop),
+            ('send workers', engine.close_workers),
+            ('write batcher', engine.writer.close),
+            ('delivery stats', engine.stats.stop),
+        ]
+        for name, step in steps:
+            try:
+                step()
+            except Exception as e:
+                logger.warning(f"Shutdown: stopping {name} failed: {e}")
+        logger.info("Shutdown complete")
+
+    def _report(self):
+        left = self.engine.in_flight_count()
+        if left:
+            logger.warning(f"Shutdown deadline reached with {left} documents still sending; their leases will expire")
+        else:
+            logger.info("In-flight sends finished")
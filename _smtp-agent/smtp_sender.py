@@ -1,13 +1,22 @@
 """
 SMTP Sender module for sending emails via SMTP
 """
+import hashlib
 import logging
 import smtplib
+import socket
+import threading
+import time
+from collections import OrderedDict
+from email import policy
+from email.message import Message
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from datetime import datetime
 
 import config
+import metrics
+from rate_limiter import AdaptiveRateLimiter, THROTTLE_CODES
 
 # Configure logging
 logging.basicConfig(
@@ -17,6 +26,204 @@ logging.basicConfig(
 )
 logger = logging.getLogger('smtp_sender')
 
+SMTP_PHASE_SECONDS = metrics.histogram(
+    'smtp_agent_smtp_phase_seconds', 'Latency of SMTP connect, STARTTLS, AUTH and DATA', ('phase',))
+SMTP_MESSAGES = metrics.counter(
+    'smtp_agent_smtp_messages_total', 'Messages handed to the SMTP server by outcome', ('result',))
+# Children resolved once so the send path skips the label lookup
+_PHASE_CONNECT = SMTP_PHASE_SECONDS.labels('connect')
+_PHASE_TLS = SMTP_PHASE_SECONDS.labels('tls')
+_PHASE_AUTH = SMTP_PHASE_SECONDS.labels('auth')
+_PHASE_DATA = SMTP_PHASE_SECONDS.labels('data')
+MIME_CACHE = metrics.counter('smtp_agent_mime_body_cache_total', 'Message body lookups in the encoded MIME cache', ('result',))
+_MIME_HIT = MIME_CACHE.labels('hit')
+_MIME_MISS = MIME_CACHE.labels('miss')
+
+# Same serialization as Message.as_string(), but with the CRLF line endings sendmail expects for bytes
+_SMTP_POLICY = policy.compat32.clone(linesep='\r\n', max_line_length=0)
+
+
+def _smtp_code(error):
+    """Best-effort SMTP reply code of an smtplib exception."""
+    code = getattr(error, 'smtp_code', None)
+    if code is None and isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [c for c, _ in error.recipients.values()]
+        code = codes[0] if codes else None
+    return code
+
+
+# Errors that mean the session is gone and the message can be retried on a fresh one
+_RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, socket.timeout, ConnectionError)
+
+
+class _PooledConnection:
+    """An authenticated SMTP session plus the bookkeeping the pool needs."""
+    def __init__(self, server, bucket=None):
+        self.server = server
+        self.bucket = bucket  # optional per-session rate limit
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+        self.messages_sent = 0
+
+
+class SMTPConnectionPool:
+    """
+    Bounded pool of already-authenticated SMTP sessions
+
+    Sessions are checked with NOOP before reuse, retired after
+    max_messages messages and closed after idle_timeout seconds without use.
+    """
+    def __init__(self, connect, max_size, max_messages, idle_timeout, bucket_factory=None):
+        self._connect = connect
+        self._bucket_factory = bucket_factory
+        self.max_size = max(1, max_size)
+        self.max_messages = max(1, max_messages)
+        self.idle_timeout = idle_timeout
+        self._idle = []  # LIFO so the warmest session is reused first
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._in_use = 0
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        self._reaper = None
+
+    def acquire(self):
+        """Return a live session, reusing an idle one when possible."""
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    break
+                if self._expired(conn) or not self._is_alive(conn):
+                    self._close(conn)
+                    continue
+                with self._lock:
+                    self.hits += 1
+                    self._in_use += 1
+                return conn
+            bucket = self._bucket_factory() if self._bucket_factory else None
+            conn = _PooledConnection(self._connect(), bucket)
+            with self._lock:
+                self.misses += 1
+                self._in_use += 1
+            self._ensure_reaper()
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, reusable=True):
+        """Return a session to the pool, or close it if it should not be reused."""
+        try:
+            with self._lock:
+                self._in_use -= 1
+            if reusable and conn.messages_sent < self.max_messages:
+                conn.last_used_at = time.monotonic()
+                with self._lock:
+                    self._idle.append(conn)
+            else:
+                self._close(conn)
+        finally:
+            self._slots.release()
+
+    def close_idle(self):
+        """Close sessions that have been idle longer than idle_timeout."""
+        with self._lock:
+            expired = [c for c in self._idle if self._expired(c)]
+            self._idle = [c for c in self._idle if c not in expired]
+        for conn in expired:
+            logger.debug("Closing idle SMTP session")
+            self._close(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.max_size,
+                'idle': len(self._idle),
+                'inUse': self._in_use,
+                'hits': self.hits,
+                'misses': self.misses,
+                'discarded': self.discarded,
+            }
+
+    def _expired(self, conn):
+        return self.idle_timeout > 0 and (time.monotonic() - conn.last_used_at) > self.idle_timeout
+
+    def _is_alive(self, conn):
+        try:
+            return conn.server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _close(self, conn):
+        with self._lock:
+            self.discarded += 1
+        try:
+            conn.server.quit()
+        except Exception:
+            try:
+                conn.server.close()
+            except Exception:
+                pass
+
+    def _ensure_reaper(self):
+        if self.idle_timeout <= 0 or self._reaper is not None:
+            return
+        def _run():
+            interval = max(1, self.idle_timeout / 2)
+            while True:
+                time.sleep(interval)
+                try:
+                    self.close_idle()
+                except Exception as e:
+                    logger.debug(f"Idle session reaper error: {e}")
+        self._reaper = threading.Thread(target=_run, name="smtp-pool-reaper", daemon=True)
+        self._reaper.start()
+
+
+class MimeBodyCache:
+    """
+    Encoded message bodies, keyed by content hash
+
+    An entry holds the multipart/alternative headers and the encoded body
+    parts of one HTML content, serialized once. A message is then just its
+    Subject/From/To headers joined in between, so a bulk send does not
+    re-encode the same newsletter for every recipient.
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max(1, max_entries or config.MIME_CACHE_SIZE)
+        self._entries = OrderedDict()  # content key -> (head, body)
+        self._lock = threading.Lock()
+
+    def get(self, key, html_content):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            _MIME_HIT.inc()
+            return entry
+        _MIME_MISS.inc()
+        msg = MIMEMultipart('alternative')
+        msg.attach(MIMEText(html_content, 'html'))
+        head, _, body = msg.as_bytes(policy=_SMTP_POLICY).partition(b'\r\n\r\n')
+        entry = (head + b'\r\n', body)
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+
 class SMTPSender:
     """
     Handles sending emails via SMTP
@@ -29,62 +236,254 @@ class SMTPSender:
         self.use_tls = config.SMTP_USE_TLS
         self.from_email = config.SMTP_FROM_EMAIL
         self.from_name = config.SMTP_FROM_NAME
-        
-    def send_email(self, to_email, subject, html_content):
+        self.timeout = config.SMTP_TIMEOUT
+        self.rate_limiter = AdaptiveRateLimiter()
+        self.bodies = MimeBodyCache()
+        self.pool = SMTPConnectionPool(
+            self._open_connection,
+            max_size=config.SMTP_POOL_SIZE,
+            max_messages=config.SMTP_MAX_MESSAGES_PER_CONNECTION,
+            idle_timeout=config.SMTP_IDLE_TIMEOUT,
+            bucket_factory=self.rate_limiter.connection_bucket,
+        )
+
+    def _open_connection(self):
+        """Open, secure and authenticate a new SMTP session"""
+        logger.info(f"Connecting to SMTP server {self.smtp_server}:{self.smtp_port}")
+        with _PHASE_CONNECT.time():
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                with _PHASE_TLS.time():
+                    server.starttls()
+
+            # Login if credentials are provided
+            if self.username and self.password:
+                logger.debug(f"Logging in as {self.username}")
+                with _PHASE_AUTH.time():
+                    server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def close(self):
+        self.pool.close_all()
+
+    def send_email(self, to_email, subject, html_content, content_key=None):
         """
         Send an email using SMTP
-        
+
         Args:
             to_email (str): Recipient email address
             subject (str): Email subject
             html_content (str): HTML content of the email
-            
+            content_key (str): Hash identifying html_content, for the body cache (computed if omitted)
+
         Returns:
             dict: Result of the email sending operation
                 {
                     'success': bool,
                     'timestamp': datetime,
-                    'error': str or None
+                    'error': str or None,
+                    'smtpCode': int or None,
+                    'throttled': bool  # provider asked us to slow down (421/451/452)
                 }
         """
         try:
-            # Create message container
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = subject
-            msg['From'] = f"{self.from_name} <{self.from_email}>"
-            msg['To'] = to_email
-            
-            # Attach HTML content
-            html_part = MIMEText(html_content, 'html')
-            msg.attach(html_part)
-            
-            # Connect to SMTP server
-            logger.info(f"Connecting to SMTP server {self.smtp_server}:{self.smtp_port}")
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                if self.use_tls:
-                    server.starttls()
-                
-                # Login if credentials are provided
-                if self.username and self.password:
-                    logger.debug(f"Logging in as {self.username}")
-                    server.login(self.username, self.password)
-                
-                # Send email
-                logger.info(f"Sending email to {to_email} with subject: {subject}")
-                server.sendmail(self.from_email, to_email, msg.as_string())
-                
-            logger.info(f"Email sent successfully to {to_email}")
-            return {
-                'success': True,
-                'timestamp': datetime.now(),
-                'error': None
-            }
-            
+            payload = self._render_message(to_email, subject, html_content, content_key)
         except Exception as e:
-            error_msg = f"Failed to send email: {str(e)}"
-            logger.error(error_msg)
-            return {
-                'success': False,
-                'timestamp': datetime.now(),
-                'error': error_msg
-            }
+            return self._failed_result(e)
+        outcome = self._deliver_all([(to_email, payload)])[0]
+        return self._outcome_result(outcome, to_email)
+
+    def send_group(self, recipients, subject, html_content, bcc=False, content_key=None):
+        """
+        Send one message body to the recipients of several documents
+
+        Documents are ordered by recipient domain and sent back to back over
+        a single pooled session. With bcc=True the message is rendered once
+        with an undisclosed To header and up to BCC_MAX_RECIPIENTS recipients
+        share each SMTP transaction.
+
+        Args:
+            recipients (list): One list of addresses per document
+            subject (str): Email subject
+            html_content (str): HTML content of the email
+            content_key (str): Hash identifying html_content, for the body cache (computed if omitted)
+
+        Returns:
+            list: One send_email-style result dict per document, in input order
+        """
+        try:
+            chunks, messages = self._group_messages(recipients, subject, html_content, bcc, content_key)
+        except Exception as e:
+            return [self._failed_result(e) for _ in recipients]
+        return self._group_results(recipients, chunks, self._deliver_all(messages))
+
+    def _group_messages(self, recipients, subject, html_content, bcc, content_key=None):
+        """
+        SMTP transactions for send_group
+
+        Returns:
+            tuple: (chunks, messages) where chunks[k] lists the document indexes
+                delivered by messages[k], a (to_addrs, payload) tuple
+        """
+        order = sorted(range(len(recipients)), key=lambda i: _domain_key(recipients[i]))
+        if bcc:
+            chunks = _chunk_recipients(order, recipients, config.BCC_MAX_RECIPIENTS)
+            payload = self._render_message('undisclosed-recipients:;', subject, html_content, content_key)
+            return chunks, [([a for i in chunk for a in recipients[i]], payload) for chunk in chunks]
+        chunks = [[i] for i in order]
+        return chunks, [
+            (recipients[i], self._render_message(', '.join(recipients[i]), subject, html_content, content_key))
+            for i in order
+        ]
+
+    def _group_results(self, recipients, chunks, outcomes):
+        results = [None] * len(recipients)
+        for chunk, outcome in zip(chunks, outcomes):
+            for i in chunk:
+                results[i] = self._outcome_result(outcome, recipients[i])
+        return results
+
+    def _render_message(self, to_email, subject, html_content, content_key=None):
+        """Build the MIME message and return it as bytes ready for sendmail"""
+        if content_key is None:
+            content_key = hashlib.sha256((html_content or '').encode('utf-8', 'surrogatepass')).hexdigest()
+        head, body = self.bodies.get(content_key, html_content)
+        # Only the per-recipient headers are rendered for each message
+        headers = Message()
+        headers['Subject'] = subject
+        headers['From'] = f"{self.from_name} <{self.from_email}>"
+        headers['To'] = to_email
+        return b''.join((head, headers.as_bytes(policy=_SMTP_POLICY), body))
+
+    def _sent_result(self, to_email):
+        logger.info(f"Email sent successfully to {to_email}")
+        SMTP_MESSAGES.labels('sent').inc()
+        return {
+            'success': True,
+            'timestamp': datetime.now(),
+            'error': None,
+            'smtpCode': 250,
+            'throttled': False
+        }
+
+    def _failed_result(self, error):
+        error_msg = f"Failed to send email: {str(error)}"
+        logger.error(error_msg)
+        code = _smtp_code(error)
+        SMTP_MESSAGES.labels('throttled' if code in THROTTLE_CODES else 'error').inc()
+        return {
+            'success': False,
+            'timestamp': datetime.now(),
+            'error': error_msg,
+            'smtpCode': code,
+            'throttled': code in THROTTLE_CODES
+        }
+
+    def _outcome_result(self, outcome, to_addrs):
+        """Result dict for one document from a _deliver_all outcome."""
+        if isinstance(outcome, BaseException):
+            return self._failed_result(outcome)
+        to_addrs = [to_addrs] if isinstance(to_addrs, str) else to_addrs
+        refused = {a: outcome[a] for a in to_addrs if a in outcome}
+        if refused and len(refused) == len(to_addrs):
+            # Other recipients of a shared transaction were accepted; these were not
+            return self._failed_result(smtplib.SMTPRecipientsRefused(refused))
+        return self._sent_result(', '.join(to_addrs))
+
+    def _deliver_all(self, messages):
+        """
+        Send rendered messages back to back over one pooled session
+
+        A reused session that was dropped by the server (421, disconnect,
+        timeout) is discarded and the message retried once on a fresh one.
+
+        Args:
+            messages (list): (to_addrs, payload) tuples
+
+        Returns:
+            list: Per message, the dict of refused recipients or the exception that failed it
+        """
+        outcomes = []
+        conn = None
+        try:
+            for to_addrs, payload in messages:
+                for attempt in (1, 2):
+                    self.rate_limiter.acquire()
+                    if conn is None:
+                        try:
+                            conn = self.pool.acquire()
+                        except Exception as e:
+                            # No session to be had; the rest of the batch would fail the same way
+                            outcomes.extend([e] * (len(messages) - len(outcomes)))
+                            return outcomes
+                    reused = conn.messages_sent > 0
+                    try:
+                        if conn.bucket is not None:
+                            conn.bucket.acquire()
+                        logger.info(f"Sending email to {to_addrs}")
+                        with _PHASE_DATA.time():
+                            outcome = conn.server.sendmail(self.from_email, to_addrs, payload)
+                        conn.messages_sent += 1
+                        self.rate_limiter.on_success()
+                    except smtplib.SMTPResponseException as e:
+                        if e.smtp_code in THROTTLE_CODES:
+                            self.rate_limiter.on_throttle(e.smtp_code)
+                        outcome = e
+                        # 421: service closing the channel; other codes leave the session usable
+                        if e.smtp_code == 421:
+                            self.pool.release(conn, reusable=False)
+                            conn = None
+                            if reused and attempt == 1:
+                                logger.info("SMTP session closed by server (421), reconnecting")
+                                continue
+                    except _RECONNECT_ERRORS as e:
+                        self.pool.release(conn, reusable=False)
+                        conn = None
+                        outcome = e
+                        if reused and attempt == 1:
+                            logger.info(f"SMTP session lost ({e.__class__.__name__}), reconnecting")
+                            continue
+                    except Exception as e:
+                        self.pool.release(conn, reusable=False)
+                        conn = None
+                        if _smtp_code(e) in THROTTLE_CODES:
+                            self.rate_limiter.on_throttle(_smtp_code(e))
+                        outcome = e
+                    break
+                outcomes.append(outcome)
+                if conn is not None and conn.messages_sent >= self.pool.max_messages:
+                    self.pool.release(conn)
+                    conn = None
+        finally:
+            if conn is not None:
+                self.pool.release(conn)
+        return outcomes
+
+
+def _domain_key(to_addrs):
+    """Sort key grouping recipients of the same domain together."""
+    to_addrs = [to_addrs] if isinstance(to_addrs, str) else to_addrs
+    return sorted((a.rsplit('@', 1)[-1].lower(), a.lower()) for a in to_addrs) or [('', '')]
+
+
+def _chunk_recipients(order, recipients, max_recipients):
+    """Split document indexes into transactions of at most max_recipients RCPTs (a document is never split)."""
+    chunks = []
+    current, count = [], 0
+    for i in order:
+        n = len(recipients[i])
+        if current and count + n > max_recipients:
+            chunks.append(current)
+            current, count = [], 0
+        current.append(i)
+        count += n
+    if current:
+        chunks.append(current)
+    return chunks
@@ -0,0 +1,129 @@
+"""
+Shared helpers for the SMTP Agent
+"""
+import os
+import time
+
+import metrics
+
+QUERY_PAGE_SECONDS = metrics.histogram(
+    'smtp_agent_query_page_seconds', 'Time to fetch one page of a Firestore query')
+
+
+def iter_query_pages(query, page_size):
+    """
+    Stream a Firestore query page by page using limit + start_after cursors
+
+    Only one page of snapshots is held at a time, so memory stays flat no matter
+    how many documents match. The SDK adds the implicit ordering (inequality
+    fields, then document id) that the cursors need.
+
+    Yields:
+        list: Document snapshots of one page (never empty)
+    """
+    last = None
+    while True:
+        page_query = query.limit(page_size)
+        if last is not None:
+            page_query = page_query.start_after(last)
+        with QUERY_PAGE_SECONDS.time():
+            page = list(page_query.stream())
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
+
+async def aiter_query_pages(query, page_size):
+    """Async counterpart of iter_query_pages for queries of the async Firestore client."""
+    last = None
+    while True:
+        page_query = query.limit(page_size)
+        if last is not None:
+            page_query = page_query.start_after(last)
+        with QUERY_PAGE_SECONDS.time():
+            page = [snap async for snap in page_query.stream()]
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
+
+def tail_lines(path, n, block_size=8192):
+    """
+    Last n lines of a text file
+
+    Reads backwards from the end of the file in block_size chunks until enough
+    newlines have been seen, so the cost depends on n, not on the file size.
+    """
+    if n <= 0:
+        return []
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b''
+        # n + 1 newlines guarantee n complete lines when the file ends with one
+        while pos > 0 and data.count(b'\n') <= n:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    return [line.decode('utf-8', errors='replace') for line in data.splitlines(keepends=True)[-n:]]
+
+
+def follow_file(path, interval=0.5, idle_every=15.0):
+    """
+    Follow a growing (and possibly rotated) text file, like tail -F
+
+    Starts at the current end of the file. Yields each new complete line, and
+    None after idle_every seconds without output so callers can send
+    keep-alives. When the file is rotated or truncated it is reopened and read
+    from its start.
+    """
+    f = None
+    inode = None
+    from_start = False  # only the very first open skips existing content
+    partial = ''
+    idle = 0.0
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = open(path, 'r', encoding='utf-8', errors='replace')
+                    inode = os.fstat(f.fileno()).st_ino
+                    if not from_start:
+                        f.seek(0, os.SEEK_END)
+                except FileNotFoundError:
+                    f = None
+                from_start = True
+            line = f.readline() if f is not None else ''
+            if line:
+                partial += line
+                if partial.endswith('\n'):
+                    yield partial
+                    partial = ''
+                    idle = 0.0
+                continue
+            if f is not None:
+                # At EOF: reopen if the file was rotated away or truncated
+                try:
+                    st = os.stat(path)
+                    rotated = st.st_ino != inode or st.st_size < f.tell()
+                except FileNotFoundError:
+                    rotated = True
+                if rotated:
+                    f.close()
+                    f = None
+                    continue
+            time.sleep(interval)
+            idle += interval
+            if idle >= idle_every:
+                idle = 0.0
+                yield None
+    finally:
+        if f is not None:
+            f.close()
@@ -0,0 +1,184 @@
+"""
+Write batcher that coalesces Firestore document writes into batched commits
+"""
+import logging
+import threading
+import time
+
+import config
+import metrics
+
+# Configure logging
+logging.basicConfig(
+    level=getattr(logging, config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    filename=config.LOG_FILE if config.LOG_FILE else None
+)
+logger = logging.getLogger('write_batcher')
+
+# Firestore rejects batches with more than 500 writes
+MAX_BATCH_OPS = 500
+
+WRITE_SECONDS = metrics.histogram(
+    'smtp_agent_firestore_write_seconds', 'Latency of Firestore batch commits and single writes', ('kind',))
+_WRITE_BATCH = WRITE_SECONDS.labels('batch')
+_WRITE_SINGLE = WRITE_SECONDS.labels('single')
+WRITE_OPS = metrics.counter(
+    'smtp_agent_firestore_write_ops_total', 'Document writes by outcome', ('result',))
+
+
+class PendingWrite:
+    """A queued write; wait() blocks until it has been committed or has failed."""
+    __slots__ = ('doc_ref', 'op', 'data', 'merge', 'queued_at', 'ok', 'error', '_done')
+
+    def __init__(self, doc_ref, op, data, merge=False):
+        self.doc_ref = doc_ref
+        self.op = op
+        self.data = data
+        self.merge = merge
+        self.queued_at = time.monotonic()
+        self.ok = None
+        self.error = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Wait for the write to land. Returns True on success."""
+        self._done.wait(timeout)
+        return bool(self.ok)
+
+    def _resolve(self, ok, error=None):
+        self.ok = ok
+        self.error = error
+        self._done.set()
+
+
+class WriteBatcher:
+    """
+    Groups document writes into WriteBatch commits
+
+    Writes are flushed when max_ops are queued or the oldest queued write is
+    window seconds old. If a batch commit fails, each write in it is retried
+    on its own so one bad document cannot sink the others.
+    """
+    def __init__(self, db, max_ops=None, window=None):
+        self.db = db
+        self.max_ops = max(1, min(max_ops or config.WRITE_BATCH_MAX_OPS, MAX_BATCH_OPS))
+        self.window = config.WRITE_BATCH_WINDOW_MS / 1000.0 if window is None else window
+        self._queue = []
+        self._inflight = []  # chunks taken off the queue and still committing
+        self._cond = threading.Condition()
+        self._closed = False
+        self.commits = 0
+        self.ops_committed = 0
+        self.ops_failed = 0
+        self._thread = threading.Thread(target=self._run, name="write-batcher", daemon=True)
+        self._thread.start()
+
+    def set(self, doc_ref, data, merge=False):
+        """Queue doc_ref.set(data, merge=merge)."""
+        return self._enqueue(PendingWrite(doc_ref, 'set', data, merge))
+
+    def update(self, doc_ref, data):
+        """Queue doc_ref.update(data)."""
+        return self._enqueue(PendingWrite(doc_ref, 'update', data))
+
+    def flush(self):
+        """Commit everything queued so far and wait for it, and any commit already under way, to land."""
+        with self._cond:
+            pending = list(self._queue)
+            for chunk in self._inflight:
+                pending.extend(chunk)
+            self._cond.notify_all()
+        self._commit_now()
+        for write in pending:
+            write.wait()
+
+    def close(self):
+        """Flush outstanding writes and stop the background thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=max(5.0, self.window * 10))
+        self._commit_now()
+
+    def pending(self):
+        with self._cond:
+            return len(self._queue)
+
+    def _enqueue(self, write):
+        with self._cond:
+            if self._closed:
+                # Shutting down: write through so nothing is dropped
+                self._write_one(write)
+                return write
+            self._queue.append(write)
+            if len(self._queue) >= self.max_ops or len(self._queue) == 1:
+                self._cond.notify_all()
+        return write
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._queue:
+                        age = time.monotonic() - self._queue[0].queued_at
+                        if len(self._queue) >= self.max_ops or age >= self.window:
+                            break
+                        self._cond.wait(self.window - age)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+            self._commit_now()
+
+    def _commit_now(self):
+        while True:
+            with self._cond:
+                chunk = self._queue[:self.max_ops]
+                del self._queue[:self.max_ops]
+                if chunk:
+                    self._inflight.append(chunk)
+            if not chunk:
+                return
+            try:
+                self._commit(chunk)
+            finally:
+                with self._cond:
+                    self._inflight.remove(chunk)
+
+    def _commit(self, chunk):
+        batch = self.db.batch()
+        for write in chunk:
+            if write.op == 'set':
+                batch.set(write.doc_ref, write.data, merge=write.merge)
+            else:
+                batch.update(write.doc_ref, write.data)
+        try:
+            with _WRITE_BATCH.time():
+                batch.commit()
+            self.commits += 1
+            self.ops_committed += len(chunk)
+            WRITE_OPS.labels('ok').inc(len(chunk))
+            for write in chunk:
+                write._resolve(True)
+            logger.debug(f"Committed batch of {len(chunk)} writes")
+        except Exception as e:
+            logger.warning(f"Batch commit of {len(chunk)} writes failed ({e}); retrying individually")
+            for write in chunk:
+                self._write_one(write)
+
+    def _write_one(self, write):
+        try:
+            with _WRITE_SINGLE.time():
+                if write.op == 'set':
+                    write.doc_ref.set(write.data, merge=write.merge)
+                else:
+                    write.doc_ref.update(write.data)
+            self.ops_committed += 1
+            WRITE_OPS.labels('ok').inc()
+            write._resolve(True)
+        except Exception as e:
+            self.ops_failed += 1
+            WRITE_OPS.labels('failed').inc()
+            logger.error(f"Failed to write {write.doc_ref.id}: {e}")
+            write._resolve(False, e)